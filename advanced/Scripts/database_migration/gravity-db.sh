@@ -12,8 +12,96 @@
 
 readonly scriptPath="/etc/.pihole/advanced/Scripts/database_migration/gravity"
 
+# All writers of the gravity database (gravity, list.sh and the web interface) take an
+# exclusive lock on this file first. They wait in line for each other instead of competing
+# for SQLite's write lock with busy timeouts. Readers do not take the lock: the database
+# uses a write-ahead log, so FTL and the web interface can read while a write is going on
+readonly gravityDBlockFile="/etc/pihole/gravity.db.lock"
+readonly gravityDBlockTimeout=120
+# A replaced database is kept here until FTL has been told to reload the lists
+readonly gravityDBoldFile="/etc/pihole/gravity_old.db"
+
+# Run a command while holding the gravity database lock
+lock_gravityDB() {
+	# The lock is already held by this shell (see acquire_gravityDB_lock)
+	if [[ -n "${gravityDBlockFD:-}" ]]; then
+		"$@"
+		return
+	fi
+	(
+		if ! flock -w "${gravityDBlockTimeout}" 9; then
+			echo "Unable to lock ${gravityDBlockFile} within ${gravityDBlockTimeout} seconds" >&2
+			exit 1
+		fi
+		"$@"
+		status="$?"
+		fix_gravityDB_permissions
+		exit "${status}"
+	) 9>> "${gravityDBlockFile}"
+}
+
+# Hold the gravity database lock for a sequence of commands, until release_gravityDB_lock is called
+acquire_gravityDB_lock() {
+	exec {gravityDBlockFD}>> "${gravityDBlockFile}"
+	if ! flock -w "${gravityDBlockTimeout}" "${gravityDBlockFD}"; then
+		echo "Unable to lock ${gravityDBlockFile} within ${gravityDBlockTimeout} seconds" >&2
+		release_gravityDB_lock
+		return 1
+	fi
+}
+
+release_gravityDB_lock() {
+	if [[ -n "${gravityDBlockFD:-}" ]]; then
+		fix_gravityDB_permissions
+		exec {gravityDBlockFD}>&-
+		unset gravityDBlockFD
+	fi
+}
+
+# The write-ahead log and shared memory files are created by whoever opens the database first,
+# they remain as long as FTL keeps the database open. FTL (user pihole) and the web interface
+# (read-only, group pihole) have to write the shared memory file even to read, so both files
+# get the owner and mode of the database after every write of a root-run script
+fix_gravityDB_permissions(){
+	local database="${gravityDBlockFile%.lock}" file
+	for file in "${database}-wal" "${database}-shm"; do
+		if [[ -e "${file}" ]]; then
+			chown --reference="${database}" "${file}" 2> /dev/null
+			chmod --reference="${database}" "${file}" 2> /dev/null
+		fi
+	done
+	return 0
+}
+
+# Replace the gravity database with a new database file, the lock has to be held
+# The old database is moved aside together with its write-ahead log and shared memory files:
+# SQLite would apply them to the new database, and FTL keeps reading from them until it is
+# told to reload the lists. Call remove_old_gravityDB once FTL has been signalled
+swap_gravityDB(){
+	local new="${1}" database="${gravityDBlockFile%.lock}" suffix
+	for suffix in "" "-wal" "-shm"; do
+		if [[ -e "${database}${suffix}" ]]; then
+			mv -f "${database}${suffix}" "${gravityDBoldFile}${suffix}"
+		fi
+	done
+	mv "${new}" "${database}"
+	chown pihole:pihole "${database}"
+	chmod g+w "${database%/*}" "${database}"
+}
+
+remove_old_gravityDB(){
+	rm -f "${gravityDBoldFile}" "${gravityDBoldFile}-wal" "${gravityDBoldFile}-shm"
+}
+
+# Write all changes from the write-ahead log back into the database and truncate the log
+checkpoint_gravityDB(){
+	local database="${1}"
+	printf ".timeout 30000\\nPRAGMA wal_checkpoint(TRUNCATE);\\n" | lock_gravityDB sqlite3 "${database}" > /dev/null
+}
+
 upgrade_gravityDB(){
 	local database piholeDir auditFile version
+	local -a steps=()
 	database="${1}"
 	piholeDir="${2}"
 	auditFile="${piholeDir}/auditlog.list"
@@ -24,74 +112,63 @@ upgrade_gravityDB(){
 	if [[ "$version" == "1" ]]; then
 		# This migration script upgrades the gravity.db file by
 		# adding the domain_audit table
-		echo -e "  ${INFO} Upgrading gravity database from version 1 to 2"
-		sqlite3 "${database}" < "${scriptPath}/1_to_2.sql"
+		steps+=("1_to_2")
 		version=2
 
 		# Store audit domains in database table
 		if [ -e "${auditFile}" ]; then
-			echo -e "  ${INFO} Migrating content of ${auditFile} into new database"
-			# database_table_from_file is defined in gravity.sh
-			database_table_from_file "domain_audit" "${auditFile}"
+			steps+=("auditlog")
 		fi
 	fi
 	if [[ "$version" == "2" ]]; then
 		# This migration script upgrades the gravity.db file by
 		# renaming the regex table to regex_blacklist, and
 		# creating a new regex_whitelist table + corresponding linking table and views
-		echo -e "  ${INFO} Upgrading gravity database from version 2 to 3"
-		sqlite3 "${database}" < "${scriptPath}/2_to_3.sql"
+		steps+=("2_to_3")
 		version=3
 	fi
 	if [[ "$version" == "3" ]]; then
 		# This migration script unifies the formally separated domain
 		# lists into a single table with a UNIQUE domain constraint
-		echo -e "  ${INFO} Upgrading gravity database from version 3 to 4"
-		sqlite3 "${database}" < "${scriptPath}/3_to_4.sql"
+		steps+=("3_to_4")
 		version=4
 	fi
 	if [[ "$version" == "4" ]]; then
 		# This migration script upgrades the gravity and list views
 		# implementing necessary changes for per-client blocking
-		echo -e "  ${INFO} Upgrading gravity database from version 4 to 5"
-		sqlite3 "${database}" < "${scriptPath}/4_to_5.sql"
+		steps+=("4_to_5")
 		version=5
 	fi
 	if [[ "$version" == "5" ]]; then
 		# This migration script upgrades the adlist view
 		# to return an ID used in gravity.sh
-		echo -e "  ${INFO} Upgrading gravity database from version 5 to 6"
-		sqlite3 "${database}" < "${scriptPath}/5_to_6.sql"
+		steps+=("5_to_6")
 		version=6
 	fi
 	if [[ "$version" == "6" ]]; then
 		# This migration script adds a special group with ID 0
 		# which is automatically associated to all clients not
 		# having their own group assignments
-		echo -e "  ${INFO} Upgrading gravity database from version 6 to 7"
-		sqlite3 "${database}" < "${scriptPath}/6_to_7.sql"
+		steps+=("6_to_7")
 		version=7
 	fi
 	if [[ "$version" == "7" ]]; then
 		# This migration script recreated the group table
 		# to ensure uniqueness on the group name
 		# We also add date_added and date_modified columns
-		echo -e "  ${INFO} Upgrading gravity database from version 7 to 8"
-		sqlite3 "${database}" < "${scriptPath}/7_to_8.sql"
+		steps+=("7_to_8")
 		version=8
 	fi
 	if [[ "$version" == "8" ]]; then
 		# This migration fixes some issues that were introduced
 		# in the previous migration script.
-		echo -e "  ${INFO} Upgrading gravity database from version 8 to 9"
-		sqlite3 "${database}" < "${scriptPath}/8_to_9.sql"
+		steps+=("8_to_9")
 		version=9
 	fi
 	if [[ "$version" == "9" ]]; then
 		# This migration drops unused tables and creates triggers to remove
 		# obsolete groups assignments when the linked items are deleted
-		echo -e "  ${INFO} Upgrading gravity database from version 9 to 10"
-		sqlite3 "${database}" < "${scriptPath}/9_to_10.sql"
+		steps+=("9_to_10")
 		version=10
 	fi
 	if [[ "$version" == "10" ]]; then
@@ -100,20 +177,94 @@ upgrade_gravityDB(){
 		# defined in gravity.db.sql during gravity swapping. We add them here
 		# to keep the copying process generic (needs the same columns in both the
 		# source and the destination databases).
-		echo -e "  ${INFO} Upgrading gravity database from version 10 to 11"
-		sqlite3 "${database}" < "${scriptPath}/10_to_11.sql"
+		steps+=("10_to_11")
 		version=11
 	fi
 	if [[ "$version" == "11" ]]; then
 		# Rename group 0 from "Unassociated" to "Default"
-		echo -e "  ${INFO} Upgrading gravity database from version 11 to 12"
-		sqlite3 "${database}" < "${scriptPath}/11_to_12.sql"
+		steps+=("11_to_12")
 		version=12
 	fi
 	if [[ "$version" == "12" ]]; then
 		# Add column date_updated to alist table
-		echo -e "  ${INFO} Upgrading gravity database from version 12 to 13"
-		sqlite3 "${database}" < "${scriptPath}/12_to_13.sql"
+		steps+=("12_to_13")
 		version=13
 	fi
+	if [[ "$version" == "13" ]]; then
+		# Add tables holding the per-adlist and per-group statistics
+		# computed at the end of each gravity run
+		steps+=("13_to_14")
+		version=14
+	fi
+	if [[ "$version" == "14" ]]; then
+		# Add wildcard white- and blacklist types matched by domain suffix
+		# and move regex filters created by "pihole --wild" over to them
+		steps+=("14_to_15")
+		version=15
+	fi
+	if [[ "$version" == "15" ]]; then
+		# Add per-adlist refresh intervals, optionally adapted to how
+		# often the content of the list changes
+		steps+=("15_to_16")
+		version=16
+	fi
+	if [[ "$version" == "16" ]]; then
+		# Add the per-adlist history of gravity runs and its daily rollup
+		steps+=("16_to_17")
+		version=17
+	fi
+
+	run_gravityDB_upgrade "${database}" "${auditFile}" "${steps[@]}"
+}
+
+# Apply all pending migration steps through a single sqlite3 connection and in a single
+# transaction, instead of one connection and transaction per step. If any step fails, the
+# database is left unchanged. The time of each step is reported from timestamps taken by
+# SQLite in between the steps
+run_gravityDB_upgrade(){
+	local database="${1}" auditFile="${2}" step output status marker name time last now
+	shift 2
+
+	if [[ $# -eq 0 ]]; then
+		return 0
+	fi
+
+	now="CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+	echo -ne "  ${INFO} Upgrading gravity database..."
+	output=$( { {
+		printf ".timeout 30000\\nPRAGMA FOREIGN_KEYS=OFF;\\nBEGIN TRANSACTION;\\n"
+		printf "SELECT 'step','start',%s;\\n" "${now}"
+		for step in "$@"; do
+			if [[ "${step}" == "auditlog" ]]; then
+				# database_table_sql is defined in gravity.sh
+				database_table_sql "domain_audit" "${auditFile}"
+			else
+				# The steps' own transactions are replaced by the surrounding one
+				sed -e '/^\.timeout/d' -e '/^PRAGMA FOREIGN_KEYS/d' -e '/^BEGIN TRANSACTION;/d' -e '/^COMMIT;/d' "${scriptPath}/${step}.sql"
+			fi
+			printf "SELECT 'step','%s',%s;\\n" "${step}" "${now}"
+		done
+		printf "COMMIT;\\n"
+	} | sqlite3 -bail "${database}"; } 2>&1 )
+	status="$?"
+
+	if [[ "${status}" -ne 0 ]]; then
+		echo -e "${OVER}  ${CROSS} Unable to upgrade gravity database ${database}, it has been left unchanged\\n  $(grep -v "^step|" <<< "${output}")"
+		return 1
+	fi
+	echo -e "${OVER}  ${TICK} Upgraded gravity database"
+
+	while IFS='|' read -r marker name time; do
+		if [[ "${marker}" != "step" ]]; then
+			continue
+		fi
+		if [[ "${name}" == "auditlog" ]]; then
+			echo -e "     ${TICK} Migrated content of ${auditFile} ($((time - last)) ms)"
+			# database_backup_file is defined in gravity.sh
+			database_backup_file "${auditFile}"
+		elif [[ "${name}" != "start" ]]; then
+			echo -e "     ${TICK} Version ${name%_to_*} to ${name#*_to_} ($((time - last)) ms)"
+		fi
+		last="${time}"
+	done <<< "${output}"
 }
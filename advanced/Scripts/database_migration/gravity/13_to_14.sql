@@ -0,0 +1,32 @@
+.timeout 30000
+
+PRAGMA FOREIGN_KEYS=OFF;
+
+BEGIN TRANSACTION;
+
+CREATE TABLE adlist_stats
+(
+	adlist_id INTEGER PRIMARY KEY REFERENCES adlist (id),
+	domains INTEGER NOT NULL DEFAULT 0,
+	unique_domains INTEGER NOT NULL DEFAULT 0,
+	overlap INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE adlist_overlap
+(
+	adlist_id INTEGER NOT NULL REFERENCES adlist (id),
+	other_adlist_id INTEGER NOT NULL REFERENCES adlist (id),
+	domains INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (adlist_id, other_adlist_id)
+);
+
+CREATE TABLE group_stats
+(
+	group_id INTEGER PRIMARY KEY REFERENCES "group" (id),
+	gravity_minus_exact_whitelist INTEGER NOT NULL DEFAULT 0,
+	exact_whitelisted INTEGER NOT NULL DEFAULT 0
+);
+
+UPDATE info SET value = 14 WHERE property = 'version';
+
+COMMIT;
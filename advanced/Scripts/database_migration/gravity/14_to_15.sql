@@ -0,0 +1,64 @@
+.timeout 30000
+
+PRAGMA FOREIGN_KEYS=OFF;
+
+BEGIN TRANSACTION;
+
+CREATE VIEW vw_wildcard_whitelist AS SELECT domain, domainlist.id AS id, domainlist_by_group.group_id AS group_id
+    FROM domainlist
+    LEFT JOIN domainlist_by_group ON domainlist_by_group.domainlist_id = domainlist.id
+    LEFT JOIN "group" ON "group".id = domainlist_by_group.group_id
+    WHERE domainlist.enabled = 1 AND (domainlist_by_group.group_id IS NULL OR "group".enabled = 1)
+    AND domainlist.type = 4
+    ORDER BY domainlist.id;
+
+CREATE VIEW vw_wildcard_blacklist AS SELECT domain, domainlist.id AS id, domainlist_by_group.group_id AS group_id
+    FROM domainlist
+    LEFT JOIN domainlist_by_group ON domainlist_by_group.domainlist_id = domainlist.id
+    LEFT JOIN "group" ON "group".id = domainlist_by_group.group_id
+    WHERE domainlist.enabled = 1 AND (domainlist_by_group.group_id IS NULL OR "group".enabled = 1)
+    AND domainlist.type = 5
+    ORDER BY domainlist.id;
+
+-- FTL reads the regex views only, so wildcards are handed to it as the regex filter
+-- they replace: "example.com" becomes "(^|\.)example\.com$"
+-- FTL therefore still evaluates wildcards with its regex engine. Only the scripts
+-- (pihole -q, the block page, gravity) use the suffix lookup on vw_wildcard_*
+DROP VIEW vw_regex_whitelist;
+CREATE VIEW vw_regex_whitelist AS SELECT CASE domainlist.type WHEN 4 THEN '(^|\.)' || replace(domain, '.', '\.') || '$' ELSE domain END AS domain,
+    domainlist.id AS id, domainlist_by_group.group_id AS group_id
+    FROM domainlist
+    LEFT JOIN domainlist_by_group ON domainlist_by_group.domainlist_id = domainlist.id
+    LEFT JOIN "group" ON "group".id = domainlist_by_group.group_id
+    WHERE domainlist.enabled = 1 AND (domainlist_by_group.group_id IS NULL OR "group".enabled = 1)
+    AND domainlist.type IN (2, 4)
+    ORDER BY domainlist.id;
+
+DROP VIEW vw_regex_blacklist;
+CREATE VIEW vw_regex_blacklist AS SELECT CASE domainlist.type WHEN 5 THEN '(^|\.)' || replace(domain, '.', '\.') || '$' ELSE domain END AS domain,
+    domainlist.id AS id, domainlist_by_group.group_id AS group_id
+    FROM domainlist
+    LEFT JOIN domainlist_by_group ON domainlist_by_group.domainlist_id = domainlist.id
+    LEFT JOIN "group" ON "group".id = domainlist_by_group.group_id
+    WHERE domainlist.enabled = 1 AND (domainlist_by_group.group_id IS NULL OR "group".enabled = 1)
+    AND domainlist.type IN (3, 5)
+    ORDER BY domainlist.id;
+
+-- Move regex filters of the exact form "(^|\.)example\.com$" (as created by "pihole --wild"
+-- and "pihole --white-wild") to the new wildcard types. The IDs are kept, so are the
+-- group assignments of the entries
+UPDATE domainlist SET type = type + 2,
+    domain = replace(substr(domain, 7, length(domain) - 7), '\.', '.')
+    WHERE type IN (2, 3)
+    AND substr(domain, 1, 6) = '(^|\.)' AND substr(domain, -1, 1) = '$'
+    AND length(domain) > 7
+    AND replace(substr(domain, 7, length(domain) - 7), '\.', '') NOT GLOB '*[^a-z0-9_-]*'
+    AND substr(domain, 7, 2) != '\.' AND substr(domain, -3, 2) != '\.'
+    AND instr(substr(domain, 7, length(domain) - 7), '\.\.') = 0
+    AND NOT EXISTS (SELECT 1 FROM domainlist AS existing
+                    WHERE existing.type = domainlist.type + 2
+                    AND existing.domain = replace(substr(domainlist.domain, 7, length(domainlist.domain) - 7), '\.', '.'));
+
+UPDATE info SET value = 15 WHERE property = 'version';
+
+COMMIT;
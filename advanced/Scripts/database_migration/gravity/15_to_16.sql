@@ -0,0 +1,13 @@
+.timeout 30000
+
+PRAGMA FOREIGN_KEYS=OFF;
+
+BEGIN TRANSACTION;
+
+ALTER TABLE adlist ADD COLUMN refresh_interval INTEGER;
+ALTER TABLE adlist ADD COLUMN adaptive BOOLEAN NOT NULL DEFAULT 0;
+ALTER TABLE adlist ADD COLUMN date_checked INTEGER;
+
+UPDATE info SET value = 16 WHERE property = 'version';
+
+COMMIT;
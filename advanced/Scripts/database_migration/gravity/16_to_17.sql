@@ -0,0 +1,40 @@
+.timeout 30000
+
+PRAGMA FOREIGN_KEYS=OFF;
+
+BEGIN TRANSACTION;
+
+CREATE TABLE adlist_history
+(
+	adlist_id INTEGER NOT NULL,
+	timestamp INTEGER NOT NULL,
+	domains INTEGER NOT NULL DEFAULT 0,
+	invalid INTEGER NOT NULL DEFAULT 0,
+	unique_domains INTEGER NOT NULL DEFAULT 0,
+	bytes INTEGER NOT NULL DEFAULT 0,
+	duration INTEGER NOT NULL DEFAULT 0,
+	http_code INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (adlist_id, timestamp)
+);
+
+CREATE TABLE adlist_history_daily
+(
+	adlist_id INTEGER NOT NULL,
+	day INTEGER NOT NULL,
+	runs INTEGER NOT NULL DEFAULT 0,
+	failures INTEGER NOT NULL DEFAULT 0,
+	domains INTEGER NOT NULL DEFAULT 0,
+	domains_min INTEGER NOT NULL DEFAULT 0,
+	domains_max INTEGER NOT NULL DEFAULT 0,
+	invalid INTEGER NOT NULL DEFAULT 0,
+	unique_domains INTEGER NOT NULL DEFAULT 0,
+	bytes INTEGER NOT NULL DEFAULT 0,
+	duration INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (adlist_id, day)
+);
+
+CREATE INDEX idx_adlist_history_timestamp ON adlist_history (timestamp);
+
+UPDATE info SET value = 17 WHERE property = 'version';
+
+COMMIT;
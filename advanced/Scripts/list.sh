@@ -12,11 +12,12 @@
 basename=pihole
 piholeDir=/etc/"${basename}"
 gravityDBfile="${piholeDir}/gravity.db"
+snapshotFile="${piholeDir}/gravity.snapshot"
 
 reload=false
+snapshotStale=false
 addmode=true
 verbose=true
-wildcard=false
 web=false
 
 domList=()
@@ -29,12 +30,18 @@ domaincount=0
 colfile="/opt/pihole/COL_TABLE"
 source ${colfile}
 
+# Source gravity database helpers for lock_gravityDB()
+# shellcheck disable=SC1091
+source "/etc/.pihole/advanced/Scripts/database_migration/gravity-db.sh"
+
 # IDs are hard-wired to domain interpretation in the gravity database scheme
 # Clients (including FTL) will read them through the corresponding views
 readonly whitelist="0"
 readonly blacklist="1"
 readonly regex_whitelist="2"
 readonly regex_blacklist="3"
+readonly wildcard_whitelist="4"
+readonly wildcard_blacklist="5"
 
 GetListnameFromTypeId() {
     if [[ "$1" == "${whitelist}" ]]; then
@@ -45,6 +52,10 @@ GetListnameFromTypeId() {
         echo "regex whitelist"
     elif  [[ "$1" == "${regex_blacklist}" ]]; then
         echo "regex blacklist"
+    elif  [[ "$1" == "${wildcard_whitelist}" ]]; then
+        echo "wildcard whitelist"
+    elif  [[ "$1" == "${wildcard_blacklist}" ]]; then
+        echo "wildcard blacklist"
     fi
 }
 
@@ -53,14 +64,14 @@ GetListParamFromTypeId() {
         echo "w"
     elif  [[ "${typeId}" == "${blacklist}" ]]; then
         echo "b"
-    elif  [[ "${typeId}" == "${regex_whitelist}" && "${wildcard}" == true ]]; then
-        echo "-white-wild"
     elif  [[ "${typeId}" == "${regex_whitelist}" ]]; then
         echo "-white-regex"
-    elif  [[ "${typeId}" == "${regex_blacklist}" && "${wildcard}" == true ]]; then
-        echo "-wild"
     elif  [[ "${typeId}" == "${regex_blacklist}" ]]; then
         echo "-regex"
+    elif  [[ "${typeId}" == "${wildcard_whitelist}" ]]; then
+        echo "-white-wild"
+    elif  [[ "${typeId}" == "${wildcard_blacklist}" ]]; then
+        echo "-wild"
     fi
 }
 
@@ -91,7 +102,7 @@ ValidateDomain() {
 
     # Check validity of domain (don't check for regex entries)
     if [[ "${#domain}" -le 253 ]]; then
-        if [[ ( "${typeId}" == "${regex_blacklist}" || "${typeId}" == "${regex_whitelist}" ) && "${wildcard}" == false ]]; then
+        if [[ "${typeId}" == "${regex_blacklist}" || "${typeId}" == "${regex_whitelist}" ]]; then
             validDomain="${domain}"
         else
             validDomain=$(grep -P "^((-|_)*[a-z\\d]((-|_)*[a-z\\d])*(-|_)*)(\\.(-|_)*([a-z\\d]((-|_)*[a-z\\d])*))*$" <<< "${domain}") # Valid chars check
@@ -110,11 +121,6 @@ ValidateDomain() {
 
 ProcessDomainList() {
     for dom in "${domList[@]}"; do
-        # Format domain into regex filter if requested
-        if [[ "${wildcard}" == true ]]; then
-            dom="(^|\\.)${dom//\./\\.}$"
-        fi
-
         # Logic: If addmode then add to desired list and remove from the other;
         # if delmode then remove from desired list but do not add to the other
         if ${addmode}; then
@@ -130,18 +136,21 @@ AddDomain() {
     domain="$1"
 
     # Is the domain in the list we want to add it to?
-    num="$(sqlite3 "${gravityDBfile}" "SELECT COUNT(*) FROM domainlist WHERE domain = '${domain}';")"
+    # Exact, regex and wildcard entries are independent of each other: the white- and blacklist
+    # of each kind share the same integer part of type / 2, e.g. 4 and 5 for wildcards
+    num="$(sqlite3 "${gravityDBfile}" "SELECT COUNT(*) FROM domainlist WHERE domain = '${domain}' AND type / 2 = ${typeId} / 2;")"
     requestedListname="$(GetListnameFromTypeId "${typeId}")"
 
     if [[ "${num}" -ne 0 ]]; then
-      existingTypeId="$(sqlite3 "${gravityDBfile}" "SELECT type FROM domainlist WHERE domain = '${domain}';")"
+      existingTypeId="$(sqlite3 "${gravityDBfile}" "SELECT type FROM domainlist WHERE domain = '${domain}' AND type / 2 = ${typeId} / 2;")"
       if [[ "${existingTypeId}" == "${typeId}" ]]; then
         if [[ "${verbose}" == true ]]; then
             echo -e "  ${INFO} ${1} already exists in ${requestedListname}, no need to add!"
         fi
       else
         existingListname="$(GetListnameFromTypeId "${existingTypeId}")"
-        sqlite3 "${gravityDBfile}" "UPDATE domainlist SET type = ${typeId} WHERE domain='${domain}';"
+        lock_gravityDB sqlite3 "${gravityDBfile}" "UPDATE domainlist SET type = ${typeId} WHERE domain='${domain}' AND type = ${existingTypeId};"
+        MarkSnapshotStale "${existingTypeId}"
         if [[ "${verbose}" == true ]]; then
             echo -e "  ${INFO} ${1} already exists in ${existingListname}, it has been moved to ${requestedListname}!"
         fi
@@ -157,11 +166,12 @@ AddDomain() {
     # Insert only the domain here. The enabled and date_added fields will be filled
     # with their default values (enabled = true, date_added = current timestamp)
     if [[ -z "${comment}" ]]; then
-        sqlite3 "${gravityDBfile}" "INSERT INTO domainlist (domain,type) VALUES ('${domain}',${typeId});"
+        lock_gravityDB sqlite3 "${gravityDBfile}" "INSERT INTO domainlist (domain,type) VALUES ('${domain}',${typeId});"
     else
         # also add comment when variable has been set through the "--comment" option
-        sqlite3 "${gravityDBfile}" "INSERT INTO domainlist (domain,type,comment) VALUES ('${domain}',${typeId},'${comment}');"
+        lock_gravityDB sqlite3 "${gravityDBfile}" "INSERT INTO domainlist (domain,type,comment) VALUES ('${domain}',${typeId},'${comment}');"
     fi
+    MarkSnapshotStale "${typeId}"
 }
 
 RemoveDomain() {
@@ -186,7 +196,8 @@ RemoveDomain() {
     fi
     reload=true
     # Remove it from the current list
-    sqlite3 "${gravityDBfile}" "DELETE FROM domainlist WHERE domain = '${domain}' AND type = ${typeId};"
+    lock_gravityDB sqlite3 "${gravityDBfile}" "DELETE FROM domainlist WHERE domain = '${domain}' AND type = ${typeId};"
+    MarkSnapshotStale "${typeId}"
 }
 
 Displaylist() {
@@ -234,14 +245,38 @@ NukeList() {
     count=$(sqlite3 "${gravityDBfile}" "SELECT COUNT(1) FROM domainlist WHERE type = ${typeId};")
     listname="$(GetListnameFromTypeId "${typeId}")"    
     if [ "$count" -gt 0 ];then
-        sqlite3 "${gravityDBfile}" "DELETE FROM domainlist WHERE type = ${typeId};"
+        lock_gravityDB sqlite3 "${gravityDBfile}" "DELETE FROM domainlist WHERE type = ${typeId};"
         echo "  ${TICK} Removed ${count} domain(s) from the ${listname}"
+        MarkSnapshotStale "${typeId}"
+        RebuildSnapshot
     else
         echo "  ${INFO} ${listname} already empty. Nothing to do!"
     fi    
     exit 0;
 }
 
+MarkSnapshotStale() {
+    # The snapshot contains the exact white- and blacklist, so it is stale after they change
+    # Regex and wildcard filters are not part of it
+    if [[ "${1}" == "${whitelist}" || "${1}" == "${blacklist}" || "${typeId}" == "${whitelist}" || "${typeId}" == "${blacklist}" ]]; then
+        snapshotStale=true
+    fi
+}
+
+RebuildSnapshot() {
+    # Only rebuild the snapshot if it is in use
+    if [[ "${snapshotStale}" != true ]] || [[ ! -e "${snapshotFile}" ]]; then
+        return
+    fi
+
+    # Keep the Bloom filter if the current snapshot has one
+    if [[ -e "${snapshotFile}.bloom" ]]; then
+        /opt/pihole/piholeSnapshot.sh build --bloom > /dev/null
+    else
+        /opt/pihole/piholeSnapshot.sh build > /dev/null
+    fi
+}
+
 GetComment() {
     comment="$1"
     if [[ "${comment}" =~ [^a-zA-Z0-9_\#:/\.,\ -] ]]; then
@@ -255,8 +290,8 @@ while (( "$#" )); do
         "-w" | "whitelist"   ) typeId=0;;
         "-b" | "blacklist"   ) typeId=1;;
         "--white-regex" | "white-regex" ) typeId=2;;
-        "--white-wild" | "white-wild" ) typeId=2; wildcard=true;;
-        "--wild" | "wildcard" ) typeId=3; wildcard=true;;
+        "--white-wild" | "white-wild" ) typeId=4;;
+        "--wild" | "wildcard" ) typeId=5;;
         "--regex" | "regex"   ) typeId=3;;
         "-nr"| "--noreload"  ) reload=false;;
         "-d" | "--delmode"   ) addmode=false;;
@@ -284,6 +319,8 @@ if $web; then
 echo "DONE"
 fi
 
+RebuildSnapshot
+
 if [[ "${reload}" != false ]]; then
     pihole restartdns reload-lists
 fi
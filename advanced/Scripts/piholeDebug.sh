@@ -43,6 +43,15 @@ fi
 
 OBFUSCATED_PLACEHOLDER="<DOMAIN OBFUSCATED>"
 
+# Independent diagnostics are run in the background, at most this many at the same time
+DIAGNOSTIC_JOBS=8
+DIAGNOSTIC_NAMES=()
+DIAGNOSTIC_TIMEOUTS=()
+DIAGNOSTIC_TIMINGS=()
+DIAGNOSTIC_PIDS=()
+DIAGNOSTIC_WATCHDOGS=()
+DIAGNOSTIC_COLLECTED=0
+
 # FAQ URLs for use in showing the debug log
 FAQ_UPDATE_PI_HOLE="${COL_CYAN}https://discourse.pi-hole.net/t/how-do-i-update-pi-hole/249${COL_NC}"
 FAQ_CHECKOUT_COMMAND="${COL_CYAN}https://discourse.pi-hole.net/t/the-pihole-command-with-examples/738#checkout${COL_NC}"
@@ -222,11 +231,98 @@ make_temporary_log() {
     # This lets us write to the log without having a temporary file on the drive, which
     # is meant to be a security measure so there is not a lingering file on the drive during the debug process
     rm "$TEMPLOG"
+    # Diagnostics running in the background store their output here until it is added to the log
+    DIAGNOSTIC_DIRECTORY=$(mktemp -d /tmp/pihole_diagnostics.XXXXXX)
+    trap 'rm -rf "${DIAGNOSTIC_DIRECTORY}"' EXIT
 }
 
 log_write() {
-    # echo arguments to both the log and the console
-    echo -e "${@}" | tee -a /proc/$$/fd/3
+    # Diagnostics running in the background only write to their own output, which is
+    # added to the log in the original order once all preceding diagnostics have finished
+    if [[ -n "${DIAGNOSTIC_JOB}" ]]; then
+        echo -e "${@}"
+    else
+        # echo arguments to both the log and the console
+        echo -e "${@}" | tee -a /proc/$$/fd/3
+    fi
+}
+
+run_diagnostic() {
+    # Run a diagnostic in the background
+    # The first argument is the number of seconds after which the diagnostic is stopped,
+    # the remaining arguments are the function (and its arguments) to run
+    local timeout="${1}"
+    shift
+    local index="${#DIAGNOSTIC_NAMES[@]}"
+
+    # If the maximum number of diagnostics is running already, wait for the oldest one
+    if (( index - DIAGNOSTIC_COLLECTED >= DIAGNOSTIC_JOBS )); then
+        collect_diagnostic
+    fi
+
+    DIAGNOSTIC_NAMES+=("$*")
+    DIAGNOSTIC_TIMEOUTS+=("${timeout}")
+
+    # Job control gives each diagnostic its own process group, so a diagnostic running
+    # into its timeout can be stopped together with all the commands it has started
+    set -m
+    (
+        DIAGNOSTIC_JOB=true
+        local start
+        start=$(date +%s%N)
+        "$@"
+        echo "$(( ($(date +%s%N) - start) / 1000000 ))" > "${DIAGNOSTIC_DIRECTORY}/${index}.time"
+    ) > "${DIAGNOSTIC_DIRECTORY}/${index}.out" 2>&1 < /dev/null &
+    DIAGNOSTIC_PIDS+=("$!")
+    set +m
+
+    # The watchdog stops the diagnostic once the timeout has passed
+    (
+        trap 'kill "${sleeper}" 2> /dev/null; exit' TERM
+        sleep "${timeout}" &
+        sleeper=$!
+        wait "${sleeper}"
+        kill -TERM -- -"${DIAGNOSTIC_PIDS[${index}]}"
+    ) > /dev/null 2>&1 &
+    DIAGNOSTIC_WATCHDOGS+=("$!")
+}
+
+collect_diagnostic() {
+    # Wait for the oldest diagnostic not yet collected and add its output to the log
+    local index="${DIAGNOSTIC_COLLECTED}"
+
+    wait "${DIAGNOSTIC_PIDS[${index}]}" 2> /dev/null
+    kill "${DIAGNOSTIC_WATCHDOGS[${index}]}" 2> /dev/null
+    wait "${DIAGNOSTIC_WATCHDOGS[${index}]}" 2> /dev/null
+
+    tee -a /proc/$$/fd/3 < "${DIAGNOSTIC_DIRECTORY}/${index}.out"
+    if [[ -f "${DIAGNOSTIC_DIRECTORY}/${index}.time" ]]; then
+        DIAGNOSTIC_TIMINGS+=("$(< "${DIAGNOSTIC_DIRECTORY}/${index}.time")")
+    else
+        # Without a timing the diagnostic did not finish in time
+        DIAGNOSTIC_TIMINGS+=("")
+        log_write "${CROSS} ${COL_RED}${DIAGNOSTIC_NAMES[${index}]} did not finish within ${DIAGNOSTIC_TIMEOUTS[${index}]} seconds${COL_NC}"
+    fi
+    DIAGNOSTIC_COLLECTED=$((index + 1))
+}
+
+collect_diagnostics() {
+    # Wait for all remaining diagnostics
+    while (( DIAGNOSTIC_COLLECTED < ${#DIAGNOSTIC_NAMES[@]} )); do
+        collect_diagnostic
+    done
+}
+
+show_diagnostic_timings() {
+    echo_current_diagnostic "Time taken by each diagnostic"
+    local i
+    for i in "${!DIAGNOSTIC_NAMES[@]}"; do
+        if [[ -n "${DIAGNOSTIC_TIMINGS[${i}]}" ]]; then
+            log_write "   $(printf "%7s ms" "${DIAGNOSTIC_TIMINGS[${i}]}")  ${DIAGNOSTIC_NAMES[${i}]}"
+        else
+            log_write "   ${COL_RED}$(printf "%7s" "timeout")${COL_NC} after ${DIAGNOSTIC_TIMEOUTS[${i}]} s  ${DIAGNOSTIC_NAMES[${i}]}"
+        fi
+    done
 }
 
 copy_to_debug_log() {
@@ -415,6 +511,14 @@ os_check() {
     detected_os=$(grep "\bID\b" /etc/os-release | cut -d '=' -f2 | tr -d '"')
     detected_version=$(grep VERSION_ID /etc/os-release | cut -d '=' -f2 | tr -d '"')
 
+    # The list of supported systems has to be retrieved from the network, which is skipped in quick mode
+    if [[ -n "${QUICK}" ]]; then
+        log_write "${INFO} Distro:  ${detected_os^}"
+        log_write "${INFO} Version: ${detected_version}"
+        log_write "${INFO} Support for this system has not been checked (quick mode)"
+        return 0
+    fi
+
     cmdResult="$(dig +short -t txt ${remote_os_domain} @ns1.pi-hole.net 2>&1; echo $?)"
     #Get the return code of the previous command (last line)
     digReturnCode="${cmdResult##*$'\n'}"
@@ -804,8 +908,11 @@ check_networking() {
     echo_current_diagnostic "Networking"
     detect_ip_addresses "4"
     detect_ip_addresses "6"
-    ping_gateway "4"
-    ping_gateway "6"
+    # Pinging the gateway is skipped in quick mode
+    if [[ -z "${QUICK}" ]]; then
+        ping_gateway "4"
+        ping_gateway "6"
+    fi
     check_required_ports
 }
 
@@ -915,6 +1022,12 @@ dig_at() {
         log_write "${CROSS} ${COL_RED}Failed to resolve${COL_NC} ${random_url} via ${COL_RED}Pi-hole${COL_NC} (${pihole_address})"
     fi
 
+    # The public DNS server is not asked in quick mode, the checks above show whether Pi-hole resolves
+    if [[ -n "${QUICK}" ]]; then
+        log_write "${INFO} Name resolution via a remote, public DNS server has not been checked (quick mode)"
+        return 0
+    fi
+
     # Finally, we need to make sure legitimate queries can out to the Internet using an external, public DNS server
     # We are using the static remote_url here instead of a random one because we know it works with IPv4 and IPv6
     if remote_dig=$(dig +tries=1 +time=2 -"${protocol}" "${remote_url}" @${remote_address} +short "${record_type}" | head -n1); then
@@ -1043,17 +1156,6 @@ parse_file() {
     IFS="$OLD_IFS"
 }
 
-check_name_resolution() {
-    # Check name resoltion from localhost, Pi-hole's IP, and Google's name severs
-    # using the function we created earlier
-    dig_at 4 "${IPV4_ADDRESS%/*}"
-    # If IPv6 enabled,
-    if [[ "${IPV6_ADDRESS}" ]]; then
-        # check resolution
-        dig_at 6 "${IPV6_ADDRESS%/*}"
-    fi
-}
-
 # This function can check a directory exists
 # Pi-hole has files in several places, so we will reuse this function
 dir_check() {
@@ -1283,7 +1385,6 @@ analyze_gravity_list() {
 
 analyze_pihole_log() {
     echo_current_diagnostic "Pi-hole log"
-    local head_line
     # Put the current Internal Field Separator into another variable so it can be restored later
     OLD_IFS="$IFS"
     # Get the lines that are in the file(s) and store them in an array for parsing later
@@ -1292,43 +1393,37 @@ analyze_pihole_log() {
     pihole_log_permissions=$(ls -ld "${PIHOLE_LOG}")
     log_write "${COL_GREEN}${pihole_log_permissions}${COL_NC}"
     local pihole_log_head=()
-    mapfile -t pihole_log_head < <(head -n 20 ${PIHOLE_LOG})
+    # Some users may not want to have the domains they visit sent to us
+    # If a flag was passed to obfuscate domains, a single awk process replaces the domain name
+    # (the 6th field in the log) of queries, forwards and replies with the placeholder value
+    mapfile -t pihole_log_head < <(head -n 20 "${PIHOLE_LOG}" | awk -v obfuscate="${OBFUSCATE}" -v placeholder="${OBFUSCATED_PLACEHOLDER}" '
+        obfuscate != "" && /: (query|forwarded|reply)/ { sub($6, placeholder) }
+        { print }')
     log_write "   ${COL_CYAN}-----head of $(basename ${PIHOLE_LOG})------${COL_NC}"
-    local error_to_check_for
-    local line_to_obfuscate
-    local obfuscated_line
+    local head_line
     for head_line in "${pihole_log_head[@]}"; do
         # A common error in the pihole.log is when there is a non-hosts formatted file
         # that the DNS server is attempting to read.  Since it's not formatted
         # correctly, there will be an entry for "bad address at line n"
         # So we can check for that here and highlight it in red so the user can see it easily
-        error_to_check_for=$(echo "${head_line}" | grep 'bad address at')
-        # Some users may not want to have the domains they visit sent to us
-        # To that end, we check for lines in the log that would contain a domain name
-        line_to_obfuscate=$(echo "${head_line}" | grep ': query\|: forwarded\|: reply')
-        # If the variable contains a value, it found an error in the log
-        if [[ -n ${error_to_check_for} ]]; then
-            # So we can print it in red to make it visible to the user
+        if [[ "${head_line}" == *"bad address at"* ]]; then
             log_write "   ${CROSS} ${COL_RED}${head_line}${COL_NC} (${FAQ_BAD_ADDRESS})"
         else
-            # If the variable does not a value (the current default behavior), so do not obfuscate anything
-            if [[ -z ${OBFUSCATE} ]]; then
-                log_write "   ${head_line}"
-            # Othwerise, a flag was passed to this command to obfuscate domains in the log
-            else
-                # So first check if there are domains in the log that should be obfuscated
-                if [[ -n ${line_to_obfuscate} ]]; then
-                    # If there are, we need to use awk to replace only the domain name (the 6th field in the log)
-                    # so we substitute the domain for the placeholder value
-                    obfuscated_line=$(echo "${line_to_obfuscate}" | awk -v placeholder="${OBFUSCATED_PLACEHOLDER}" '{sub($6,placeholder); print $0}')
-                    log_write "   ${obfuscated_line}"
-                else
-                    log_write "   ${head_line}"
-                fi
-            fi
+            log_write "   ${head_line}"
         fi
     done
     log_write ""
+
+    # Summarize the queries of the last day from the log index, if there is one
+    # The index is only read: updating it could take minutes and write to /var/log during a diagnostic run
+    local pihole_log_summary=()
+    local summary_line
+    mapfile -t pihole_log_summary < <("${PIHOLE_SCRIPTS_DIRECTORY}"/piholeLogAnalyzer.sh summary --from "24 hours ago" --no-update ${OBFUSCATE:+--obfuscate} 2>&1)
+    log_write "   ${COL_CYAN}-----summary of the last 24 hours (as of the last index update)------${COL_NC}"
+    for summary_line in "${pihole_log_summary[@]}"; do
+        log_write "   ${summary_line}"
+    done
+    log_write ""
     # Set the IFS back to what it was
     IFS="$OLD_IFS"
 }
@@ -1422,27 +1517,39 @@ initialize_debug
 # setupVars.conf needs to be sourced before the networking so the values are
 # available to the other functions
 source_setup_variables
-check_component_versions
-check_critical_program_versions
-diagnose_operating_system
-check_selinux
-check_firewalld
-processor_check
-check_networking
-check_name_resolution
-check_dhcp_servers
-process_status
-ftl_full_status
-parse_setup_vars
-check_x_headers
-analyze_gravity_list
-show_groups
-show_domainlist
-show_clients
-show_adlists
-show_content_of_pihole_files
-show_messages
-parse_locale
-analyze_pihole_log
+# The diagnostics do not depend on each other, so they are run in the background
+# Their output is added to the log in the order they are started here
+run_diagnostic 60 check_component_versions
+run_diagnostic 30 check_critical_program_versions
+run_diagnostic 30 diagnose_operating_system
+run_diagnostic 10 check_selinux
+run_diagnostic 30 check_firewalld
+run_diagnostic 10 processor_check
+run_diagnostic 30 check_networking
+# Check name resoltion from localhost, Pi-hole's IP, and Google's name severs
+run_diagnostic 20 dig_at 4 "${IPV4_ADDRESS%/*}"
+# If IPv6 enabled, check resolution
+if [[ "${IPV6_ADDRESS}" ]]; then
+    run_diagnostic 20 dig_at 6 "${IPV6_ADDRESS%/*}"
+fi
+# DHCP discovery depends on the network and is skipped in quick mode
+if [[ -z "${QUICK}" ]]; then
+    run_diagnostic 20 check_dhcp_servers
+fi
+run_diagnostic 30 process_status
+run_diagnostic 30 ftl_full_status
+run_diagnostic 10 parse_setup_vars
+run_diagnostic 30 check_x_headers
+run_diagnostic 60 analyze_gravity_list
+run_diagnostic 30 show_groups
+run_diagnostic 30 show_domainlist
+run_diagnostic 30 show_clients
+run_diagnostic 30 show_adlists
+run_diagnostic 60 show_content_of_pihole_files
+run_diagnostic 30 show_messages
+run_diagnostic 10 parse_locale
+run_diagnostic 300 analyze_pihole_log
+collect_diagnostics
+show_diagnostic_timings
 copy_to_debug_log
 upload_to_tricorder
@@ -0,0 +1,258 @@
+#!/usr/bin/env bash
+# shellcheck disable=SC1090
+# Pi-hole: A black hole for Internet advertisements
+# (c) 2020 Pi-hole, LLC (https://pi-hole.net)
+# Network-wide ad blocking via your own hardware.
+#
+# Report trends and anomalies of the adlists from the history of gravity runs
+#
+# This file is copyright under the latest version of the EUPL.
+# Please see LICENSE file for your rights under this license.
+
+# Every gravity run appends one row per downloaded adlist to adlist_history: the domains received,
+# the invalid lines among them, the domains found in no other list, the bytes downloaded, the
+# duration of the download (ms) and the HTTP status code (200 or 404 for local files).
+# Rows older than ${GRAVITY_HISTORY_DAYS} days are rolled up into one row per adlist and day in
+# adlist_history_daily (averages per run, plus the number of runs and failed downloads), which
+# are kept for ${GRAVITY_HISTORY_RETENTION} days. The reports only read these two tables.
+
+export LC_ALL=C
+
+piholeDir="/etc/pihole"
+gravityDBfile="${piholeDir}/gravity.db"
+
+# Defaults, can be set in setupVars.conf
+GRAVITY_HISTORY_DAYS=14
+GRAVITY_HISTORY_RETENTION=365
+
+# An adlist is reported as anomalous if its latest run
+# - received less than ${shrinkPercent}% or more than ${growthPercent}% of its average number of domains,
+# - had more than ${invalidPercent}% invalid lines,
+# - took more than ${slowFactor} times its average duration (and more than ${slowMinimum} ms), or
+# - failed to download
+shrinkPercent=50
+growthPercent=200
+invalidPercent=10
+slowFactor=3
+slowMinimum=1000
+
+colfile="/opt/pihole/COL_TABLE"
+if [[ -f "${colfile}" ]]; then
+    source "${colfile}"
+fi
+# shellcheck disable=SC1091
+source "/etc/.pihole/advanced/Scripts/database_migration/gravity-db.sh"
+
+helpFunc() {
+    echo "Usage: pihole history <command> [options]
+Example: 'pihole history anomalies --days 7'
+Report trends and anomalies of the adlists from the history of gravity runs
+
+Commands:
+  trends              Show size, change, unique domains, failures and download time of every adlist
+  anomalies           Show adlists which shrank, grew, failed, turned invalid or slow in their latest run
+                        Exit code 1 if any anomaly was found
+  show <id>           Show the recorded runs of a single adlist
+  rollup              Roll up old runs into daily rows and remove expired history
+                        Runs after every 'pihole -g'
+  --days <number>     Compare against the last <number> days (default: 30)
+  -h, --help          Show this help dialog
+
+Runs are kept for GRAVITY_HISTORY_DAYS days (default: 14), daily rows for
+GRAVITY_HISTORY_RETENTION days (default: 365), both set in setupVars.conf"
+    exit 0
+}
+
+# Roll up the runs older than ${GRAVITY_HISTORY_DAYS} days into daily rows
+# The cutoff is aligned to the start of a day (UTC), so every day is rolled up exactly once
+rollupFunc() {
+    local today rawCutoff dailyCutoff output status
+
+    today=$(( $(date +%s) / 86400 * 86400 ))
+    rawCutoff=$(( today - GRAVITY_HISTORY_DAYS * 86400 ))
+    dailyCutoff=$(( today - GRAVITY_HISTORY_RETENTION * 86400 ))
+
+    output=$( { printf ".timeout 30000
+BEGIN TRANSACTION;
+INSERT OR REPLACE INTO adlist_history_daily (adlist_id,day,runs,failures,domains,domains_min,domains_max,invalid,unique_domains,bytes,duration)
+  SELECT adlist_id, timestamp / 86400 * 86400, COUNT(*), SUM(http_code NOT IN (200,304)), CAST(ROUND(AVG(domains)) AS INT), MIN(domains), MAX(domains),
+         CAST(ROUND(AVG(invalid)) AS INT), CAST(ROUND(AVG(unique_domains)) AS INT), CAST(ROUND(AVG(bytes)) AS INT), CAST(ROUND(AVG(duration)) AS INT)
+  FROM adlist_history WHERE timestamp < %d GROUP BY adlist_id, timestamp / 86400;
+DELETE FROM adlist_history WHERE timestamp < %d;
+DELETE FROM adlist_history_daily WHERE day < %d;
+DELETE FROM adlist_history WHERE adlist_id NOT IN (SELECT id FROM adlist);
+DELETE FROM adlist_history_daily WHERE adlist_id NOT IN (SELECT id FROM adlist);
+COMMIT;\\n" "${rawCutoff}" "${rawCutoff}" "${dailyCutoff}" | lock_gravityDB sqlite3 -bail "${gravityDBfile}"; } 2>&1 )
+    status="$?"
+
+    if [[ "${status}" -ne 0 ]]; then
+        echo -e "  ${CROSS} Unable to roll up the adlist history in ${gravityDBfile}\\n  ${output}" >&2
+        return 1
+    fi
+}
+
+# Print one line per enabled adlist with a recorded run, fields separated by tabs:
+# id, address, time, domains, invalid, unique domains, duration and HTTP code of the latest run,
+# number of domains at the start of the period, average domains and duration of the period before
+# the latest run, number of runs and failures in the period, and the failures since the last success
+# Runs and daily rows are combined, weighted by their number of runs
+summaryQuery() {
+    local since=$(( $(date +%s) - ${1} * 86400 ))
+
+    sqlite3 -separator $'\t' "${gravityDBfile}" "CREATE TEMP VIEW points AS
+        SELECT adlist_id, timestamp AS time, 1 AS runs, (http_code NOT IN (200,304)) AS failures, domains, invalid, unique_domains, duration FROM adlist_history
+        UNION ALL SELECT adlist_id, day, runs, failures, domains, invalid, unique_domains, duration FROM adlist_history_daily;
+      SELECT l.id, l.address, l.latest, p.domains, p.invalid, p.unique_domains, p.duration,
+        IFNULL((SELECT http_code FROM adlist_history WHERE adlist_id = l.id ORDER BY timestamp DESC LIMIT 1), ''),
+        (SELECT domains FROM points WHERE adlist_id = l.id AND time >= ${since} ORDER BY time LIMIT 1),
+        IFNULL((SELECT CAST(ROUND(1.0 * SUM(domains * runs) / SUM(runs)) AS INT) FROM points WHERE adlist_id = l.id AND time >= ${since} AND time < l.latest), ''),
+        IFNULL((SELECT CAST(ROUND(1.0 * SUM(duration * runs) / SUM(runs)) AS INT) FROM points WHERE adlist_id = l.id AND time >= ${since} AND time < l.latest), ''),
+        (SELECT SUM(runs) FROM points WHERE adlist_id = l.id AND time >= ${since}),
+        (SELECT SUM(failures) FROM points WHERE adlist_id = l.id AND time >= ${since}),
+        (SELECT COUNT(*) FROM adlist_history WHERE adlist_id = l.id AND http_code NOT IN (200,304)
+           AND timestamp > IFNULL((SELECT MAX(timestamp) FROM adlist_history WHERE adlist_id = l.id AND http_code IN (200,304)), 0))
+      FROM (SELECT id, address, (SELECT MAX(time) FROM points WHERE adlist_id = adlist.id) AS latest FROM adlist WHERE enabled = 1) AS l
+      JOIN points AS p ON p.adlist_id = l.id AND p.time = l.latest
+      ORDER BY l.id;"
+}
+
+trendsFunc() {
+    local days="${1}" summary
+
+    summary="$(summaryQuery "${days}")" || exit 1
+    if [[ -z "${summary}" ]]; then
+        echo -e "  ${INFO} No adlist history recorded yet, it is written by 'pihole -g'"
+        exit 0
+    fi
+
+    echo -e "  ${INFO} Adlist trends over the last ${days} days"
+    awk -F '\t' '
+    BEGIN { printf "  %4s  %10s  %8s  %10s  %8s  %9s  %10s  %s\n", "ID", "Domains", "Change", "Unique", "Invalid", "Failures", "Avg. time", "Address" }
+    {
+        change = ($9 > 0) ? sprintf("%+.1f%%", ($4 - $9) * 100 / $9) : "-"
+        invalid = ($4 > 0) ? sprintf("%.1f%%", $5 * 100 / $4) : "-"
+        avg = ($11 != "") ? $11 : $7
+        printf "  %4d  %10d  %8s  %10d  %8s  %9s  %8d ms  %s\n", $1, $4, change, $6, invalid, $13 "/" $12, avg, $2
+    }' <<< "${summary}"
+}
+
+anomaliesFunc() {
+    local days="${1}" summary
+
+    summary="$(summaryQuery "${days}")" || exit 1
+    if [[ -z "${summary}" ]]; then
+        echo -e "  ${INFO} No adlist history recorded yet, it is written by 'pihole -g'"
+        exit 0
+    fi
+
+    awk -F '\t' -v shrink="${shrinkPercent}" -v growth="${growthPercent}" -v invalid="${invalidPercent}" \
+        -v slow="${slowFactor}" -v slowmin="${slowMinimum}" -v info="${INFO}" -v cross="${CROSS}" -v tick="${TICK}" -v days="${days}" '
+    function report(text) {
+        if (!($1 in reported)) { printf "  %s %d: %s\n", cross, $1, $2; reported[$1] = 1; found++ }
+        printf "      - %s\n", text
+    }
+    {
+        if ($14 > 0) {
+            report(sprintf("download failed %d time(s) in a row (HTTP %s)%s", $14, ($8 == "" || $8 == 0) ? "-" : $8, ($4 > 0) ? ", the cached list is used" : ""))
+        }
+        if ($4 == 0) {
+            report("no domains received")
+        } else if ($10 != "" && $4 * 100 < $10 * shrink) {
+            report(sprintf("shrank to %d domains from an average of %d", $4, $10))
+        } else if ($10 != "" && $10 > 0 && $4 * 100 > $10 * growth) {
+            report(sprintf("grew to %d domains from an average of %d", $4, $10))
+        }
+        if ($4 > 0 && $5 * 100 > $4 * invalid) {
+            report(sprintf("%d of %d lines invalid (%.1f%%)", $5, $4, $5 * 100 / $4))
+        }
+        if ($11 != "" && $7 > slowmin && $7 > $11 * slow) {
+            report(sprintf("download took %d ms, on average %d ms", $7, $11))
+        }
+    }
+    END {
+        if (found == 0) {
+            printf "  %s No anomalies in the latest run of %d adlist(s) (compared to the last %d days)\n", tick, NR, days
+            exit 0
+        }
+        printf "  %s %d adlist(s) with anomalies (compared to the last %d days)\n", info, found, days
+        exit 1
+    }' <<< "${summary}"
+}
+
+showFunc() {
+    local id="${1}" address
+
+    address="$(sqlite3 "${gravityDBfile}" "SELECT address FROM adlist WHERE id = ${id};")"
+    if [[ -z "${address}" ]]; then
+        echo -e "  ${CROSS} Adlist ${id} does not exist"
+        exit 1
+    fi
+
+    echo -e "  ${INFO} History of adlist ${id}: ${address}"
+    # Daily rows first, they are older than all runs
+    sqlite3 -separator $'\t' "${gravityDBfile}" "SELECT 'D', strftime('%Y-%m-%d', day, 'unixepoch'), runs, failures, domains, domains_min, domains_max, invalid, unique_domains, bytes, duration
+          FROM adlist_history_daily WHERE adlist_id = ${id} ORDER BY day;
+        SELECT 'R', strftime('%Y-%m-%d %H:%M', timestamp, 'unixepoch'), 1, http_code, domains, domains, domains, invalid, unique_domains, bytes, duration
+          FROM adlist_history WHERE adlist_id = ${id} ORDER BY timestamp;" | \
+    awk -F '\t' '
+    BEGIN { printf "  %-16s  %10s  %21s  %8s  %10s  %10s  %8s  %s\n", "Date (UTC)", "Domains", "Min - Max", "Invalid", "Unique", "Bytes", "Time", "Status" }
+    {
+        if ($1 == "D") {
+            status = $4 "/" $3 " failed"
+            range = $6 " - " $7
+        } else {
+            status = ($4 == 200 || $4 == 304) ? "HTTP " $4 : "HTTP " $4 " (failed)"
+            range = ""
+        }
+        printf "  %-16s  %10d  %21s  %8d  %10d  %10d  %5d ms  %s\n", $2, $5, range, $8, $9, $10, $11, status
+    }'
+}
+
+main() {
+    local command="${1}" days=30 id=""
+
+    if [[ -z "${command}" ]]; then
+        helpFunc
+    fi
+    shift
+
+    while (( "$#" )); do
+        case "${1}" in
+            "--days"        ) days="${2}"; shift;;
+            "-h" | "--help" ) helpFunc;;
+            -*              ) echo -e "  ${CROSS} Invalid option: ${1}
+  Try 'pihole history --help' for more information."; exit 1;;
+            *               ) id="${1}";;
+        esac
+        shift
+    done
+
+    if [[ ! "${days}" =~ ^[0-9]+$ ]] || [[ "${days}" -eq 0 ]]; then
+        echo -e "  ${CROSS} Invalid number of days: ${days}"
+        exit 1
+    fi
+    if [[ ! "${GRAVITY_HISTORY_DAYS}" =~ ^[0-9]+$ ]] || [[ ! "${GRAVITY_HISTORY_RETENTION}" =~ ^[0-9]+$ ]]; then
+        echo -e "  ${CROSS} GRAVITY_HISTORY_DAYS and GRAVITY_HISTORY_RETENTION have to be numbers of days"
+        exit 1
+    fi
+
+    case "${command}" in
+        "trends"    ) trendsFunc "${days}";;
+        "anomalies" ) anomaliesFunc "${days}";;
+        "show"      )
+            if [[ ! "${id}" =~ ^[0-9]+$ ]]; then
+                echo -e "  ${CROSS} No adlist ID specified"
+                exit 1
+            fi
+            showFunc "${id}"
+            ;;
+        "rollup"    ) rollupFunc;;
+        *           ) helpFunc;;
+    esac
+}
+
+if [[ -r "${piholeDir}/setupVars.conf" ]]; then
+    source "${piholeDir}/setupVars.conf"
+fi
+
+main "$@"
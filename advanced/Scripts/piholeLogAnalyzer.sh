@@ -0,0 +1,301 @@
+#!/usr/bin/env bash
+# shellcheck disable=SC1090
+# Pi-hole: A black hole for Internet advertisements
+# (c) 2020 Pi-hole, LLC (https://pi-hole.net)
+# Network-wide ad blocking via your own hardware.
+#
+# Index and analyze the current and rotated Pi-hole logs
+#
+# This file is copyright under the latest version of the EUPL.
+# Please see LICENSE file for your rights under this license.
+
+# Globals
+PIHOLE_LOG="${PIHOLE_LOG:-/var/log/pihole.log}"
+PIHOLE_LOG_INDEX="${PIHOLE_LOG_INDEX:-/var/log/pihole-log-index.db}"
+
+colfile="/opt/pihole/COL_TABLE"
+if [[ -f "${colfile}" ]]; then
+    source "${colfile}"
+fi
+
+# Schema of the index
+# Domains and clients are stored once and referenced by their ID to keep the index compact.
+# Times are stored as seconds since the epoch of the local (not UTC) time found in the log
+# as the log itself does not contain any timezone information
+indexSchema="CREATE TABLE IF NOT EXISTS source (fingerprint TEXT PRIMARY KEY, lines INTEGER NOT NULL DEFAULT 0, complete BOOL NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS domain (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS client (id INTEGER PRIMARY KEY, ip TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS query (time INTEGER NOT NULL, client_id INTEGER NOT NULL, domain_id INTEGER NOT NULL, type TEXT NOT NULL, blocked BOOL NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS idx_query_time ON query (time);
+CREATE INDEX IF NOT EXISTS idx_query_client_time ON query (client_id, time);"
+
+helpFunc() {
+    echo "Usage: pihole -la <command> [options]
+Example: 'pihole -la query --client 192.168.0.10 --blocked --from \"yesterday 18:00\"'
+Index and analyze the current and rotated Pi-hole logs
+
+Commands:
+  index               Add new lines of all log files to the index
+                        Add '--rebuild' to discard the existing index first
+  query               List the matching queries
+  top                 List the most queried domains
+                        Add '--clients' to list the most active clients instead
+  summary             Show an overview of the matching queries
+
+Options:
+  --from <time>       Only include queries made at or after <time>
+  --to <time>         Only include queries made before <time>
+                        <time> can be anything understood by 'date -d', e.g. '2020-05-01 18:00' or '2 hours ago'
+  --client <ip>       Only include queries made by the given client
+  --domain <text>     Only include domains containing <text>
+  --blocked           Only include blocked queries
+  -n <number>         Limit the output to <number> lines (default: 10 for top, 100 for query)
+  --obfuscate         Do not show any domain names (summary only)
+  --no-update         Only read the existing index, do not add new lines to it first
+  -h, --help          Show this help dialog
+
+The index is updated automatically before running any of the commands above (unless --no-update is given).
+It is stored in ${PIHOLE_LOG_INDEX}"
+    exit 0
+}
+
+# Convert a time given to 'date -d' into the local epoch used by the index
+localEpoch() {
+    local localtime
+    localtime="$(date -d "${1}" +'%Y-%m-%d %H:%M:%S' 2> /dev/null)" || return 1
+    date -u -d "${localtime}" +%s
+}
+
+# Print the log files in chronological order (oldest first)
+logFiles() {
+    local i
+    for (( i=30; i>0; i-- )); do
+        if [[ -f "${PIHOLE_LOG}.${i}.gz" ]]; then
+            echo "${PIHOLE_LOG}.${i}.gz"
+        elif [[ -f "${PIHOLE_LOG}.${i}" ]]; then
+            echo "${PIHOLE_LOG}.${i}"
+        fi
+    done
+    if [[ -f "${PIHOLE_LOG}" ]]; then
+        echo "${PIHOLE_LOG}"
+    fi
+}
+
+readLog() {
+    if [[ "${1}" == *".gz" ]]; then
+        zcat -f "${1}"
+    else
+        cat "${1}"
+    fi
+}
+
+# Stream the not yet indexed lines of a log file into tab separated records
+#   Q <time> <client> <domain> <type> <blocked>
+#   B - - <domain> - -  (blocked reply whose query was indexed during an earlier run)
+# The last line of the output contains the number of lines that have been read
+parseLog() {
+    awk -v year="$(date +%Y)" -v month="$(date +%-m)" '
+    BEGIN {
+        OFS = "\t"
+        split("Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec", names, " ")
+        for (i = 1; i <= 12; i++) { months[names[i]] = i }
+    }
+    # Days since 1970-01-01 of the given date
+    function days(y, m, d,    era, yoe, doy, doe) {
+        y -= (m <= 2)
+        era = int((y >= 0 ? y : y - 399) / 400)
+        yoe = y - era * 400
+        doy = int((153 * (m + (m > 2 ? -3 : 9)) + 2) / 5) + d - 1
+        doe = yoe * 365 + int(yoe / 4) - int(yoe / 100) + doy
+        return era * 146097 + doe - 719468
+    }
+    function epoch(    m, t) {
+        m = months[$1]
+        # Logs do not contain the year, entries from a later month have to be from last year
+        split($3, t, ":")
+        return (days(m > month ? year - 1 : year, m, $2) * 86400) + (t[1] * 3600) + (t[2] * 60) + t[3]
+    }
+    function flush(dom) {
+        print "Q", pending[dom], blocked[dom]
+        delete pending[dom]
+        delete blocked[dom]
+        waiting--
+    }
+    $5 ~ /^query\[/ {
+        dom = $6
+        if (dom in pending) { flush(dom) }
+        # Only keep a limited number of queries waiting for their reply
+        if (waiting >= 10000) { for (d in pending) { flush(d) } }
+        pending[dom] = epoch() OFS $8 OFS dom OFS substr($5, 7, length($5) - 7)
+        blocked[dom] = 0
+        waiting++
+        next
+    }
+    $5 == "gravity" || $5 == "regex" || $5 == "exactly" || $5 == "blacklisted" {
+        dom = ($5 == "blacklisted") ? $6 : $7
+        if (dom in pending) { blocked[dom] = 1; flush(dom) }
+        else { print "B", "", "", dom, "", "" }
+    }
+    END {
+        for (d in pending) { flush(d) }
+        print "N", NR
+    }'
+}
+
+indexFunc() {
+    local rebuild="${1:-false}" file fingerprint escaped indexed complete records lines total=0
+
+    if [[ "${rebuild}" == true ]]; then
+        rm -f "${PIHOLE_LOG_INDEX}"
+    fi
+
+    if ! sqlite3 "${PIHOLE_LOG_INDEX}" "${indexSchema}"; then
+        echo -e "  ${CROSS} Unable to create index ${PIHOLE_LOG_INDEX}" >&2
+        return 1
+    fi
+
+    records="$(mktemp -p "/tmp" "pihole_log_index.XXXXX")"
+
+    while IFS= read -r file; do
+        # Rotated files keep their first line, so it identifies a log file regardless of its current name
+        fingerprint="$(readLog "${file}" | head -n 1)"
+        if [[ -z "${fingerprint}" ]]; then
+            continue
+        fi
+        escaped="${fingerprint//\'/\'\'}"
+        IFS='|' read -r indexed complete <<< "$(sqlite3 "${PIHOLE_LOG_INDEX}" "SELECT lines, complete FROM source WHERE fingerprint = '${escaped}';")"
+        if [[ "${complete}" == "1" ]]; then
+            continue
+        fi
+
+        readLog "${file}" | tail -n +"$(( ${indexed:-0} + 1 ))" | parseLog > "${records}"
+        lines="$(tail -n 1 "${records}" | cut -f 2)"
+        sed -i '$d' "${records}"
+
+        # Rotated files do not change anymore and do not have to be looked at again
+        complete=0
+        if [[ "${file}" != "${PIHOLE_LOG}" ]]; then
+            complete=1
+        fi
+
+        sqlite3 "${PIHOLE_LOG_INDEX}" << EOSQL || { rm -f "${records}"; return 1; }
+.timeout 30000
+CREATE TEMP TABLE parsed (kind TEXT, time INTEGER, client TEXT, domain TEXT, type TEXT, blocked BOOL);
+.mode tabs
+.import ${records} parsed
+BEGIN TRANSACTION;
+UPDATE query SET blocked = 1 WHERE rowid IN
+    (SELECT (SELECT max(q.rowid) FROM query q JOIN domain d ON d.id = q.domain_id WHERE d.name = p.domain) FROM parsed p WHERE p.kind = 'B');
+DELETE FROM parsed WHERE kind != 'Q';
+INSERT OR IGNORE INTO domain (name) SELECT DISTINCT domain FROM parsed;
+INSERT OR IGNORE INTO client (ip) SELECT DISTINCT client FROM parsed;
+INSERT INTO query (time, client_id, domain_id, type, blocked)
+    SELECT p.time, c.id, d.id, p.type, p.blocked FROM parsed p JOIN client c ON c.ip = p.client JOIN domain d ON d.name = p.domain;
+INSERT OR REPLACE INTO source (fingerprint, lines, complete) VALUES ('${escaped}', ${indexed:-0} + ${lines:-0}, ${complete});
+COMMIT;
+EOSQL
+        total=$(( total + ${lines:-0} ))
+    done < <(logFiles)
+
+    rm -f "${records}"
+    echo "${total}"
+}
+
+main() {
+    local command="${1}" from="" to="" client="" domain="" blocked=false limit="" obfuscate=false clients=false rebuild=false update=true
+    local where=("1") query
+
+    if [[ -z "${command}" ]]; then
+        helpFunc
+    fi
+    shift
+
+    while (( "$#" )); do
+        case "${1}" in
+            "--from"      ) from="$(localEpoch "${2}")" || { echo -e "  ${CROSS} Invalid time: ${2}"; exit 1; }; shift;;
+            "--to"        ) to="$(localEpoch "${2}")" || { echo -e "  ${CROSS} Invalid time: ${2}"; exit 1; }; shift;;
+            "--client"    ) client="${2}"; shift;;
+            "--domain"    ) domain="${2}"; shift;;
+            "--blocked"   ) blocked=true;;
+            "-n"          ) limit="${2}"; shift;;
+            "--obfuscate" ) obfuscate=true;;
+            "--clients"   ) clients=true;;
+            "--rebuild"   ) rebuild=true;;
+            "--no-update" ) update=false;;
+            "-h" | "--help" ) helpFunc;;
+            *             ) echo -e "  ${CROSS} Invalid option: ${1}
+  Try 'pihole -la --help' for more information."; exit 1;;
+        esac
+        shift
+    done
+
+    if [[ -n "${limit}" ]] && [[ ! "${limit}" =~ ^[0-9]+$ ]]; then
+        echo -e "  ${CROSS} Invalid number: ${limit}"
+        exit 1
+    fi
+
+    if [[ "${command}" == "index" ]]; then
+        local lines
+        lines="$(indexFunc "${rebuild}")" || exit 1
+        echo -e "  ${TICK} Indexed ${lines} new lines"
+        exit 0
+    fi
+
+    if [[ "${update}" == true ]]; then
+        indexFunc > /dev/null || exit 1
+    elif [[ ! -s "${PIHOLE_LOG_INDEX}" ]]; then
+        echo -e "  ${INFO} No log index found at ${PIHOLE_LOG_INDEX}, it is created by 'pihole -la index'"
+        exit 1
+    fi
+
+    [[ -n "${from}" ]] && where+=("q.time >= ${from}")
+    [[ -n "${to}" ]] && where+=("q.time < ${to}")
+    [[ -n "${client}" ]] && where+=("q.client_id = (SELECT id FROM client WHERE ip = '${client//\'/\'\'}')")
+    [[ -n "${domain}" ]] && where+=("d.name LIKE '%${domain//\'/\'\'}%'")
+    [[ "${blocked}" == true ]] && where+=("q.blocked = 1")
+    query="FROM query q JOIN domain d ON d.id = q.domain_id JOIN client c ON c.id = q.client_id"
+    query+=" WHERE $(printf '%s AND ' "${where[@]}")1"
+
+    case "${command}" in
+        "query" )
+            sqlite3 -separator $'\t' "${PIHOLE_LOG_INDEX}" \
+                "SELECT datetime(q.time, 'unixepoch'), c.ip, q.type, d.name, CASE q.blocked WHEN 1 THEN 'blocked' ELSE 'allowed' END
+                 ${query} ORDER BY q.time LIMIT ${limit:-100};"
+            ;;
+        "top" )
+            if [[ "${clients}" == true ]]; then
+                sqlite3 -separator $'\t' "${PIHOLE_LOG_INDEX}" \
+                    "SELECT count(*) AS num, c.ip ${query} GROUP BY q.client_id ORDER BY num DESC LIMIT ${limit:-10};"
+            else
+                sqlite3 -separator $'\t' "${PIHOLE_LOG_INDEX}" \
+                    "SELECT count(*) AS num, d.name ${query} GROUP BY q.domain_id ORDER BY num DESC LIMIT ${limit:-10};"
+            fi
+            ;;
+        "summary" )
+            local total blocked_total first last
+            IFS='|' read -r total blocked_total first last <<< "$(sqlite3 "${PIHOLE_LOG_INDEX}" \
+                "SELECT count(*), total(q.blocked), datetime(min(q.time), 'unixepoch'), datetime(max(q.time), 'unixepoch') ${query};")"
+            echo "Queries: ${total}"
+            echo "Blocked: ${blocked_total%.*}"
+            echo "First query: ${first:-none}"
+            echo "Last query: ${last:-none}"
+            echo "Query types:"
+            sqlite3 -separator $'\t' "${PIHOLE_LOG_INDEX}" \
+                "SELECT count(*) AS num, q.type ${query} GROUP BY q.type ORDER BY num DESC;" | sed 's/^/  /'
+            echo "Clients: $(sqlite3 "${PIHOLE_LOG_INDEX}" "SELECT count(DISTINCT q.client_id) ${query};")"
+            echo "Domains: $(sqlite3 "${PIHOLE_LOG_INDEX}" "SELECT count(DISTINCT q.domain_id) ${query};")"
+            # Domain names are only shown when they are not to be obfuscated
+            if [[ "${obfuscate}" == false ]]; then
+                echo "Top domains:"
+                sqlite3 -separator $'\t' "${PIHOLE_LOG_INDEX}" \
+                    "SELECT count(*) AS num, d.name ${query} GROUP BY q.domain_id ORDER BY num DESC LIMIT ${limit:-10};" | sed 's/^/  /'
+                echo "Top blocked domains:"
+                sqlite3 -separator $'\t' "${PIHOLE_LOG_INDEX}" \
+                    "SELECT count(*) AS num, d.name ${query} AND q.blocked = 1 GROUP BY q.domain_id ORDER BY num DESC LIMIT ${limit:-10};" | sed 's/^/  /'
+            fi
+            ;;
+        * ) helpFunc;;
+    esac
+}
+
+main "$@"
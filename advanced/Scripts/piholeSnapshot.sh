@@ -0,0 +1,398 @@
+#!/usr/bin/env bash
+# shellcheck disable=SC1090
+# Pi-hole: A black hole for Internet advertisements
+# (c) 2020 Pi-hole, LLC (https://pi-hole.net)
+# Network-wide ad blocking via your own hardware.
+#
+# Build and query the compiled gravity snapshot
+#
+# This file is copyright under the latest version of the EUPL.
+# Please see LICENSE file for your rights under this license.
+
+# The snapshot is a read-only file holding all domains blocked by gravity and the exact
+# blacklist (minus the exact whitelist) for every enabled group.
+#
+# Format (version 1):
+# - The header comes first, followed by the domain lines sorted bytewise (LC_ALL=C). Header
+#   lines start with "#", which sorts before any domain, so the whole file can still be
+#   memory-mapped and binary-searched for a domain. Header fields are separated by tabs:
+#     #pihole-snapshot  <format version>
+#     #build            <build ID>  <gravity.db updated timestamp>
+#     #groups           <comma separated group IDs, in bitmap order>
+#     #domains          <number of domains>
+#     #bloom            <bits>  <hashes>   (only if a Bloom filter has been built)
+# - Every other line is "<domain><TAB><bitmap>", where the bitmap is one character per
+#   group in the order of the #groups header: "1" if the domain is blocked for the group
+# Regex and wildcard filters are not part of the snapshot.
+# The bitmaps are deliberately stored as text rather than as a binary index, so the file
+# can be built with sort and awk and searched with look, without a compiled helper.
+#
+# The optional Bloom filter is stored in a separate file. Its first line is the build ID
+# (it is only valid if it matches the snapshot's build ID), followed by the filter as hex
+# digits with bit i of the filter being bit (i % 4) of digit (i / 4). Bit positions are
+# (h1 + i * h2) % bits for i < hashes, with
+#   h1 = fold(h * 31 + byte) % 2147483647 and h2 = fold(h * 37 + byte) % 2147483629
+
+export LC_ALL=C
+
+piholeDir="/etc/pihole"
+gravityDBfile="${piholeDir}/gravity.db"
+snapshotFile="${piholeDir}/gravity.snapshot"
+bloomFile="${snapshotFile}.bloom"
+snapshotVersion=1
+bloomHashes=7
+
+colfile="/opt/pihole/COL_TABLE"
+if [[ -f "${colfile}" ]]; then
+    source "${colfile}"
+fi
+
+helpFunc() {
+    echo "Usage: pihole snapshot <command> [options]
+Example: 'pihole snapshot lookup doubleclick.net'
+Build and query the compiled gravity snapshot
+
+Commands:
+  build               Build the snapshot from the gravity database
+                        Add '--bloom' to build a Bloom filter as well
+  lookup <domain>     Show the groups the domain is blocked for
+                        Add '--group <id>' to only check a single group (exit code 0 = blocked)
+                        Add '--bloom' to check the Bloom filter first
+  bench               Compare lookups in the snapshot with the gravity database
+                        Add '-n <number>' to set the number of lookups (default: 100)
+  info                Show the header of the snapshot
+  -h, --help          Show this help dialog"
+    exit 0
+}
+
+buildFunc() {
+    local bloom="${1}" buildID updated numDomains bits="" tmpSnapshot tmpBloom tmpHeader tmpLeftover status
+
+    buildID="$(date +%s)-$$"
+    updated="$(sqlite3 "${gravityDBfile}" "SELECT value FROM info WHERE property = 'updated';")"
+    if [[ "${bloom}" == true ]]; then
+        # About ten bits per domain result in a false positive rate of roughly 1%
+        numDomains="$(sqlite3 "${gravityDBfile}" "SELECT IFNULL((SELECT value FROM info WHERE property = 'gravity_count'), 0) + (SELECT COUNT(*) FROM domainlist WHERE type = 1);")"
+        bits=$(( (numDomains * 10 / 4 + 1) * 4 ))
+    fi
+
+    # Build into temporary files next to the published ones, so they can be moved into place atomically
+    tmpSnapshot="$(mktemp -p "${piholeDir}" "gravity.snapshot.XXXXX")"
+    tmpBloom="$(mktemp -p "${piholeDir}" "gravity.snapshot.bloom.XXXXX")"
+    tmpHeader="$(mktemp -p "/tmp" "gravity.snapshot.XXXXX")"
+    tmpLeftover="$(mktemp -p "/tmp" "gravity.snapshot.XXXXX")"
+
+    # The gravity table is read in domain order using its index, so all lists containing a domain
+    # are seen at once. Blacklisted domains not found in gravity are sorted and merged afterwards
+    sqlite3 -separator $'\t' "${gravityDBfile}" \
+        "SELECT 'G', id FROM \"group\" WHERE enabled = 1 ORDER BY id;
+         SELECT 'L', adlist_by_group.adlist_id, adlist_by_group.group_id FROM adlist_by_group
+           JOIN adlist ON adlist.id = adlist_by_group.adlist_id JOIN \"group\" ON \"group\".id = adlist_by_group.group_id
+           WHERE adlist.enabled = 1 AND \"group\".enabled = 1;
+         SELECT 'W', domain, group_id FROM vw_whitelist WHERE group_id IS NOT NULL;
+         SELECT 'B', domain, group_id FROM vw_blacklist WHERE group_id IS NOT NULL;
+         SELECT 'D', domain, adlist_id FROM gravity ORDER BY domain, adlist_id;" | \
+    awk -F '\t' -v bits="${bits}" -v hashes="${bloomHashes}" -v bloomfile="${tmpBloom}" -v headerfile="${tmpHeader}" \
+        -v leftover="${tmpLeftover}" -v version="${snapshotVersion}" -v buildid="${buildID}" -v updated="${updated}" '
+    BEGIN { for (i = 1; i < 256; i++) { ord[sprintf("%c", i)] = i } }
+    # Bitmap with the given groups (space separated IDs) set
+    function bitmap(ids,    num, i, gs, map) {
+        map = empty
+        num = split(ids, gs, " ")
+        for (i = 1; i <= num; i++) {
+            if (gs[i] in position) { map = substr(map, 1, position[gs[i]] - 1) "1" substr(map, position[gs[i]] + 1) }
+        }
+        return map
+    }
+    function bloomAdd(domain,    h1, h2, i, len, c, idx, nibble, value) {
+        h1 = 0; h2 = 0
+        len = length(domain)
+        for (i = 1; i <= len; i++) {
+            c = ord[substr(domain, i, 1)]
+            h1 = (h1 * 31 + c) % 2147483647
+            h2 = (h2 * 37 + c) % 2147483629
+        }
+        for (i = 0; i < hashes; i++) {
+            idx = (h1 + i * h2) % bits
+            nibble = int(idx / 4)
+            value = 2 ^ (idx % 4)
+            if (int(filter[nibble] / value) % 2 == 0) { filter[nibble] += value }
+        }
+    }
+    function emit(domain, map, file) {
+        if (map == empty) { return }
+        if (file == "") { print domain "\t" map } else { print domain "\t" map > file }
+        domains++
+        if (bits != "") { bloomAdd(domain) }
+    }
+    # Combine the groups of all lists containing the current domain with its blacklist
+    # entries and remove the groups the domain is whitelisted for
+    function finish(    i, key, ids, map, g, pos) {
+        if (domain == "") { return }
+        key = ""
+        for (i = 1; i <= n; i++) { key = key " " lists[i] }
+        if (!(key in maps)) {
+            ids = ""
+            for (i = 1; i <= n; i++) { ids = ids groups[lists[i]] }
+            maps[key] = bitmap(ids)
+        }
+        map = maps[key]
+        if (domain in black) {
+            map = mapOr(map, bitmap(black[domain]))
+            delete black[domain]
+        }
+        if (domain in white) {
+            for (g in position) {
+                pos = position[g]
+                if ((domain, g) in whitelist) { map = substr(map, 1, pos - 1) "0" substr(map, pos + 1) }
+            }
+        }
+        emit(domain, map, "")
+        n = 0
+    }
+    function mapOr(a, b,    i, result) {
+        result = ""
+        for (i = 1; i <= length(a); i++) {
+            result = result ((substr(a, i, 1) == "1" || substr(b, i, 1) == "1") ? "1" : "0")
+        }
+        return result
+    }
+    $1 == "G" { order = order (order == "" ? "" : ",") $2; position[$2] = ++numgroups; empty = empty "0"; next }
+    $1 == "L" { groups[$2] = groups[$2] " " $3; next }
+    $1 == "W" { white[$2] = 1; whitelist[$2 SUBSEP $3] = 1; next }
+    $1 == "B" { black[$2] = black[$2] " " $3; next }
+    $1 == "D" {
+        if ($2 != domain) { finish(); domain = $2 }
+        if (n == 0 || lists[n] != $3) { lists[++n] = $3 }
+    }
+    END {
+        finish()
+        # Blacklisted domains which are not part of gravity
+        for (d in black) {
+            map = bitmap(black[d])
+            if (d in white) {
+                for (g in position) {
+                    if ((d, g) in whitelist) { map = substr(map, 1, position[g] - 1) "0" substr(map, position[g] + 1) }
+                }
+            }
+            emit(d, map, leftover)
+        }
+        print "#pihole-snapshot\t" version > headerfile
+        print "#build\t" buildid "\t" updated > headerfile
+        print "#groups\t" order > headerfile
+        print "#domains\t" domains + 0 > headerfile
+        if (bits != "") {
+            print "#bloom\t" bits "\t" hashes > headerfile
+            print buildid > bloomfile
+            line = ""
+            for (i = 0; i < bits / 4; i++) {
+                line = line sprintf("%x", filter[i])
+                if (length(line) >= 4096) { printf "%s", line > bloomfile; line = "" }
+            }
+            print line > bloomfile
+        }
+    }' > "${tmpSnapshot}.unsorted"
+    status="$?"
+
+    if [[ "${status}" -eq 0 ]]; then
+        # Everything but the leftover blacklist entries is sorted already
+        { cat "${tmpHeader}"; sort "${tmpLeftover}" | sort -m "${tmpSnapshot}.unsorted" -; } > "${tmpSnapshot}"
+        status="$?"
+    fi
+    rm -f "${tmpSnapshot}.unsorted" "${tmpHeader}" "${tmpLeftover}"
+
+    if [[ "${status}" -ne 0 ]]; then
+        rm -f "${tmpSnapshot}" "${tmpBloom}"
+        echo -e "  ${CROSS} Unable to build snapshot from ${gravityDBfile}" >&2
+        return 1
+    fi
+
+    chmod 644 "${tmpSnapshot}" "${tmpBloom}"
+    # Publish the Bloom filter first: it is only used when its build ID matches the snapshot's
+    if [[ "${bloom}" == true ]]; then
+        mv -f "${tmpBloom}" "${bloomFile}"
+    else
+        rm -f "${tmpBloom}" "${bloomFile}"
+    fi
+    mv -f "${tmpSnapshot}" "${snapshotFile}"
+}
+
+# Read a header field of the snapshot
+headerValue() {
+    awk -F '\t' -v OFS='\t' -v name="#${1}" '!/^#/ { exit } $1 == name { $1 = ""; sub(/^\t/, ""); print; exit }' "${snapshotFile}"
+}
+
+# Check whether the domain may be in the snapshot (1 = definitely not)
+bloomCheck() {
+    local domain="${1}" bloom buildID bits hashes h1=0 h2=0 i c idx digit
+
+    read -r bloom <<< "$(headerValue "bloom")"
+    read -r buildID _ <<< "$(headerValue "build")"
+    if [[ -z "${bloom}" ]] || [[ ! -r "${bloomFile}" ]] || [[ "$(head -n 1 "${bloomFile}")" != "${buildID}" ]]; then
+        # No (valid) Bloom filter available
+        return 0
+    fi
+    read -r bits hashes <<< "${bloom}"
+
+    for (( i=0; i<${#domain}; i++ )); do
+        printf -v c "%d" "'${domain:i:1}"
+        h1=$(( (h1 * 31 + c) % 2147483647 ))
+        h2=$(( (h2 * 37 + c) % 2147483629 ))
+    done
+    for (( i=0; i<hashes; i++ )); do
+        idx=$(( (h1 + i * h2) % bits ))
+        # Skip the build ID line and read a single hex digit
+        digit="$(dd if="${bloomFile}" bs=1 skip=$(( ${#buildID} + 1 + idx / 4 )) count=1 2> /dev/null)"
+        if (( (16#${digit:-0} >> (idx % 4)) % 2 == 0 )); then
+            return 1
+        fi
+    done
+    return 0
+}
+
+# Print "<domain><TAB><bitmap>" if the domain is in the snapshot
+snapshotLookup() {
+    if command -v look &> /dev/null; then
+        # look performs a binary search on the memory-mapped file
+        look "${1}"$'\t' "${snapshotFile}"
+    else
+        grep -m 1 "^${1//./\\.}"$'\t' "${snapshotFile}"
+    fi
+}
+
+lookupFunc() {
+    local domain="${1}" group="${2}" bloom="${3}" line map groups=() blocked=() i
+
+    if [[ ! -r "${snapshotFile}" ]]; then
+        echo -e "  ${CROSS} Snapshot ${snapshotFile} not found, please run 'pihole -g'"
+        exit 2
+    fi
+
+    domain="${domain,,}"
+    if [[ "${bloom}" == true ]] && ! bloomCheck "${domain}"; then
+        line=""
+    else
+        line="$(snapshotLookup "${domain}")"
+    fi
+    map="${line#*$'\t'}"
+
+    IFS=',' read -r -a groups <<< "$(headerValue "groups")"
+    for i in "${!groups[@]}"; do
+        if [[ -n "${line}" ]] && [[ "${map:i:1}" == "1" ]]; then
+            blocked+=("${groups[$i]}")
+        fi
+    done
+
+    if [[ -n "${group}" ]]; then
+        for i in "${blocked[@]}"; do
+            if [[ "${i}" == "${group}" ]]; then
+                echo "  ${TICK} ${domain} is blocked for group ${group}"
+                exit 0
+            fi
+        done
+        echo "  ${INFO} ${domain} is not blocked for group ${group} (regex and wildcard filters are not considered)"
+        exit 1
+    fi
+
+    if [[ "${#blocked[@]}" -eq 0 ]]; then
+        echo "  ${INFO} ${domain} is not blocked for any group (regex and wildcard filters are not considered)"
+        exit 1
+    fi
+    echo "  ${TICK} ${domain} is blocked for group(s): $(IFS=','; echo "${blocked[*]}")"
+    exit 0
+}
+
+benchFunc() {
+    local num="${1:-100}" domains=() domain start end snapshot_ms bloom_ms sql_ms
+
+    if [[ ! -r "${snapshotFile}" ]]; then
+        echo -e "  ${CROSS} Snapshot ${snapshotFile} not found, please run 'pihole -g'"
+        exit 2
+    fi
+
+    # Half of the lookups are for blocked domains, the other half for domains which are not blocked
+    mapfile -t domains < <(sqlite3 "${gravityDBfile}" "SELECT domain FROM gravity WHERE rowid IN (SELECT ABS(RANDOM()) % (SELECT MAX(rowid) FROM gravity) + 1 FROM gravity LIMIT $(( num / 2 )));")
+    while [[ "${#domains[@]}" -lt "${num}" ]]; do
+        domains+=("bench-${RANDOM}-${#domains[@]}.invalid")
+    done
+
+    echo -e "  ${INFO} Looking up ${#domains[@]} domains ($(grep -c -v '^#' "${snapshotFile}") domains in the snapshot)"
+
+    start=$(date +%s%N)
+    for domain in "${domains[@]}"; do
+        snapshotLookup "${domain}" > /dev/null
+    done
+    end=$(date +%s%N)
+    snapshot_ms=$(( (end - start) / 1000000 ))
+    echo -e "  ${INFO} Snapshot:                ${snapshot_ms} ms ($(( (end - start) / 1000 / ${#domains[@]} )) µs per lookup)"
+
+    if [[ -n "$(headerValue "bloom")" ]]; then
+        start=$(date +%s%N)
+        for domain in "${domains[@]}"; do
+            bloomCheck "${domain}" && snapshotLookup "${domain}" > /dev/null
+        done
+        end=$(date +%s%N)
+        bloom_ms=$(( (end - start) / 1000000 ))
+        echo -e "  ${INFO} Snapshot + Bloom filter: ${bloom_ms} ms ($(( (end - start) / 1000 / ${#domains[@]} )) µs per lookup)"
+    fi
+
+    # The equivalent query on the gravity database
+    start=$(date +%s%N)
+    for domain in "${domains[@]}"; do
+        sqlite3 "${gravityDBfile}" "SELECT group_id FROM vw_gravity WHERE domain = '${domain}' AND group_id NOT IN (SELECT group_id FROM vw_whitelist WHERE domain = '${domain}' AND group_id IS NOT NULL)
+                                    UNION SELECT group_id FROM vw_blacklist WHERE domain = '${domain}' AND group_id IS NOT NULL;" > /dev/null
+    done
+    end=$(date +%s%N)
+    sql_ms=$(( (end - start) / 1000000 ))
+    echo -e "  ${INFO} SQL (vw_gravity):        ${sql_ms} ms ($(( (end - start) / 1000 / ${#domains[@]} )) µs per lookup)"
+}
+
+main() {
+    local command="${1}" domain="" group="" bloom=false num=""
+
+    if [[ -z "${command}" ]]; then
+        helpFunc
+    fi
+    shift
+
+    while (( "$#" )); do
+        case "${1}" in
+            "--bloom"       ) bloom=true;;
+            "--group"       ) group="${2}"; shift;;
+            "-n"            ) num="${2}"; shift;;
+            "-h" | "--help" ) helpFunc;;
+            -*              ) echo -e "  ${CROSS} Invalid option: ${1}
+  Try 'pihole snapshot --help' for more information."; exit 1;;
+            *               ) domain="${1}";;
+        esac
+        shift
+    done
+
+    case "${command}" in
+        "build"  ) buildFunc "${bloom}";;
+        "lookup" )
+            if [[ -z "${domain}" ]]; then
+                echo -e "  ${CROSS} No domain specified"
+                exit 1
+            fi
+            lookupFunc "${domain}" "${group}" "${bloom}"
+            ;;
+        "bench"  )
+            if [[ -n "${num}" ]] && [[ ! "${num}" =~ ^[0-9]+$ ]]; then
+                echo -e "  ${CROSS} Invalid number: ${num}"
+                exit 1
+            fi
+            benchFunc "${num}"
+            ;;
+        "info"   )
+            if [[ ! -r "${snapshotFile}" ]]; then
+                echo -e "  ${CROSS} Snapshot ${snapshotFile} not found, please run 'pihole -g'"
+                exit 2
+            fi
+            awk '!/^#/ { exit } { print }' "${snapshotFile}"
+            ;;
+        *        ) helpFunc;;
+    esac
+}
+
+main "$@"
@@ -0,0 +1,434 @@
+#!/usr/bin/env bash
+# shellcheck disable=SC1090
+# Pi-hole: A black hole for Internet advertisements
+# (c) 2020 Pi-hole, LLC (https://pi-hole.net)
+# Network-wide ad blocking via your own hardware.
+#
+# Distribute gravity builds from a leader to follower Pi-holes
+#
+# This file is copyright under the latest version of the EUPL.
+# Please see LICENSE file for your rights under this license.
+
+# The leader publishes every gravity build into a directory (which may be served by its web server):
+#   manifest             "version <n>", "schema <gravity.db version>", "full <file> <sha256>"
+#                        and one "delta <n> <file> <sha256>" line for every available delta
+#   manifest.sig         Signature of the manifest, if SYNC_SIGNING_KEY is set on the leader
+#   gravity-<n>.db.gz    The complete database of build n
+#   delta-<n>.db.gz      The changes from build n-1 to build n: the new and changed rows of every
+#                        table, and the keys of its removed rows in table "removed_<table>"
+# Followers remember the build they are on in info.sync_version. They apply all deltas since
+# in a single transaction, or replace their database with the complete build if they are too
+# far behind (only the last ${syncDeltas} deltas are kept) or on a different schema version.
+#
+# Followers never run SQL they receive: deltas and builds are databases which only provide rows.
+# They are attached and copied with fixed statements built from the local schema. A leader is a
+# directory or an https:// URL. With SYNC_LEADER_KEY set to the public key of the leader's
+# SYNC_SIGNING_KEY (copied to the follower by other means), only signed manifests are accepted.
+
+export LC_ALL=C
+
+piholeDir="/etc/pihole"
+gravityDBfile="${piholeDir}/gravity.db"
+gravityDBschema="/etc/.pihole/advanced/Templates/gravity.db.sql"
+gravityTEMPfile="${piholeDir}/gravity_temp.db"
+# The last published build, deltas are computed against it
+syncBaseFile="${piholeDir}/gravity_sync_base.db"
+# At most ten deltas can be attached at once
+syncDeltas=10
+
+# Tables to be synchronized and their key columns, the gravity table is compared as a whole
+syncTables=("group:id" "domainlist:id" "domainlist_by_group:domainlist_id,group_id" "adlist:id"
+            "adlist_by_group:adlist_id,group_id" "client:id" "client_by_group:client_id,group_id"
+            "domain_audit:id" "info:property" "adlist_stats:adlist_id" "adlist_overlap:adlist_id,other_adlist_id"
+            "group_stats:group_id" "adlist_history:adlist_id,timestamp" "adlist_history_daily:adlist_id,day"
+            "gravity:domain,adlist_id")
+
+colfile="/opt/pihole/COL_TABLE"
+if [[ -f "${colfile}" ]]; then
+    source "${colfile}"
+fi
+# shellcheck disable=SC1091
+source "/etc/.pihole/advanced/Scripts/database_migration/gravity-db.sh"
+
+helpFunc() {
+    echo "Usage: pihole sync <command> [directory|URL]
+Example: 'pihole sync pull https://pi.hole.leader/pihole-sync'
+Distribute gravity builds from a leader to follower Pi-holes
+
+Commands:
+  publish <directory>  Publish the current gravity database as a new build (leader)
+                         Runs after every 'pihole -g' when SYNC_PUBLISH_DIR is set in setupVars.conf
+  pull <dir|URL>       Update the gravity database to the latest published build (follower)
+                         Replaces 'pihole -g' when SYNC_LEADER is set in setupVars.conf
+                         URLs have to use https://
+  status               Show the build this Pi-hole is on
+  -h, --help           Show this help dialog
+
+Set SYNC_SIGNING_KEY (leader, private key) and SYNC_LEADER_KEY (followers, public key)
+in setupVars.conf to sign and verify the published builds.
+Followers should not be edited locally: their lists are overwritten by the next build"
+    exit 0
+}
+
+# Get the statements storing the changes from database "OLD" to database "NEW" in database "DELTA"
+# All three databases need to be attached to the current connection
+deltaQuery() {
+    local entry table keys
+    for entry in "${syncTables[@]}"; do
+        table="${entry%%:*}"
+        keys="${entry#*:}"
+        # New and changed rows, then the keys of rows which are no longer present
+        echo "CREATE TABLE DELTA.\"${table}\" AS SELECT * FROM NEW.\"${table}\" EXCEPT SELECT * FROM OLD.\"${table}\";"
+        echo "CREATE TABLE DELTA.\"removed_${table}\" AS SELECT ${keys} FROM OLD.\"${table}\" EXCEPT SELECT ${keys} FROM NEW.\"${table}\";"
+    done
+}
+
+# Get the quoted column names of a table of the local schema, separated by commas
+tableColumns() {
+    sqlite3 "${1}" "PRAGMA table_info(\"${2}\");" | awk -F'|' '{ printf "%s\"%s\"", (NR > 1 ? "," : ""), $2 }'
+}
+
+# Check that a fetched database has all tables to be read from it, each with the given prefixes
+# Views or triggers under these names are rejected: reading from them could run functions of
+# the sqlite3 shell, e.g. writefile()
+checkTables() {
+    local file="${1}" prefix entry names=""
+    shift
+    for prefix in "$@"; do
+        for entry in "${syncTables[@]}"; do
+            names+="${names:+,}'${prefix}${entry%%:*}'"
+        done
+    done
+    [[ "$(sqlite3 "${file}" "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN (${names});" 2> /dev/null)" == "$(( ${#syncTables[@]} * $# ))" ]]
+}
+
+publishFunc() {
+    local dir="${1}" version schema build tmpFile delta="" full line number files=()
+
+    if [[ -z "${dir}" ]]; then
+        echo -e "  ${CROSS} No directory specified"
+        exit 1
+    fi
+    mkdir -p "${dir}" || exit 1
+
+    version=1
+    if [[ -r "${syncBaseFile}" ]]; then
+        version=$(( $(sqlite3 "${syncBaseFile}" "SELECT IFNULL((SELECT value FROM info WHERE property = 'sync_version'), 0);") + 1 ))
+    fi
+    schema="$(sqlite3 "${gravityDBfile}" "SELECT value FROM info WHERE property = 'version';")"
+
+    # Take a consistent copy of the database, writers are not blocked for the whole publication
+    build="${piholeDir}/gravity_sync_${version}.db"
+    rm -f "${build}"
+    if ! lock_gravityDB sqlite3 "${gravityDBfile}" ".backup '${build}'" || \
+       ! sqlite3 "${build}" "INSERT OR REPLACE INTO info (property,value) VALUES ('sync_version',${version});" > /dev/null; then
+        echo -e "  ${CROSS} Unable to copy ${gravityDBfile}"
+        rm -f "${build}"
+        exit 1
+    fi
+
+    echo -ne "  ${INFO} Publishing build ${version}..."
+    # Deltas can only be applied to a database with the same schema
+    if [[ -r "${syncBaseFile}" ]] && [[ "$(sqlite3 "${syncBaseFile}" "SELECT value FROM info WHERE property = 'version';")" == "${schema}" ]]; then
+        delta="delta-${version}.db.gz"
+        tmpFile="$(mktemp -p "${dir}" "${delta}.XXXXX")"
+        rm -f "${build}.delta"
+        if ! { echo "ATTACH DATABASE '${syncBaseFile}' AS OLD;"
+               echo "ATTACH DATABASE '${build}' AS NEW;"
+               echo "ATTACH DATABASE '${build}.delta' AS DELTA;"
+               deltaQuery
+             } | sqlite3 -bail ":memory:" || ! gzip -c "${build}.delta" > "${tmpFile}"; then
+            echo -e "${OVER}  ${CROSS} Unable to compute the changes since build $(( version - 1 ))"
+            rm -f "${tmpFile}" "${build}" "${build}.delta"
+            exit 1
+        fi
+        rm -f "${build}.delta"
+        mv -f "${tmpFile}" "${dir}/${delta}"
+    fi
+
+    full="gravity-${version}.db.gz"
+    tmpFile="$(mktemp -p "${dir}" "${full}.XXXXX")"
+    gzip -c "${build}" > "${tmpFile}" && mv -f "${tmpFile}" "${dir}/${full}"
+    mv -f "${build}" "${syncBaseFile}"
+
+    # Remove deltas which are no longer announced and previous complete builds
+    for line in "${dir}"/delta-*.gz "${dir}"/gravity-*.db.gz; do
+        [[ -e "${line}" ]] || continue
+        line="${line##*/}"
+        case "${line}" in
+            "${full}"     ) ;;
+            delta-*.db.gz )
+                line="${line#delta-}"
+                if [[ "${line%.db.gz}" -le $(( version - syncDeltas )) ]]; then
+                    rm -f "${dir}/delta-${line}"
+                fi;;
+            *             ) rm -f "${dir:?}/${line}";;
+        esac
+    done
+
+    # Write the manifest last, followers only see complete builds
+    tmpFile="$(mktemp -p "${dir}" "manifest.XXXXX")"
+    {
+        echo "version ${version}"
+        echo "schema ${schema}"
+        echo "full ${full} $(sha256sum "${dir}/${full}" | cut -d' ' -f1)"
+        for line in "${dir}"/delta-*.db.gz; do
+            [[ -e "${line}" ]] || continue
+            line="${line##*/}"
+            files+=("${line}")
+        done
+        for line in "${files[@]}"; do
+            number="${line#delta-}"
+            echo "delta ${number%.db.gz} ${line} $(sha256sum "${dir}/${line}" | cut -d' ' -f1)"
+        done | sort -n -k2
+    } > "${tmpFile}"
+    chmod 644 "${tmpFile}" "${dir}"/*.gz
+    if [[ -n "${SYNC_SIGNING_KEY:-}" ]]; then
+        if ! openssl dgst -sha256 -sign "${SYNC_SIGNING_KEY}" -out "${tmpFile}.sig" "${tmpFile}"; then
+            echo -e "${OVER}  ${CROSS} Unable to sign the manifest with ${SYNC_SIGNING_KEY}"
+            rm -f "${tmpFile}" "${tmpFile}.sig"
+            exit 1
+        fi
+        chmod 644 "${tmpFile}.sig"
+        mv -f "${tmpFile}.sig" "${dir}/manifest.sig"
+    fi
+    mv -f "${tmpFile}" "${dir}/manifest"
+    echo -e "${OVER}  ${TICK} Published build ${version}${delta:+ (with changes since build $(( version - 1 )))}"
+}
+
+# Copy a published file from a directory or an HTTPS endpoint
+fetch() {
+    local source="${1}" file="${2}" target="${3}"
+    if [[ "${source}" == https://* ]]; then
+        curl -s -f -L --proto =https --proto-redir =https --connect-timeout 10 -o "${target}" "${source%/}/${file}"
+    else
+        cp "${source%/}/${file}" "${target}"
+    fi
+}
+
+# Fetch a published file and verify its checksum
+fetchVerified() {
+    local source="${1}" file="${2}" sum="${3}" target="${4}"
+    if ! fetch "${source}" "${file}" "${target}"; then
+        echo -e "  ${CROSS} Unable to fetch ${file} from ${source}"
+        return 1
+    fi
+    if [[ "$(sha256sum "${target}" | cut -d' ' -f1)" != "${sum}" ]]; then
+        echo -e "  ${CROSS} Checksum mismatch for ${file}"
+        return 1
+    fi
+}
+
+# Apply the deltas to the local database in a single transaction
+applyDeltas() {
+    local files=("$@") file n entry table keys key join output status
+    local -A columns
+
+    for entry in "${syncTables[@]}"; do
+        columns[${entry%%:*}]="$(tableColumns "${gravityDBfile}" "${entry%%:*}")"
+    done
+
+    output=$( {
+        echo ".timeout 30000"
+        # Databases cannot be attached within a transaction
+        for (( n=1; n<=${#files[@]}; n++ )); do
+            echo "ATTACH DATABASE '${files[n-1]}' AS DELTA${n};"
+        done
+        echo "BEGIN TRANSACTION;"
+        # Triggers would add rows (e.g. default group assignments) the leader does not have
+        sqlite3 "${gravityDBfile}" "SELECT 'DROP TRIGGER \"' || name || '\";' FROM sqlite_master WHERE type = 'trigger';"
+        for (( n=1; n<=${#files[@]}; n++ )); do
+            for entry in "${syncTables[@]}"; do
+                table="${entry%%:*}"
+                keys="${entry#*:}"
+                join=""
+                for key in ${keys//,/ }; do
+                    join+="${join:+ AND }old.\"${key}\" = removed.\"${key}\""
+                done
+                echo "DELETE FROM \"${table}\" WHERE rowid IN (SELECT old.rowid FROM DELTA${n}.\"removed_${table}\" AS removed JOIN main.\"${table}\" AS old ON ${join});"
+                echo "INSERT OR REPLACE INTO \"${table}\" (${columns[${table}]}) SELECT ${columns[${table}]} FROM DELTA${n}.\"${table}\";"
+            done
+        done
+        sqlite3 "${gravityDBfile}" "SELECT sql || ';' FROM sqlite_master WHERE type = 'trigger';"
+        echo "COMMIT;"
+    } | lock_gravityDB sqlite3 -bail "${gravityDBfile}" 2>&1 )
+    status="$?"
+
+    if [[ "${status}" -ne 0 ]]; then
+        echo -e "  ${CROSS} Unable to apply changes, the database has not been modified\\n  ${output}"
+        return 1
+    fi
+}
+
+# Replace the local database with a complete build
+# Its rows are copied into a new database created from the local schema, which has to be
+# the same version: the views and triggers of the build are not used
+replaceDatabase() {
+    local build="${1}" schema entry table columns output status
+
+    if [[ "$(sqlite3 "${build}" "PRAGMA quick_check;" 2> /dev/null)" != "ok" ]] || ! checkTables "${build}" ""; then
+        echo -e "  ${CROSS} Published database is corrupt"
+        return 1
+    fi
+
+    rm -f "${gravityTEMPfile}"
+    if ! sqlite3 "${gravityTEMPfile}" < "${gravityDBschema}"; then
+        echo -e "  ${CROSS} Unable to create ${gravityTEMPfile}"
+        rm -f "${gravityTEMPfile}"
+        return 1
+    fi
+    schema="$(sqlite3 "${gravityTEMPfile}" "SELECT value FROM info WHERE property = 'version';")"
+    if [[ "$(sqlite3 "${build}" "SELECT value FROM info WHERE property = 'version';")" != "${schema}" ]]; then
+        echo -e "  ${CROSS} Published database is not on version ${schema}, leader and followers need to run the same version of Pi-hole"
+        rm -f "${gravityTEMPfile}"
+        return 1
+    fi
+
+    output=$( {
+        echo "ATTACH DATABASE '${build}' AS BUILD;"
+        echo "BEGIN TRANSACTION;"
+        sqlite3 "${gravityTEMPfile}" "SELECT 'DROP TRIGGER \"' || name || '\";' FROM sqlite_master WHERE type = 'trigger';"
+        for entry in "${syncTables[@]}"; do
+            table="${entry%%:*}"
+            columns="$(tableColumns "${gravityTEMPfile}" "${table}")"
+            echo "DELETE FROM \"${table}\";"
+            echo "INSERT INTO \"${table}\" (${columns}) SELECT ${columns} FROM BUILD.\"${table}\";"
+        done
+        sqlite3 "${gravityTEMPfile}" "SELECT sql || ';' FROM sqlite_master WHERE type = 'trigger';"
+        echo "CREATE INDEX idx_gravity ON gravity (domain, adlist_id);"
+        echo "COMMIT;"
+    } | sqlite3 -bail "${gravityTEMPfile}" 2>&1 )
+    status="$?"
+
+    if [[ "${status}" -ne 0 ]]; then
+        echo -e "  ${CROSS} Unable to copy the published database\\n  ${output}"
+        rm -f "${gravityTEMPfile}"
+        return 1
+    fi
+    # The journal mode is stored in the database file, readers never block behind a writer
+    sqlite3 "${gravityTEMPfile}" "PRAGMA journal_mode=WAL;" > /dev/null
+
+    acquire_gravityDB_lock || return 1
+    swap_gravityDB "${gravityTEMPfile}"
+    release_gravityDB_lock
+}
+
+pullFunc() {
+    local source="${1}" tmpDir key value file sum local_version local_schema
+    local latest="" schema="" full="" fullSum="" deltas=() files=() snapshotArgs=() n
+
+    if [[ -z "${source}" ]]; then
+        echo -e "  ${CROSS} No leader specified"
+        exit 1
+    fi
+    if [[ "${source}" == *://* ]] && [[ "${source}" != https://* ]]; then
+        echo -e "  ${CROSS} Leader ${source} has to be a directory or an https:// URL"
+        exit 1
+    fi
+
+    tmpDir="$(mktemp -d -p "/tmp" "pihole_sync.XXXXX")"
+    trap 'rm -rf "${tmpDir}"' EXIT
+
+    if ! fetch "${source}" "manifest" "${tmpDir}/manifest"; then
+        echo -e "  ${CROSS} Unable to fetch manifest from ${source}"
+        exit 1
+    fi
+    # The checksums of the manifest are only worth something if the manifest comes from the leader
+    if [[ -n "${SYNC_LEADER_KEY:-}" ]]; then
+        if ! fetch "${source}" "manifest.sig" "${tmpDir}/manifest.sig" || \
+           ! openssl dgst -sha256 -verify "${SYNC_LEADER_KEY}" -signature "${tmpDir}/manifest.sig" "${tmpDir}/manifest" &> /dev/null; then
+            echo -e "  ${CROSS} Unable to verify the signature of the manifest from ${source}"
+            exit 1
+        fi
+    fi
+    declare -A deltaFiles deltaSums
+    while read -r key value file sum; do
+        # File names are used as local paths
+        case "${key}" in
+            "version" ) latest="${value}";;
+            "schema"  ) schema="${value}";;
+            "full"    ) [[ "${value}" =~ ^gravity-[0-9]+\.db\.gz$ ]] && full="${value}" && fullSum="${file}";;
+            "delta"   ) [[ "${value}" =~ ^[0-9]+$ ]] && [[ "${file}" =~ ^delta-[0-9]+\.db\.gz$ ]] && deltaFiles[${value}]="${file}" && deltaSums[${value}]="${sum}";;
+        esac
+    done < "${tmpDir}/manifest"
+
+    if [[ ! "${latest}" =~ ^[0-9]+$ ]] || [[ -z "${full}" ]]; then
+        echo -e "  ${CROSS} Invalid manifest at ${source}"
+        exit 1
+    fi
+
+    if [[ -e "${gravityDBfile}" ]]; then
+        local_version="$(sqlite3 "${gravityDBfile}" "SELECT value FROM info WHERE property = 'sync_version';" 2> /dev/null)"
+        local_schema="$(sqlite3 "${gravityDBfile}" "SELECT value FROM info WHERE property = 'version';" 2> /dev/null)"
+    fi
+
+    if [[ "${local_version:-}" == "${latest}" ]]; then
+        echo -e "  ${INFO} Build ${latest} is already in use"
+        exit 0
+    fi
+
+    # Deltas can be used if all of them since the local build are available
+    if [[ "${local_version:-}" =~ ^[0-9]+$ ]] && [[ "${local_version}" -lt "${latest}" ]] && [[ "${local_schema}" == "${schema}" ]]; then
+        for (( n=local_version+1; n<=latest; n++ )); do
+            if [[ -z "${deltaFiles[${n}]:-}" ]]; then
+                deltas=()
+                break
+            fi
+            deltas+=("${n}")
+        done
+    fi
+
+    if [[ "${#deltas[@]}" -gt 0 ]]; then
+        echo -e "  ${INFO} Updating from build ${local_version} to build ${latest} (${#deltas[@]} delta(s))"
+        for n in "${deltas[@]}"; do
+            file="${tmpDir}/${deltaFiles[${n}]}"
+            fetchVerified "${source}" "${deltaFiles[${n}]}" "${deltaSums[${n}]}" "${file}" || exit 1
+            if ! zcat "${file}" > "${file%.gz}" || ! checkTables "${file%.gz}" "" "removed_"; then
+                echo -e "  ${CROSS} Invalid delta ${deltaFiles[${n}]}"
+                exit 1
+            fi
+            files+=("${file%.gz}")
+        done
+        applyDeltas "${files[@]}" || exit 1
+    else
+        echo -e "  ${INFO} Replacing database with build ${latest}"
+        file="${tmpDir}/${full}"
+        fetchVerified "${source}" "${full}" "${fullSum}" "${file}" || exit 1
+        zcat "${file}" > "${file%.gz}" || exit 1
+        replaceDatabase "${file%.gz}" || exit 1
+    fi
+    echo -e "  ${TICK} Updated to build ${latest}"
+
+    # The snapshot has to match the database
+    if [[ "${GRAVITY_SNAPSHOT_BLOOM:-}" == true ]]; then
+        snapshotArgs+=("--bloom")
+    fi
+    /opt/pihole/piholeSnapshot.sh build "${snapshotArgs[@]}"
+    checkpoint_gravityDB "${gravityDBfile}"
+    pihole restartdns reload-lists
+    remove_old_gravityDB
+}
+
+statusFunc() {
+    local version
+    version="$(sqlite3 "${gravityDBfile}" "SELECT value FROM info WHERE property = 'sync_version';" 2> /dev/null)"
+    if [[ -n "${version}" ]]; then
+        echo -e "  ${INFO} Gravity database is on build ${version}"
+    else
+        echo -e "  ${INFO} Gravity database has not been synchronized"
+    fi
+    if [[ -r "${syncBaseFile}" ]]; then
+        echo -e "  ${INFO} Last published build: $(sqlite3 "${syncBaseFile}" "SELECT value FROM info WHERE property = 'sync_version';")"
+    fi
+}
+
+if [[ -r "${piholeDir}/setupVars.conf" ]]; then
+    source "${piholeDir}/setupVars.conf"
+fi
+
+case "${1}" in
+    "publish"       ) publishFunc "${2:-${SYNC_PUBLISH_DIR:-}}";;
+    "pull"          ) pullFunc "${2:-${SYNC_LEADER:-}}";;
+    "status"        ) statusFunc;;
+    *               ) helpFunc;;
+esac
@@ -12,7 +12,9 @@
 # Globals
 piholeDir="/etc/pihole"
 gravityDBfile="${piholeDir}/gravity.db"
-options="$*"
+options=""
+clients=""
+groups=""
 all=""
 exact=""
 blockpage=""
@@ -21,6 +23,16 @@ matchType="match"
 colfile="/opt/pihole/COL_TABLE"
 source "${colfile}"
 
+# Client and group selection take an argument, all other options are handled below
+while (( "$#" )); do
+    case "${1}" in
+        "-client" ) clients="${2}"; shift;;
+        "-group"  ) groups="${2}"; shift;;
+        *         ) options="${options:+${options} }${1}";;
+    esac
+    shift
+done
+
 # Scan an array of files for matching strings
 scanList(){
     # Escape full stops
@@ -56,6 +68,11 @@ Query the adlists for a specified domain
 Options:
   -exact              Search the block lists for exact domain matches
   -all                Return all query matches within a block list
+  -client <ip>        Check whether the domain is blocked for this client
+                        Add more clients separated by commas, or use '-' to read them from stdin
+                        Client entries given as MAC addresses, hostnames or interfaces are skipped
+  -group <group>      Check whether the domain is blocked for this group (ID or name)
+                        Add more groups separated by commas
   -h, --help          Show this help dialog"
   exit 0
 fi
@@ -147,6 +164,45 @@ scanDatabaseTable() {
     done
 }
 
+scanWildcardDatabaseTable() {
+    local domain list type suffix suffixes result results extra
+    domain="${1}"
+    list="${2}"
+    type="${3:-}"
+
+    # A wildcard entry matches the domain itself and all of its subdomains, so only the
+    # domain and its parent domains need to be looked up (using the index on domain and type)
+    suffix="${domain//\'/\'\'}"
+    suffixes="'${suffix}'"
+    while [[ "${suffix}" == *.* ]]; do
+        suffix="${suffix#*.}"
+        suffixes="${suffixes},'${suffix}'"
+    done
+
+    result="$(sqlite3 "${gravityDBfile}" "SELECT domain,enabled FROM domainlist WHERE type = ${type} AND domain IN (${suffixes}) ORDER BY length(domain) DESC;" 2> /dev/null)"
+    if [[ -z "${result}" ]]; then
+        return
+    fi
+
+    if [[ -n "${blockpage}" ]]; then
+        echo "π .wildcard"
+        exit 0
+    fi
+
+    # Set the wildcard match flag
+    wcMatch=true
+    echo " ${matchType^} found in ${COL_BOLD}wildcard ${list}${COL_NC}"
+    mapfile -t results <<< "${result}"
+    for result in "${results[@]}"; do
+        if [[ "${result#*|}" == "0" ]]; then
+            extra=" (disabled)"
+        else
+            extra=""
+        fi
+        echo "   ${COL_BOLD}${result/|*}${COL_NC}${extra}"
+    done
+}
+
 scanRegexDatabaseTable() {
     local domain list
     domain="${1}"
@@ -187,10 +243,245 @@ scanRegexDatabaseTable() {
     fi
 }
 
+# Convert an IPv4 or IPv6 address into a string of 32 or 128 bits
+ipToBits() {
+    local ip="${1}" head tail part parts=() missing bits="" i value
+    if [[ "${ip}" == *:* ]]; then
+        # Expand "::" into the number of missing zero groups
+        if [[ "${ip}" == *::* ]]; then
+            head="${ip%%::*}"
+            tail="${ip#*::}"
+            IFS=':' read -r -a parts <<< "${head}"
+            missing=$(( 8 - ${#parts[@]} ))
+            IFS=':' read -r -a part <<< "${tail}"
+            missing=$(( missing - ${#part[@]} ))
+            for (( i=0; i<missing; i++ )); do
+                parts+=("0")
+            done
+            parts+=("${part[@]}")
+        else
+            IFS=':' read -r -a parts <<< "${ip}"
+        fi
+        [[ "${#parts[@]}" -eq 8 ]] || return 1
+        for part in "${parts[@]}"; do
+            [[ "${part}" =~ ^[0-9a-fA-F]{1,4}$ ]] || return 1
+            value=$(( 16#${part} ))
+            for (( i=15; i>=0; i-- )); do
+                bits+=$(( (value >> i) & 1 ))
+            done
+        done
+    else
+        IFS='.' read -r -a parts <<< "${ip}"
+        [[ "${#parts[@]}" -eq 4 ]] || return 1
+        for part in "${parts[@]}"; do
+            # Force base 10, octets with a leading zero would be read as octal otherwise
+            [[ "${part}" =~ ^[0-9]{1,3}$ ]] && (( 10#${part} <= 255 )) || return 1
+            for (( i=7; i>=0; i-- )); do
+                bits+=$(( (10#${part} >> i) & 1 ))
+            done
+        done
+    fi
+    echo "${bits}"
+}
+
+# Load all client entries and groups once, so that any number of clients can be resolved
+# without further database queries
+declare -A groupNames enabledGroups clientCache resultCache
+clientEntries=()
+clientPrefixes=()
+clientGroups=()
+skippedClients=()
+loadClients() {
+    local id name enabled ip ids bits prefix
+
+    while IFS='|' read -r id name enabled; do
+        groupNames[${id}]="${name}"
+        if [[ "${enabled}" -eq 1 ]]; then
+            enabledGroups[${id}]=true
+        fi
+    done < <(sqlite3 "${gravityDBfile}" "SELECT id,name,enabled FROM \"group\";" 2> /dev/null)
+
+    while IFS='|' read -r ip ids; do
+        # Only addresses and subnets in CIDR notation can be evaluated here
+        # MAC addresses, hostnames and interfaces are resolved by FTL at query time
+        if ! bits="$(ipToBits "${ip%/*}")"; then
+            skippedClients+=("${ip}")
+            continue
+        fi
+        prefix="${#bits}"
+        if [[ "${ip}" == */* ]]; then
+            prefix="${ip#*/}"
+        fi
+        clientEntries+=("${bits:0:${prefix}}")
+        clientPrefixes+=("${prefix}")
+        clientGroups+=("${ids}")
+    done < <(sqlite3 "${gravityDBfile}" "SELECT client.ip, group_concat(client_by_group.group_id) FROM client
+                                          LEFT JOIN client_by_group ON client_by_group.client_id = client.id
+                                          GROUP BY client.id;" 2> /dev/null)
+}
+
+# Get the enabled groups of a client: those of the most specific matching client
+# entry, or the default group if no entry matches
+getClientGroups() {
+    local ip="${1}" bits i best=-1 bestPrefix=-1 id ids=()
+
+    if [[ -n "${clientCache[${ip}]+x}" ]]; then
+        echo "${clientCache[${ip}]}"
+        return
+    fi
+
+    bits="$(ipToBits "${ip}")" || return 1
+    for i in "${!clientEntries[@]}"; do
+        if [[ "${bits:0:${clientPrefixes[$i]}}" == "${clientEntries[$i]}" ]] && [[ "${clientPrefixes[$i]}" -gt "${bestPrefix}" ]]; then
+            best="${i}"
+            bestPrefix="${clientPrefixes[$i]}"
+        fi
+    done
+
+    if [[ "${best}" -ge 0 ]]; then
+        IFS=',' read -r -a ids <<< "${clientGroups[$best]}"
+    else
+        ids=("0")
+    fi
+    clientCache[${ip}]=""
+    for id in "${ids[@]}"; do
+        if [[ -n "${enabledGroups[${id}]:-}" ]]; then
+            clientCache[${ip}]+="${clientCache[${ip}]:+,}${id}"
+        fi
+    done
+    echo "${clientCache[${ip}]}"
+}
+
+# Determine whether the domain is blocked for a set of groups
+# The result is computed only once per group set, as many clients usually share the same groups
+evaluateGroups() {
+    local domain="${1}" groupset="${2}" esc_domain suffix suffixes kind match result="" whitelisted="" blacklisted=""
+
+    if [[ -n "${resultCache[${groupset}]+x}" ]]; then
+        echo "${resultCache[${groupset}]}"
+        return
+    fi
+
+    if [[ -n "${groupset}" ]]; then
+        esc_domain="${domain//\'/\'\'}"
+        suffix="${esc_domain}"
+        suffixes="'${suffix}'"
+        while [[ "${suffix}" == *.* ]]; do
+            suffix="${suffix#*.}"
+            suffixes="${suffixes},'${suffix}'"
+        done
+
+        # Whitelist entries take precedence over any blocking entry
+        while IFS='|' read -r kind match; do
+            case "${kind}" in
+                "W" ) whitelisted="${whitelisted:-exact whitelist (${match})}";;
+                "w" ) whitelisted="${whitelisted:-wildcard whitelist (${match})}";;
+                "R" ) [[ "${domain}" =~ ${match} ]] && whitelisted="${whitelisted:-regex whitelist (${match})}";;
+                "B" ) blacklisted="${blacklisted:-exact blacklist (${match})}";;
+                "b" ) blacklisted="${blacklisted:-wildcard blacklist (${match})}";;
+                "r" ) [[ "${domain}" =~ ${match} ]] && blacklisted="${blacklisted:-regex blacklist (${match})}";;
+                "G" ) blacklisted="${blacklisted:-gravity (${match})}";;
+            esac
+        done < <(sqlite3 "${gravityDBfile}" "SELECT 'W', domain FROM vw_whitelist WHERE domain = '${esc_domain}' AND group_id IN (${groupset})
+            UNION ALL SELECT 'w', domain FROM vw_wildcard_whitelist WHERE domain IN (${suffixes}) AND group_id IN (${groupset})
+            UNION ALL SELECT 'R', domain FROM vw_regex_whitelist WHERE group_id IN (${groupset})
+            UNION ALL SELECT 'B', domain FROM vw_blacklist WHERE domain = '${esc_domain}' AND group_id IN (${groupset})
+            UNION ALL SELECT 'b', domain FROM vw_wildcard_blacklist WHERE domain IN (${suffixes}) AND group_id IN (${groupset})
+            UNION ALL SELECT 'r', domain FROM vw_regex_blacklist WHERE group_id IN (${groupset})
+            UNION ALL SELECT 'G', address FROM gravity JOIN adlist ON adlist.id = gravity.adlist_id
+                JOIN adlist_by_group ON adlist_by_group.adlist_id = gravity.adlist_id
+                WHERE gravity.domain = '${esc_domain}' AND adlist.enabled = 1 AND adlist_by_group.group_id IN (${groupset});" 2> /dev/null)
+    fi
+
+    if [[ -n "${whitelisted}" ]]; then
+        result="allowed by ${whitelisted}"
+    elif [[ -n "${blacklisted}" ]]; then
+        result="blocked by ${blacklisted}"
+    else
+        result="not blocked"
+    fi
+    resultCache[${groupset}]="${result}"
+    echo "${result}"
+}
+
+# Print the group names of a comma separated list of group IDs
+groupNameList() {
+    local id ids=() names=()
+    IFS=',' read -r -a ids <<< "${1}"
+    for id in "${ids[@]}"; do
+        names+=("${groupNames[${id}]:-${id}}")
+    done
+    if [[ "${#names[@]}" -eq 0 ]]; then
+        echo "no enabled group"
+    else
+        (IFS=','; echo "${names[*]}")
+    fi
+}
+
+printEvaluation() {
+    local name="${1}" groupset="${2}" result="${3}"
+    if [[ "${result}" == "blocked"* ]]; then
+        echo -e "  ${CROSS} ${name} ($(groupNameList "${groupset}")): ${result}"
+    else
+        echo -e "  ${TICK} ${name} ($(groupNameList "${groupset}")): ${result}"
+    fi
+}
+
+if [[ -n "${clients}" ]] || [[ -n "${groups}" ]]; then
+    loadClients
+    domainQuery="${domainQuery,,}"
+    echo -e "  ${INFO} Evaluating ${COL_BOLD}${domainQuery}${COL_NC}"
+
+    if [[ -n "${groups}" ]]; then
+        groupset=""
+        IFS=',' read -r -a selection <<< "${groups}"
+        for group in "${selection[@]}"; do
+            for id in "${!groupNames[@]}"; do
+                if [[ "${id}" == "${group}" ]] || [[ "${groupNames[${id}]}" == "${group}" ]]; then
+                    [[ -n "${enabledGroups[${id}]:-}" ]] && groupset+="${groupset:+,}${id}"
+                    continue 2
+                fi
+            done
+            echo -e "  ${CROSS} Group ${group} does not exist"
+            exit 1
+        done
+        printEvaluation "group(s) ${groups}" "${groupset}" "$(evaluateGroups "${domainQuery}" "${groupset}")"
+    fi
+
+    if [[ -n "${clients}" ]]; then
+        if [[ "${clients}" == "-" ]]; then
+            mapfile -t selection
+        else
+            IFS=',' read -r -a selection <<< "${clients}"
+        fi
+        if [[ "${#skippedClients[@]}" -gt 0 ]]; then
+            echo -e "  ${INFO} Skipped ${#skippedClients[@]} client entries that are not IP addresses or subnets: $(IFS=','; echo "${skippedClients[*]}")"
+        fi
+        for client in "${selection[@]}"; do
+            [[ -z "${client}" ]] && continue
+            if ! groupset="$(getClientGroups "${client}")"; then
+                echo -e "  ${CROSS} ${client} is not a valid IP address"
+                continue
+            fi
+            # Keep the caches of this shell filled, command substitutions run in subshells
+            clientCache[${client}]="${groupset}"
+            if [[ -z "${resultCache[${groupset}]+x}" ]]; then
+                resultCache[${groupset}]="$(evaluateGroups "${domainQuery}" "${groupset}")"
+            fi
+            printEvaluation "${client}" "${groupset}" "${resultCache[${groupset}]}"
+        done
+    fi
+    exit 0
+fi
+
 # Scan Whitelist and Blacklist
 scanDatabaseTable "${domainQuery}" "whitelist" "0"
 scanDatabaseTable "${domainQuery}" "blacklist" "1"
 
+# Scan Wildcard table
+scanWildcardDatabaseTable "${domainQuery}" "whitelist" "4"
+scanWildcardDatabaseTable "${domainQuery}" "blacklist" "5"
+
 # Scan Regex table
 scanRegexDatabaseTable "${domainQuery}" "whitelist" "2"
 scanRegexDatabaseTable "${domainQuery}" "blacklist" "3"
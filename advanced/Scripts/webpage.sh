@@ -20,6 +20,10 @@ readonly dnscustomcnamefile="/etc/dnsmasq.d/05-pihole-custom-cname.conf"
 
 readonly gravityDBfile="/etc/pihole/gravity.db"
 
+# Batch mode: signals requested by the applied changes, sent once at the end
+batchMode=false
+declare -A batchSignals
+
 # Source install script for ${setupVars}, ${PI_HOLE_BIN_DIR} and valid_ip()
 readonly PI_HOLE_FILES_DIR="/etc/.pihole"
 # shellcheck disable=SC2034  # used in basic-install
@@ -31,6 +35,9 @@ if [[ -f ${coltable} ]]; then
     source ${coltable}
 fi
 
+# Source gravity database helpers for lock_gravityDB()
+source "${PI_HOLE_FILES_DIR}/advanced/Scripts/database_migration/gravity-db.sh"
+
 helpFunc() {
     echo "Usage: pihole -a [options]
 Example: pihole -a -p password
@@ -44,7 +51,15 @@ Options:
   -e, email           Set an administrative contact address for the Block Page
   -h, --help          Show this help dialog
   -i, interface       Specify dnsmasq's interface listening behavior
-  -l, privacylevel    Set privacy level (0 = lowest, 3 = highest)"
+  -l, privacylevel    Set privacy level (0 = lowest, 3 = highest)
+  backup              Back up groups, domains, adlists and clients
+                        Add '-h' for more info on backup usage
+  restore             Restore a backup made with 'backup'
+                        Add '-h' for more info on restore usage
+  batch               Apply many changes from a file or stdin with a
+                        single DNS reload
+  adlist interval     Set the refresh interval of an adlist
+                        (seconds, Nh, Nd, adaptive or off)"
     exit 0
 }
 
@@ -353,8 +368,17 @@ Reboot() {
     nohup bash -c "sleep 5; reboot" &> /dev/null </dev/null &
 }
 
+# Restart FTL, or send it the lighter signal given as argument ("reload" flushes the
+# cache and re-reads the hosts files, "reload-lists" re-reads the gravity database)
+# In batch mode the request is only recorded and ApplyBatchSignals() acts on it once
 RestartDNS() {
-    "${PI_HOLE_BIN_DIR}"/pihole restartdns
+    local svcOption="${1:-restart}"
+
+    if [[ "${batchMode}" == true ]]; then
+        batchSignals[${svcOption}]=true
+        return 0
+    fi
+    "${PI_HOLE_BIN_DIR}"/pihole restartdns "${svcOption}"
 }
 
 SetQueryLogOptions() {
@@ -509,13 +533,15 @@ CustomizeAdLists() {
 
     if CheckUrl "${address}"; then
         if [[ "${args[2]}" == "enable" ]]; then
-            sqlite3 "${gravityDBfile}" "UPDATE adlist SET enabled = 1 WHERE address = '${address}'"
+            lock_gravityDB sqlite3 "${gravityDBfile}" "UPDATE adlist SET enabled = 1 WHERE address = '${address}'"
         elif [[ "${args[2]}" == "disable" ]]; then
-            sqlite3 "${gravityDBfile}" "UPDATE adlist SET enabled = 0 WHERE address = '${address}'"
+            lock_gravityDB sqlite3 "${gravityDBfile}" "UPDATE adlist SET enabled = 0 WHERE address = '${address}'"
         elif [[ "${args[2]}" == "add" ]]; then
-            sqlite3 "${gravityDBfile}" "INSERT OR IGNORE INTO adlist (address, comment) VALUES ('${address}', '${comment}')"
+            lock_gravityDB sqlite3 "${gravityDBfile}" "INSERT OR IGNORE INTO adlist (address, comment) VALUES ('${address}', '${comment}')"
         elif [[ "${args[2]}" == "del" ]]; then
-            sqlite3 "${gravityDBfile}" "DELETE FROM adlist WHERE address = '${address}'"
+            lock_gravityDB sqlite3 "${gravityDBfile}" "DELETE FROM adlist WHERE address = '${address}'"
+        elif [[ "${args[2]}" == "interval" ]]; then
+            SetAdListInterval "${address}" "${args[4]}"
         else
             echo "Not permitted"
             return 1
@@ -526,6 +552,29 @@ CustomizeAdLists() {
     fi
 }
 
+# Set how often "pihole -g --due" refreshes an adlist: a fixed interval in seconds
+# (optionally with an h or d suffix), "adaptive" to let gravity adjust the interval
+# to how often the list changes, or "off" to refresh it only in full gravity runs
+SetAdListInterval() {
+    local address="${1}" interval="${2}"
+
+    if [[ "${interval}" == "adaptive" ]]; then
+        lock_gravityDB sqlite3 "${gravityDBfile}" "UPDATE adlist SET adaptive = 1, refresh_interval = IFNULL(refresh_interval, 86400) WHERE address = '${address}'"
+    elif [[ "${interval}" == "off" ]]; then
+        lock_gravityDB sqlite3 "${gravityDBfile}" "UPDATE adlist SET adaptive = 0, refresh_interval = NULL WHERE address = '${address}'"
+    elif [[ "${interval}" =~ ^([1-9][0-9]*)([hd]?)$ ]]; then
+        interval="${BASH_REMATCH[1]}"
+        case "${BASH_REMATCH[2]}" in
+            "h" ) interval=$((interval * 3600));;
+            "d" ) interval=$((interval * 86400));;
+        esac
+        lock_gravityDB sqlite3 "${gravityDBfile}" "UPDATE adlist SET adaptive = 0, refresh_interval = ${interval} WHERE address = '${address}'"
+    else
+        echo "Invalid interval"
+        return 1
+    fi
+}
+
 SetPrivacyMode() {
     if [[ "${args[2]}" == "true" ]]; then
         change_setting "API_PRIVACY_MODE" "true"
@@ -640,6 +689,183 @@ Teleporter() {
     php /var/www/html/admin/scripts/pi-hole/php/teleporter.php > "pi-hole-teleporter_${datetimestamp}.tar.gz"
 }
 
+# Configuration tables of the gravity database restored by RestoreConfig()
+# The linking tables have to follow the tables they link
+readonly backupTables=("group" "domainlist" "adlist" "client" "domainlist_by_group" "adlist_by_group" "client_by_group" "domain_audit"
+                       "adlist_history" "adlist_history_daily")
+# Tables derived from the adlists, they are skipped with --skip-gravity
+readonly backupGravityTables=("gravity" "adlist_stats" "adlist_overlap" "group_stats")
+
+# Back up the gravity database into a compressed archive (or to stdout with "-")
+# SQLite's online backup API copies a consistent state of the database while FTL keeps reading
+# and without holding the writer lock. With --skip-gravity the domains of the adlists are left out,
+# they are rebuilt from the cached lists on restore
+BackupConfig() {
+    local target="" skipGravity=false arg tmpDir table
+
+    for arg in "${args[@]:2}"; do
+        case "${arg}" in
+            "--skip-gravity" ) skipGravity=true;;
+            "-h" | "--help"  )
+                echo "Usage: pihole -a backup [--skip-gravity] [file|-]
+Example: 'pihole -a backup --skip-gravity', or 'pihole -a backup - | ssh host pihole -a restore -'
+Back up groups, domains, adlists and clients into a compressed archive
+
+Options:
+  --skip-gravity      Leave out the domains of the adlists (they are rebuilt
+                      from the cached lists on restore)
+  -h, --help          Show this help dialog"
+                exit 0;;
+            * ) target="${arg}";;
+        esac
+    done
+    if [[ -z "${target}" ]]; then
+        target="pi-hole-backup_$(date "+%Y-%m-%d_%H-%M-%S").tar.gz"
+    fi
+
+    tmpDir="$(mktemp -d -p "/tmp" "pihole_backup.XXXXX")"
+    if ! printf ".timeout 30000\\n.backup '%s'\\n" "${tmpDir}/gravity.db" | sqlite3 -bail "${gravityDBfile}"; then
+        echo -e "  ${CROSS} Unable to back up ${gravityDBfile}" >&2
+        rm -rf "${tmpDir}"
+        return 1
+    fi
+
+    if [[ "${skipGravity}" == true ]]; then
+        # The copy is private, no lock needed. VACUUM returns the space to keep the archive small
+        for table in "${backupGravityTables[@]}"; do
+            sqlite3 "${tmpDir}/gravity.db" "DELETE FROM ${table};"
+        done
+        sqlite3 "${tmpDir}/gravity.db" "VACUUM;"
+    fi
+
+    if [[ "${target}" == "-" ]]; then
+        tar -czf - -C "${tmpDir}" gravity.db
+    else
+        tar -czf "${target}" -C "${tmpDir}" gravity.db
+        echo -e "  ${TICK} Backup written to ${target}"
+    fi
+    rm -rf "${tmpDir}"
+}
+
+# Rebuild the gravity table from the cached adlists (/etc/pihole/list.<id>.<host>.domains)
+# Adlists without a cached copy stay empty until the next "pihole -g"
+RebuildGravityFromCache() {
+    local id address host cache target missing=0
+
+    target="$(mktemp -p "/tmp" --suffix=".gravity")"
+    while IFS='|' read -r id address; do
+        if [[ -z "${id}" ]]; then
+            continue
+        fi
+        # Host part of the address as used by gravity for the name of the cached file
+        host="$(awk -F '[/:]' '{ gsub(/(.*:\/\/|.*:.*@)/, "", $0); if(length($1)>0){print $1} else {print "local"} }' <<< "${address}")"
+        cache="${PI_HOLE_CONFIG_DIR}/list.${id}.${host}.domains"
+        if [[ -r "${cache}" ]]; then
+            sed -e "/[^a-zA-Z0-9.\_-]/d;s/$/,${id}/;/.$/a\\" "${cache}" >> "${target}"
+        else
+            missing=$((missing+1))
+        fi
+    done <<< "$(sqlite3 "${gravityDBfile}" "SELECT id, address FROM vw_adlist;")"
+
+    printf ".timeout 30000\\nBEGIN TRANSACTION;\\nDELETE FROM gravity;\\n.mode csv\\n.import \"%s\" gravity\\nCOMMIT;\\n" "${target}" | lock_gravityDB sqlite3 "${gravityDBfile}"
+    rm -f "${target}"
+
+    if [[ "${missing}" -gt 0 ]]; then
+        echo -e "  ${INFO} ${missing} adlist(s) have no cached copy, run 'pihole -g' to download them"
+    fi
+}
+
+# Restore an archive written by BackupConfig() (or read it from stdin with "-")
+# Older backups are upgraded to the current database version first. All tables are
+# replaced within a single transaction, FTL sees either the old or the restored state
+RestoreConfig() {
+    local source="" archive skipGravity=false arg tmpDir table version backupVersion hasGravity sql
+
+    for arg in "${args[@]:2}"; do
+        case "${arg}" in
+            "--skip-gravity" ) skipGravity=true;;
+            "-h" | "--help"  )
+                echo "Usage: pihole -a restore [--skip-gravity] <file|->
+Example: 'pihole -a restore pi-hole-backup.tar.gz'
+Restore groups, domains, adlists and clients from an archive written by 'pihole -a backup'
+
+Options:
+  --skip-gravity      Do not restore the domains of the adlists, rebuild them
+                      from the cached lists instead
+  -h, --help          Show this help dialog"
+                exit 0;;
+            * ) source="${arg}";;
+        esac
+    done
+    if [[ -z "${source}" ]]; then
+        echo -e "  ${CROSS} No backup file given"
+        return 1
+    fi
+
+    tmpDir="$(mktemp -d -p "/tmp" "pihole_restore.XXXXX")"
+    archive="${source}"
+    if [[ "${source}" == "-" ]]; then
+        archive="/dev/stdin"
+    fi
+    if ! tar -xzf "${archive}" -C "${tmpDir}" gravity.db 2> /dev/null; then
+        echo -e "  ${CROSS} ${source} is not a Pi-hole backup"
+        rm -rf "${tmpDir}"
+        return 1
+    fi
+
+    # Bring the backup to the version of the current database
+    version="$(sqlite3 "${gravityDBfile}" "SELECT value FROM info WHERE property = 'version';")"
+    backupVersion="$(sqlite3 "${tmpDir}/gravity.db" "SELECT value FROM info WHERE property = 'version';")"
+    if [[ "${backupVersion}" -gt "${version}" ]]; then
+        echo -e "  ${CROSS} The backup is newer (version ${backupVersion}) than this Pi-hole (version ${version})"
+        rm -rf "${tmpDir}"
+        return 1
+    elif [[ "${backupVersion}" -lt "${version}" ]]; then
+        upgrade_gravityDB "${tmpDir}/gravity.db" "${tmpDir}"
+    fi
+
+    # Backups made with --skip-gravity have no domains to restore
+    hasGravity="$(sqlite3 "${tmpDir}/gravity.db" "SELECT EXISTS (SELECT 1 FROM gravity);")"
+    if [[ "${hasGravity}" != "1" ]]; then
+        skipGravity=true
+    fi
+
+    # Deleting from the tables fires the triggers removing the group assignments and
+    # re-adding the default group, the assignments of the backup replace them afterwards
+    sql=".timeout 30000\\nATTACH DATABASE '${tmpDir}/gravity.db' AS backup;\\nBEGIN TRANSACTION;\\n"
+    for table in "${backupTables[@]}"; do
+        sql+="DELETE FROM \"${table}\";\\nINSERT OR REPLACE INTO \"${table}\" SELECT * FROM backup.\"${table}\";\\n"
+    done
+    if [[ "${skipGravity}" != true ]]; then
+        for table in "${backupGravityTables[@]}"; do
+            sql+="DELETE FROM \"${table}\";\\nINSERT INTO \"${table}\" SELECT * FROM backup.\"${table}\";\\n"
+        done
+    fi
+    sql+="COMMIT;\\n"
+
+    local str="Restoring configuration tables"
+    echo -ne "  ${INFO} ${str}..."
+    output=$( { printf "%b" "${sql}" | lock_gravityDB sqlite3 -bail "${gravityDBfile}"; } 2>&1 )
+    status="$?"
+    rm -rf "${tmpDir}"
+
+    if [[ "${status}" -ne 0 ]]; then
+        echo -e "${OVER}  ${CROSS} ${str}\\n  ${output}"
+        return 1
+    fi
+    echo -e "${OVER}  ${TICK} ${str}"
+
+    if [[ "${skipGravity}" == true ]]; then
+        str="Rebuilding gravity from the cached lists"
+        echo -e "  ${INFO} ${str}"
+        RebuildGravityFromCache
+    fi
+
+    checkpoint_gravityDB "${gravityDBfile}"
+    "${PI_HOLE_INSTALL_DIR}"/piholeSnapshot.sh build > /dev/null
+    RestartDNS reload-lists
+}
+
 checkDomain()
 {
     local domain validDomain
@@ -673,19 +899,19 @@ addAudit()
     done
     # Insert only the domain here. The date_added field will be
     # filled with its default value (date_added = current timestamp)
-    sqlite3 "${gravityDBfile}" "INSERT INTO domain_audit (domain) VALUES ${domains};"
+    lock_gravityDB sqlite3 "${gravityDBfile}" "INSERT INTO domain_audit (domain) VALUES ${domains};"
 }
 
 clearAudit()
 {
-    sqlite3 "${gravityDBfile}" "DELETE FROM domain_audit;"
+    lock_gravityDB sqlite3 "${gravityDBfile}" "DELETE FROM domain_audit;"
 }
 
 SetPrivacyLevel() {
     # Set privacy level. Minimum is 0, maximum is 3
     if [ "${args[2]}" -ge 0 ] && [ "${args[2]}" -le 3 ]; then
         changeFTLsetting "PRIVACYLEVEL" "${args[2]}"
-        pihole restartdns reload-lists
+        RestartDNS reload-lists
     fi
 }
 
@@ -696,8 +922,8 @@ AddCustomDNSAddress() {
     host="${args[3]}"
 	echo "${ip} ${host}" >> "${dnscustomfile}"
 
-    # Restart dnsmasq to load new custom DNS entries
-    RestartDNS
+    # The custom DNS entries are a hosts file, reloading is enough to read them
+    RestartDNS reload
 }
 
 RemoveCustomDNSAddress() {
@@ -707,8 +933,8 @@ RemoveCustomDNSAddress() {
     host="${args[3]}"
     sed -i "/${ip} ${host}/d" "${dnscustomfile}"
 
-    # Restart dnsmasq to update removed custom DNS entries
-    RestartDNS
+    # The custom DNS entries are a hosts file, reloading is enough to read them
+    RestartDNS reload
 }
 
 AddCustomCNAMERecord() {
@@ -733,6 +959,140 @@ RemoveCustomCNAMERecord() {
     RestartDNS
 }
 
+# Restore the configuration files saved by BatchChanges() if the batch did not complete
+RollbackBatch() {
+    local status="$?" file
+
+    if [[ "${batchMode}" != true ]]; then
+        return
+    fi
+    batchMode=false
+
+    for file in "${batchFiles[@]}"; do
+        if [[ -e "${batchBackup}${file}" ]]; then
+            cp -p "${batchBackup}${file}" "${file}"
+        else
+            rm -f "${file}"
+        fi
+    done
+    rm -rf "${batchBackup}"
+    echo -e "  ${CROSS} Batch aborted, no changes have been applied"
+
+    if [[ "${status}" -eq 0 ]]; then
+        status=1
+    fi
+    exit "${status}"
+}
+
+# Send the signals requested during the batch. A restart re-reads everything,
+# otherwise only the (lighter) signals that were actually requested are sent
+ApplyBatchSignals() {
+    if [[ -n "${batchSignals[restart]}" ]]; then
+        RestartDNS restart
+        return
+    fi
+    if [[ -n "${batchSignals[reload]}" ]]; then
+        RestartDNS reload
+    fi
+    if [[ -n "${batchSignals[reload-lists]}" ]]; then
+        RestartDNS reload-lists
+    fi
+}
+
+# Apply many changes at once: every line of the given file (or stdin with "-")
+# holds one "pihole -a" command without the leading "pihole -a", e.g.
+#   addcustomdns 192.168.1.10 nas.lan
+#   addcustomcname www.nas.lan nas.lan
+#   privacylevel 1
+# The changes are applied to the configuration files as a whole, if any of them fails
+# all files are restored. FTL is signalled only once, after the last change
+BatchChanges() {
+    local source="${args[2]:--}" line lineno=0 changes=0 file
+    local -a batchArgs
+
+    if [[ "${source}" == "-h" || "${source}" == "--help" ]]; then
+        echo "Usage: pihole -a batch [file|-]
+Example: 'pihole -a batch records.txt', or 'cat records.txt | pihole -a batch -'
+Apply many settings, custom DNS and CNAME changes with a single DNS reload
+
+Every line holds one command as given to 'pihole -a', empty lines and lines starting
+with # are ignored. Supported commands:
+  addcustomdns, removecustomdns, addcustomcname, removecustomcname,
+  addstaticdhcp, removestaticdhcp, enabledhcp, disabledhcp, setdns,
+  interface, privacylevel, privacymode, resolve, setexcludedomains,
+  setexcludeclients, setquerylog, layout, theme, email, celsius,
+  fahrenheit, kelvin, restartdns"
+        exit 0
+    fi
+
+    if [[ "${source}" != "-" && ! -r "${source}" ]]; then
+        echo -e "  ${CROSS} Unable to read ${source}"
+        exit 1
+    fi
+    if [[ "${source}" == "-" ]]; then
+        source="/dev/stdin"
+    fi
+
+    # Save all files the commands may write to
+    batchFiles=("${setupVars}" "${FTLconf}" "${dnsmasqconfig}" "${dhcpconfig}" "${dhcpstaticconfig}" "${dnscustomfile}" "${dnscustomcnamefile}")
+    batchBackup="$(mktemp -d -p "/tmp" "pihole_batch.XXXXX")"
+    for file in "${batchFiles[@]}"; do
+        if [[ -e "${file}" ]]; then
+            mkdir -p "${batchBackup}${file%/*}"
+            cp -p "${file}" "${batchBackup}${file}"
+        fi
+    done
+
+    batchMode=true
+    trap RollbackBatch EXIT
+
+    while IFS= read -r line || [[ -n "${line}" ]]; do
+        lineno=$((lineno+1))
+        read -r -a batchArgs <<< "${line}"
+        if [[ "${#batchArgs[@]}" -eq 0 || "${batchArgs[0]}" == "#"* ]]; then
+            continue
+        fi
+
+        # The command functions read their arguments from ${args[@]} as in "pihole -a ..."
+        args=("-a" "${batchArgs[@]}")
+        case "${args[1]}" in
+            "addcustomdns"        ) AddCustomDNSAddress;;
+            "removecustomdns"     ) RemoveCustomDNSAddress;;
+            "addcustomcname"      ) AddCustomCNAMERecord;;
+            "removecustomcname"   ) RemoveCustomCNAMERecord;;
+            "addstaticdhcp"       ) AddDHCPStaticAddress;;
+            "removestaticdhcp"    ) RemoveDHCPStaticAddress;;
+            "enabledhcp"          ) EnableDHCP;;
+            "disabledhcp"         ) DisableDHCP;;
+            "setdns"              ) SetDNSServers;;
+            "-i" | "interface"    ) SetListeningMode "${args[@]}";;
+            "-l" | "privacylevel" ) SetPrivacyLevel;;
+            "privacymode"         ) SetPrivacyMode;;
+            "resolve"             ) ResolutionSettings;;
+            "setexcludedomains"   ) SetExcludeDomains;;
+            "setexcludeclients"   ) SetExcludeClients;;
+            "setquerylog"         ) SetQueryLogOptions;;
+            "layout"              ) SetWebUILayout;;
+            "theme"               ) SetWebUITheme;;
+            "-e" | "email"        ) SetAdminEmail "${args[2]}";;
+            "-c" | "celsius"      ) unit="C"; SetTemperatureUnit;;
+            "-f" | "fahrenheit"   ) unit="F"; SetTemperatureUnit;;
+            "-k" | "kelvin"       ) unit="K"; SetTemperatureUnit;;
+            "restartdns"          ) RestartDNS;;
+            *                     ) echo -e "  ${CROSS} Line ${lineno}: ${args[1]} is not supported in batch mode"; exit 1;;
+        esac || exit 1
+        changes=$((changes+1))
+    done < "${source}"
+
+    # All changes have been written, keep them
+    batchMode=false
+    trap - EXIT
+    rm -rf "${batchBackup}"
+    echo -e "  ${TICK} Applied ${changes} change(s)"
+
+    ApplyBatchSignals
+}
+
 main() {
     args=("$@")
 
@@ -768,6 +1128,9 @@ main() {
         "removecustomdns"     ) RemoveCustomDNSAddress;;
         "addcustomcname"      ) AddCustomCNAMERecord;;
         "removecustomcname"   ) RemoveCustomCNAMERecord;;
+        "batch"               ) BatchChanges;;
+        "backup"              ) BackupConfig;;
+        "restore"             ) RestoreConfig;;
         *                     ) helpFunc;;
     esac
 
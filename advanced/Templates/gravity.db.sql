@@ -32,7 +32,10 @@ CREATE TABLE adlist
 	date_added INTEGER NOT NULL DEFAULT (cast(strftime('%s', 'now') as int)),
 	date_modified INTEGER NOT NULL DEFAULT (cast(strftime('%s', 'now') as int)),
 	comment TEXT,
-	date_updated INTEGER
+	date_updated INTEGER,
+	refresh_interval INTEGER,
+	adaptive BOOLEAN NOT NULL DEFAULT 0,
+	date_checked INTEGER
 );
 
 CREATE TABLE adlist_by_group
@@ -54,7 +57,7 @@ CREATE TABLE info
 	value TEXT NOT NULL
 );
 
-INSERT INTO "info" VALUES('version','13');
+INSERT INTO "info" VALUES('version','17');
 
 CREATE TABLE domain_audit
 (
@@ -86,6 +89,60 @@ CREATE TABLE client_by_group
 	PRIMARY KEY (client_id, group_id)
 );
 
+CREATE TABLE adlist_stats
+(
+	adlist_id INTEGER PRIMARY KEY REFERENCES adlist (id),
+	domains INTEGER NOT NULL DEFAULT 0,
+	unique_domains INTEGER NOT NULL DEFAULT 0,
+	overlap INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE adlist_overlap
+(
+	adlist_id INTEGER NOT NULL REFERENCES adlist (id),
+	other_adlist_id INTEGER NOT NULL REFERENCES adlist (id),
+	domains INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (adlist_id, other_adlist_id)
+);
+
+CREATE TABLE group_stats
+(
+	group_id INTEGER PRIMARY KEY REFERENCES "group" (id),
+	gravity_minus_exact_whitelist INTEGER NOT NULL DEFAULT 0,
+	exact_whitelisted INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE adlist_history
+(
+	adlist_id INTEGER NOT NULL,
+	timestamp INTEGER NOT NULL,
+	domains INTEGER NOT NULL DEFAULT 0,
+	invalid INTEGER NOT NULL DEFAULT 0,
+	unique_domains INTEGER NOT NULL DEFAULT 0,
+	bytes INTEGER NOT NULL DEFAULT 0,
+	duration INTEGER NOT NULL DEFAULT 0,
+	http_code INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (adlist_id, timestamp)
+);
+
+CREATE TABLE adlist_history_daily
+(
+	adlist_id INTEGER NOT NULL,
+	day INTEGER NOT NULL,
+	runs INTEGER NOT NULL DEFAULT 0,
+	failures INTEGER NOT NULL DEFAULT 0,
+	domains INTEGER NOT NULL DEFAULT 0,
+	domains_min INTEGER NOT NULL DEFAULT 0,
+	domains_max INTEGER NOT NULL DEFAULT 0,
+	invalid INTEGER NOT NULL DEFAULT 0,
+	unique_domains INTEGER NOT NULL DEFAULT 0,
+	bytes INTEGER NOT NULL DEFAULT 0,
+	duration INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (adlist_id, day)
+);
+
+CREATE INDEX idx_adlist_history_timestamp ON adlist_history (timestamp);
+
 CREATE TRIGGER tr_adlist_update AFTER UPDATE OF address,enabled,comment ON adlist
     BEGIN
       UPDATE adlist SET date_modified = (cast(strftime('%s', 'now') as int)) WHERE id = NEW.id;
@@ -117,20 +174,41 @@ CREATE VIEW vw_blacklist AS SELECT domain, domainlist.id AS id, domainlist_by_gr
     AND domainlist.type = 1
     ORDER BY domainlist.id;
 
-CREATE VIEW vw_regex_whitelist AS SELECT domain, domainlist.id AS id, domainlist_by_group.group_id AS group_id
+-- Wildcards (types 4 and 5) are included in the regex views as "(^|\.)example\.com$",
+-- as FTL only reads these views and still evaluates wildcards with its regex engine.
+-- The scripts use the suffix lookup on vw_wildcard_whitelist and vw_wildcard_blacklist
+CREATE VIEW vw_regex_whitelist AS SELECT CASE domainlist.type WHEN 4 THEN '(^|\.)' || replace(domain, '.', '\.') || '$' ELSE domain END AS domain,
+    domainlist.id AS id, domainlist_by_group.group_id AS group_id
+    FROM domainlist
+    LEFT JOIN domainlist_by_group ON domainlist_by_group.domainlist_id = domainlist.id
+    LEFT JOIN "group" ON "group".id = domainlist_by_group.group_id
+    WHERE domainlist.enabled = 1 AND (domainlist_by_group.group_id IS NULL OR "group".enabled = 1)
+    AND domainlist.type IN (2, 4)
+    ORDER BY domainlist.id;
+
+CREATE VIEW vw_regex_blacklist AS SELECT CASE domainlist.type WHEN 5 THEN '(^|\.)' || replace(domain, '.', '\.') || '$' ELSE domain END AS domain,
+    domainlist.id AS id, domainlist_by_group.group_id AS group_id
+    FROM domainlist
+    LEFT JOIN domainlist_by_group ON domainlist_by_group.domainlist_id = domainlist.id
+    LEFT JOIN "group" ON "group".id = domainlist_by_group.group_id
+    WHERE domainlist.enabled = 1 AND (domainlist_by_group.group_id IS NULL OR "group".enabled = 1)
+    AND domainlist.type IN (3, 5)
+    ORDER BY domainlist.id;
+
+CREATE VIEW vw_wildcard_whitelist AS SELECT domain, domainlist.id AS id, domainlist_by_group.group_id AS group_id
     FROM domainlist
     LEFT JOIN domainlist_by_group ON domainlist_by_group.domainlist_id = domainlist.id
     LEFT JOIN "group" ON "group".id = domainlist_by_group.group_id
     WHERE domainlist.enabled = 1 AND (domainlist_by_group.group_id IS NULL OR "group".enabled = 1)
-    AND domainlist.type = 2
+    AND domainlist.type = 4
     ORDER BY domainlist.id;
 
-CREATE VIEW vw_regex_blacklist AS SELECT domain, domainlist.id AS id, domainlist_by_group.group_id AS group_id
+CREATE VIEW vw_wildcard_blacklist AS SELECT domain, domainlist.id AS id, domainlist_by_group.group_id AS group_id
     FROM domainlist
     LEFT JOIN domainlist_by_group ON domainlist_by_group.domainlist_id = domainlist.id
     LEFT JOIN "group" ON "group".id = domainlist_by_group.group_id
     WHERE domainlist.enabled = 1 AND (domainlist_by_group.group_id IS NULL OR "group".enabled = 1)
-    AND domainlist.type = 3
+    AND domainlist.type = 5
     ORDER BY domainlist.id;
 
 CREATE VIEW vw_gravity AS SELECT domain, adlist_by_group.group_id AS group_id
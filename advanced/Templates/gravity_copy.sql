@@ -22,6 +22,9 @@ INSERT OR REPLACE INTO info SELECT * FROM OLD.info;
 INSERT OR REPLACE INTO client SELECT * FROM OLD.client;
 INSERT OR REPLACE INTO client_by_group SELECT * FROM OLD.client_by_group;
 
+INSERT OR REPLACE INTO adlist_history SELECT * FROM OLD.adlist_history;
+INSERT OR REPLACE INTO adlist_history_daily SELECT * FROM OLD.adlist_history_daily;
+
 
 CREATE TRIGGER tr_domainlist_add AFTER INSERT ON domainlist
     BEGIN
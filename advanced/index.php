@@ -14,8 +14,63 @@ $serverName = preg_replace('/^\[(.*)\]$/', '${1}', $serverName);
 if (!is_file("/etc/pihole/setupVars.conf"))
   die("[ERROR] File not found: <code>/etc/pihole/setupVars.conf</code>");
 
+// Directory of the file cache, owned by the web server user and not accessible to anyone else
+$cacheDir = "/var/cache/lighttpd/pihole";
+
+// Fetch a value from the cache (APCu if available, otherwise files in $cacheDir)
+// The modification time of a cache file is the time it expires at
+function cacheFetch($key) {
+    global $cacheDir;
+    if (function_exists("apcu_fetch")) {
+        $value = apcu_fetch($key, $success);
+        return $success ? $value : null;
+    }
+    $file = "$cacheDir/".md5($key);
+    $expires = @filemtime($file);
+    if ($expires === false)
+        return null;
+    if ($expires < time()) {
+        @unlink($file);
+        return null;
+    }
+    $entry = json_decode(@file_get_contents($file), true);
+    return is_array($entry) ? $entry["value"] : null;
+}
+
+// Store a value in the cache for $ttl seconds (0 = until it is evicted, files are kept for a day)
+function cacheStore($key, $value, $ttl = 0) {
+    global $cacheDir;
+    if (function_exists("apcu_store")) {
+        apcu_store($key, $value, $ttl);
+        return;
+    }
+    if (!is_dir($cacheDir) || !is_writable($cacheDir))
+        return;
+    $file = "$cacheDir/".md5($key);
+    if (@file_put_contents($file, json_encode(array("value" => $value)), LOCK_EX) !== false)
+        @touch($file, time() + ($ttl === 0 ? 86400 : $ttl));
+    // Remove expired entries now and then, there is one per domain and database change
+    if (mt_rand(1, 100) === 1) {
+        foreach (glob("$cacheDir/*") as $expired) {
+            if (@filemtime($expired) < time())
+                @unlink($expired);
+        }
+    }
+}
+
+// Parse an ini file only when it has changed since it was last parsed
+function cachedIniFile($file) {
+    $key = "pihole-ini:$file:".@filemtime($file);
+    $values = cacheFetch($key);
+    if ($values === null) {
+        $values = parse_ini_file($file);
+        cacheStore($key, $values);
+    }
+    return $values;
+}
+
 // Get values from setupVars.conf
-$setupVars = parse_ini_file("/etc/pihole/setupVars.conf");
+$setupVars = cachedIniFile("/etc/pihole/setupVars.conf");
 $svPasswd = !empty($setupVars["WEBPASSWORD"]);
 $svEmail = (!empty($setupVars["ADMIN_EMAIL"]) && filter_var($setupVars["ADMIN_EMAIL"], FILTER_VALIDATE_EMAIL)) ? $setupVars["ADMIN_EMAIL"] : "";
 unset($setupVars);
@@ -128,7 +183,7 @@ if ($serverName === "pi.hole"
 $bpAskAdmin = !empty($svEmail) ? '<a href="mailto:'.$svEmail.'?subject=Site Blocked: '.$serverName.'"></a>' : "<span/>";
 
 // Get possible non-standard location of FTL's database
-$FTLsettings = parse_ini_file("/etc/pihole/pihole-FTL.conf");
+$FTLsettings = cachedIniFile("/etc/pihole/pihole-FTL.conf");
 if (isset($FTLsettings["GRAVITYDB"])) {
     $gravityDBFile = $FTLsettings["GRAVITYDB"];
 } else {
@@ -155,71 +210,98 @@ if (empty($adlistsUrls))
 // Get total number of blocklists (Including Whitelist, Blacklist & Wildcard lists)
 $adlistsCount = count($adlistsUrls) + 3;
 
-// Set query timeout
-ini_set("default_socket_timeout", 3);
-
-// Logic for querying blocklists
-function queryAds($serverName) {
-    // Determine the time it takes while querying adlists
-    $preQueryTime = microtime(true)-$_SERVER["REQUEST_TIME_FLOAT"];
-    $queryAdsURL = sprintf(
-        "http://127.0.0.1:%s/admin/scripts/pi-hole/php/queryads.php?domain=%s&bp",
-        $_SERVER["SERVER_PORT"],
-        $serverName
-    );
-    $queryAds = file($queryAdsURL, FILE_IGNORE_NEW_LINES);
-    $queryAds = array_values(array_filter(preg_replace("/data:\s+/", "", $queryAds)));
-    $queryTime = sprintf("%.0f", (microtime(true)-$_SERVER["REQUEST_TIME_FLOAT"]) - $preQueryTime);
-
-    // Exception Handling
-    try {
-        // Define Exceptions
-        if (strpos($queryAds[0], "No exact results") !== FALSE) {
-            // Return "none" into $queryAds array
-            return array("0" => "none");
-        } else if ($queryTime >= ini_get("default_socket_timeout")) {
-            // Connection Timeout
-            throw new Exception ("Connection timeout (".ini_get("default_socket_timeout")."s)");
-        } elseif (!strpos($queryAds[0], ".") !== false) {
-            // Unknown $queryAds output
-            throw new Exception ("Unhandled error message (<code>$queryAds[0]</code>)");
+// Logic for querying the lists
+// The lists are looked up directly in the already opened database, in the same order as
+// "pihole -q" does: exact, wildcard and regex white- and blacklist, then gravity
+function queryAds($db, $serverName) {
+    // Exact white- and blacklist
+    foreach (array(0 => "whitelist", 1 => "blacklist") as $type => $list) {
+        $stmt = $db->prepare("SELECT domain FROM domainlist WHERE type = :type AND domain = :domain");
+        $stmt->bindValue(":type", $type, SQLITE3_INTEGER);
+        $stmt->bindValue(":domain", $serverName, SQLITE3_TEXT);
+        $row = $stmt->execute()->fetchArray(SQLITE3_NUM);
+        if ($row !== false)
+            return array("type" => $list, "results" => array("π" => $row[0]));
+    }
+
+    // Wildcard white- and blacklist: look up the domain and all of its parent domains
+    $labels = explode(".", $serverName);
+    $suffixes = array();
+    for ($i = 0; $i < count($labels); $i++) {
+        $suffixes[] = implode(".", array_slice($labels, $i));
+    }
+    $placeholders = implode(",", array_fill(0, count($suffixes), "?"));
+    foreach (array(4 => "whitelist", 5 => "wildcard") as $type => $list) {
+        $stmt = $db->prepare("SELECT domain FROM domainlist WHERE type = $type AND domain IN ($placeholders) ORDER BY length(domain) DESC");
+        foreach ($suffixes as $i => $suffix) {
+            $stmt->bindValue($i + 1, $suffix, SQLITE3_TEXT);
+        }
+        $row = $stmt->execute()->fetchArray(SQLITE3_NUM);
+        if ($row !== false)
+            return array("type" => $list, "results" => array("π" => $row[0]));
+    }
+
+    // Regex white- and blacklist
+    foreach (array(2 => "whitelist", 3 => "wildcard") as $type => $list) {
+        $regexResults = $db->query("SELECT domain FROM domainlist WHERE type = $type");
+        while ($row = $regexResults->fetchArray(SQLITE3_NUM)) {
+            // Remove FTL's special options (e.g. ";querytype=AAAA") and escape the delimiter
+            $regex = preg_replace("/;(querytype=[^;]*|invert)$/", "", $row[0]);
+            $regex = preg_replace('#(?<!\\\\)/#', '\/', $regex);
+            if (@preg_match("/$regex/", $serverName) === 1)
+                return array("type" => $list, "results" => array("π" => $row[0]));
         }
-        return $queryAds;
-    } catch (Exception $e) {
-        // Return exception as array
-        return array("0" => "error", "1" => $e->getMessage());
     }
-}
 
-// Get results of queryads.php exact search
-$queryAds = queryAds($serverName);
+    // Gravity
+    $stmt = $db->prepare("SELECT adlist.id, adlist.address FROM gravity JOIN adlist ON adlist.id = gravity.adlist_id WHERE gravity.domain = :domain AND adlist.enabled = 1");
+    $stmt->bindValue(":domain", $serverName, SQLITE3_TEXT);
+    $gravityResults = $stmt->execute();
+    $results = array();
+    while ($row = $gravityResults->fetchArray(SQLITE3_NUM)) {
+        $results[$row[0]] = $row[1];
+    }
+    if (!empty($results))
+        return array("type" => "gravity", "results" => $results);
 
-// Pass error through to Block Page
-if ($queryAds[0] === "error")
-    die("[ERROR]: Unable to parse results from <i>queryads.php</i>: <code>".$queryAds[1]."</code>");
+    return array("type" => "none", "results" => array());
+}
+
+// Get results of the lookup, results are cached for one minute or until gravity.db changes
+// Changes are written to the write-ahead log first, they reach gravity.db only with the next checkpoint
+$queryKey = "pihole-bp:".@filemtime($gravityDBFile).":".@filemtime("$gravityDBFile-wal").":$serverName";
+$queryAds = cacheFetch($queryKey);
+if ($queryAds === null) {
+    $db->enableExceptions(true);
+    try {
+        $queryAds = queryAds($db, $serverName);
+    } catch (Exception $e) {
+        // Pass error through to Block Page
+        die("[ERROR]: Unable to query gravity.db: <code>".$e->getMessage()."</code>");
+    }
+    cacheStore($queryKey, $queryAds, 60);
+}
 
 // Count total number of matching blocklists
-$featuredTotal = count($queryAds);
+$featuredTotal = count($queryAds["results"]);
 
 // Place results into key => value array
-$queryResults = null;
-foreach ($queryAds as $str) {
-    $value = explode(" ", $str);
-    @$queryResults[$value[0]] .= "$value[1]";
-}
+$queryResults = $queryAds["results"];
 
 // Determine if domain has been blacklisted, whitelisted, wildcarded or CNAME blocked
-if (strpos($queryAds[0], "blacklist") !== FALSE) {
+if ($queryAds["type"] === "blacklist") {
     $notableFlagClass = "blacklist";
-    $adlistsUrls = array("π" => substr($queryAds[0], 2));
-} elseif (strpos($queryAds[0], "whitelist") !== FALSE) {
+    $adlistsUrls = $queryResults;
+} elseif ($queryAds["type"] === "whitelist") {
     $notableFlagClass = "noblock";
-    $adlistsUrls = array("π" => substr($queryAds[0], 2));
+    $adlistsUrls = $queryResults;
     $wlInfo = "recentwl";
-} elseif (strpos($queryAds[0], "wildcard") !== FALSE) {
+} elseif ($queryAds["type"] === "wildcard") {
     $notableFlagClass = "wildcard";
-    $adlistsUrls = array("π" => substr($queryAds[0], 2));
-} elseif ($queryAds[0] === "none") {
+    $adlistsUrls = $queryResults;
+} elseif ($queryAds["type"] === "gravity") {
+    $adlistsUrls = $queryResults;
+} elseif ($queryAds["type"] === "none") {
     $featuredTotal = "0";
     $notableFlagClass = "noblock";
 
@@ -237,8 +319,13 @@ if (strpos($queryAds[0], "blacklist") !== FALSE) {
 $wlOutputClass = (isset($wlInfo) && $wlInfo === "recentwl") ? $wlInfo : "hidden";
 $wlOutput = (isset($wlInfo) && $wlInfo !== "recentwl") ? "<a href='http://$wlInfo'>$wlInfo</a>" : "";
 
-// Get Pi-hole Core version
-$phVersion = exec("cd /etc/.pihole/ && git describe --long --tags");
+// Get Pi-hole Core version, cached until the local repository changes
+$versionKey = "pihole-version:".@filemtime("/etc/.pihole/.git/HEAD").":".@filemtime("/etc/.pihole/.git/index").":".@filemtime("/etc/.pihole/.git/packed-refs");
+$phVersion = cacheFetch($versionKey);
+if ($phVersion === null) {
+    $phVersion = exec("cd /etc/.pihole/ && git describe --long --tags");
+    cacheStore($versionKey, $phVersion);
+}
 
 // Print $execTime on development branches
 // Testing for - is marginally faster than "git rev-parse --abbrev-ref HEAD"
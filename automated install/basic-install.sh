@@ -65,12 +65,15 @@ webInterfaceDir="${webroot}/admin"
 piholeGitUrl="https://github.com/pi-hole/pi-hole.git"
 PI_HOLE_LOCAL_REPO="/etc/.pihole"
 # These are the names of pi-holes files, stored in an array
-PI_HOLE_FILES=(chronometer list piholeDebug piholeLogFlush setupLCD update version gravity uninstall webpage)
+PI_HOLE_FILES=(chronometer list piholeDebug piholeHistory piholeLogAnalyzer piholeLogFlush piholeSnapshot piholeSync setupLCD update version gravity uninstall webpage)
 # This directory is where the Pi-hole scripts will be installed
 PI_HOLE_INSTALL_DIR="/opt/pihole"
 PI_HOLE_CONFIG_DIR="/etc/pihole"
 PI_HOLE_BIN_DIR="/usr/local/bin"
 PI_HOLE_BLOCKPAGE_DIR="${webroot}/pihole"
+# Input and output hashes of each completed installer stage, used by repairs and updates
+# to skip the stages whose inputs and installed results have not changed since
+installManifest="${PI_HOLE_CONFIG_DIR}/install.manifest"
 if [ -z "$useUpdateVars" ]; then
   useUpdateVars=false
 fi
@@ -1434,6 +1437,97 @@ clean_existing() {
     done
 }
 
+# Print one sha1 over the given items: the content of the ones that are files,
+# the item itself otherwise (settings, function bodies, missing files)
+hash_content() {
+    local item
+    for item in "$@"; do
+        if [[ -f "${item}" ]]; then
+            sha1sum < "${item}"
+        else
+            printf "%s\\n" "${item}"
+        fi
+    done | sha1sum | cut -d ' ' -f 1
+}
+
+# Print the input and the output hash of an installer stage
+stage_hashes() {
+    local stage="${1}"
+    shift
+    local -a inputs outputs
+    local script
+
+    case "${stage}" in
+        packages_*)
+            inputs=("${PKG_MANAGER}" "$@")
+            if is_command dpkg-query; then
+                outputs=("/var/lib/dpkg/status")
+            else
+                outputs=("$(stat -c '%n %Y' /var/lib/rpm/* 2> /dev/null || true)")
+            fi
+            ;;
+        ftl)
+            inputs=("$@" "$(cat "${PI_HOLE_CONFIG_DIR}/ftlbranch" 2> /dev/null || true)")
+            outputs=("$(which pihole-FTL 2> /dev/null || true)")
+            ;;
+        scripts)
+            inputs=("$(declare -f installScripts clean_existing)" "${PI_HOLE_LOCAL_REPO}/pihole" "${PI_HOLE_LOCAL_REPO}/advanced/bash-completion/pihole")
+            outputs=("${PI_HOLE_BIN_DIR}/pihole" "/etc/bash_completion.d/pihole")
+            for script in "${PI_HOLE_LOCAL_REPO}/gravity.sh" "${PI_HOLE_LOCAL_REPO}"/advanced/Scripts/*.sh "${PI_HOLE_LOCAL_REPO}/automated install/uninstall.sh" "${PI_HOLE_LOCAL_REPO}/advanced/Scripts/COL_TABLE"; do
+                inputs+=("${script}")
+                outputs+=("${PI_HOLE_INSTALL_DIR}/${script##*/}")
+            done
+            ;;
+        configs)
+            inputs=("$(declare -f installConfigs version_check_dnsmasq)" "${DNS_SERVERS}" "${PI_HOLE_LOCAL_REPO}/advanced/dnsmasq.conf.original" "${PI_HOLE_LOCAL_REPO}/advanced/01-pihole.conf" "${PI_HOLE_LOCAL_REPO}/advanced/${LIGHTTPD_CFG}" "${PIHOLE_INTERFACE}" "${PIHOLE_DNS_1}" "${PIHOLE_DNS_2}" "${CACHE_SIZE}" "${QUERY_LOGGING}" "${INSTALL_WEB_SERVER}")
+            outputs=("/etc/dnsmasq.conf" "/etc/dnsmasq.d/01-pihole.conf" "${PI_HOLE_CONFIG_DIR}/dns-servers.conf" "$(stat -c '%n %U' "${PI_HOLE_CONFIG_DIR}/pihole-FTL.conf" "${PI_HOLE_CONFIG_DIR}/custom.list" 2> /dev/null || true)")
+            if [[ "${INSTALL_WEB_SERVER}" == true ]]; then
+                outputs+=("/etc/lighttpd/lighttpd.conf" "$(stat -c '%n %U' /etc/lighttpd/external.conf /run/lighttpd /var/cache/lighttpd/compress /var/cache/lighttpd/uploads /var/cache/lighttpd/pihole 2> /dev/null || true)")
+            fi
+            ;;
+        web)
+            inputs=("$(declare -f installPiholeWeb)" "${INSTALL_WEB_INTERFACE}" "${LIGHTTPD_USER}" "${PI_HOLE_BIN_DIR}" "${PI_HOLE_LOCAL_REPO}"/advanced/{index,blockingpage}.* "${PI_HOLE_LOCAL_REPO}/advanced/Templates/pihole.sudo")
+            outputs=("${PI_HOLE_BLOCKPAGE_DIR}"/{index,blockingpage}.* "/etc/sudoers.d/pihole" "$(stat -c '%n' "${webroot}/index.lighttpd.html" 2> /dev/null || true)")
+            ;;
+        manpage)
+            inputs=("$(declare -f install_manpage)" "${PI_HOLE_LOCAL_REPO}/manpages/pihole.8" "${PI_HOLE_LOCAL_REPO}/manpages/pihole-FTL.8" "${PI_HOLE_LOCAL_REPO}/manpages/pihole-FTL.conf.5")
+            outputs=("/usr/local/share/man/man8/pihole.8" "/usr/local/share/man/man8/pihole-FTL.8" "/usr/local/share/man/man5/pihole-FTL.conf.5")
+            ;;
+        gravity)
+            # The lists and the schema gravity is built for, and what it built: a damaged
+            # or partly filled database does not match the recorded integrity and row counts
+            inputs=("${PI_HOLE_LOCAL_REPO}/advanced/Templates/gravity.db.sql")
+            if [[ -f "${PI_HOLE_CONFIG_DIR}/gravity.db" ]]; then
+                inputs+=("$(sqlite3 "${PI_HOLE_CONFIG_DIR}/gravity.db" "SELECT address, enabled FROM adlist ORDER BY id;" 2> /dev/null || true)")
+                outputs=("$(sqlite3 "${PI_HOLE_CONFIG_DIR}/gravity.db" "PRAGMA quick_check; SELECT value FROM info WHERE property IN ('version', 'gravity_count') ORDER BY property; SELECT COUNT(*) FROM gravity;" 2> /dev/null || true)")
+            fi
+            ;;
+    esac
+
+    printf "%s %s\\n" "$(hash_content "${inputs[@]}")" "$(hash_content "${outputs[@]}")"
+}
+
+# Check whether a stage may be skipped: only repairs and updates skip stages, and
+# only when the manifest holds the same input and output hashes for it
+install_stage_unchanged() {
+    if [[ "${useUpdateVars}" != true || ! -r "${installManifest}" ]]; then
+        return 1
+    fi
+    grep -qxF "${1} $(stage_hashes "$@")" "${installManifest}"
+}
+
+# Record a completed stage in the manifest, replacing its previous entry
+record_install_stage() {
+    local hashes
+    hashes="$(stage_hashes "$@")"
+    install -d -m 755 "${PI_HOLE_CONFIG_DIR}"
+    {
+        grep -v "^${1} " "${installManifest}" 2> /dev/null || true
+        printf "%s %s\\n" "${1}" "${hashes}"
+    } > "${installManifest}.tmp"
+    mv -f "${installManifest}.tmp" "${installManifest}"
+}
+
 # Install the scripts from repository to their various locations
 installScripts() {
     # Local, named variables
@@ -1527,6 +1621,8 @@ installConfigs() {
         chown ${LIGHTTPD_USER}:${LIGHTTPD_GROUP} /var/cache/lighttpd/compress
         mkdir -p /var/cache/lighttpd/uploads
         chown ${LIGHTTPD_USER}:${LIGHTTPD_GROUP} /var/cache/lighttpd/uploads
+        # The block page caches its lookups here if APCu is not available
+        install -d -m 0700 -o ${LIGHTTPD_USER} -g ${LIGHTTPD_GROUP} /var/cache/lighttpd/pihole
     fi
 }
 
@@ -1728,9 +1824,19 @@ install_dependent_packages() {
         printf "  %b Main Dependency checks...\\n" "${INFO}"
     fi
 
+    # Nothing to check if the same packages were all present after the last install
+    # and the package database has not changed since
+    if install_stage_unchanged "packages_${counter}" "$@"; then
+        printf "  %b Dependencies unchanged since last install\\n\\n" "${TICK}"
+        return 0
+    fi
+
     # Install packages passed in via argument array
     # No spinner - conflicts with set -e
     declare -a installArray
+    # Packages found by a single query of the package database
+    local -A installedPackages
+    local package status
 
     # Debian based package install - debconf will download the entire package list
     # so we just create an array of packages not currently installed to cut down on the
@@ -1738,10 +1844,15 @@ install_dependent_packages() {
     # NOTE: We may be able to use this installArray in the future to create a list of package that were
     # installed by us, and remove only the installed packages, and not the entire list.
     if is_command apt-get ; then
+        while read -r package status; do
+            if [[ "${status}" == *"ok installed" ]]; then
+                installedPackages["${package}"]=true
+            fi
+        done < <(dpkg-query -W -f='${Package} ${Status}\n' "$@" 2> /dev/null || true)
         # For each package,
         for i in "$@"; do
             printf "  %b Checking for %s..." "${INFO}" "${i}"
-            if dpkg-query -W -f='${Status}' "${i}" 2>/dev/null | grep "ok installed" &> /dev/null; then
+            if [[ "${installedPackages[${i}]}" == true ]]; then
                 printf "%b  %b Checking for %s\\n" "${OVER}" "${TICK}" "${i}"
             else
                 printf "%b  %b Checking for %s (will be installed)\\n" "${OVER}" "${INFO}" "${i}"
@@ -1754,16 +1865,22 @@ install_dependent_packages() {
             printf '%*s\n' "$columns" '' | tr " " -;
             "${PKG_INSTALL[@]}" "${installArray[@]}"
             printf '%*s\n' "$columns" '' | tr " " -;
-            return
+        else
+            printf "\\n"
         fi
-        printf "\\n"
+        record_install_stage "packages_${counter}" "$@"
         return 0
     fi
 
     # Install Fedora/CentOS packages
+    # rpm answers for all packages at once, the package manager is only asked about
+    # the ones rpm does not know by name (e.g. provided by another package)
+    while read -r package; do
+        installedPackages["${package}"]=true
+    done < <(rpm -q --qf '%{NAME}\n' "$@" 2> /dev/null | grep -v ' ' || true)
     for i in "$@"; do
         printf "  %b Checking for %s..." "${INFO}" "${i}"
-        if "${PKG_MANAGER}" -q list installed "${i}" &> /dev/null; then
+        if [[ "${installedPackages[${i}]}" == true ]] || "${PKG_MANAGER}" -q list installed "${i}" &> /dev/null; then
             printf "%b  %b Checking for %s\\n" "${OVER}" "${TICK}" "${i}"
         else
             printf "%b  %b Checking for %s (will be installed)\\n" "${OVER}" "${INFO}" "${i}"
@@ -1775,9 +1892,10 @@ install_dependent_packages() {
         printf '%*s\n' "$columns" '' | tr " " -;
         "${PKG_INSTALL[@]}" "${installArray[@]}"
         printf '%*s\n' "$columns" '' | tr " " -;
-        return
+    else
+        printf "\\n"
     fi
-    printf "\\n"
+    record_install_stage "packages_${counter}" "$@"
     return 0
 }
 
@@ -1844,6 +1962,8 @@ installCron() {
     install -D -m 644 -T -o root -g root ${PI_HOLE_LOCAL_REPO}/advanced/Templates/pihole.cron /etc/cron.d/pihole
     # Randomize gravity update time
     sed -i "s/59 1 /$((1 + RANDOM % 58)) $((3 + RANDOM % 2))/" /etc/cron.d/pihole
+    # Randomize minute of the hourly refresh of due adlists
+    sed -i "s/39 \*/$((RANDOM % 60)) */" /etc/cron.d/pihole
     # Randomize update checker time
     sed -i "s/59 17/$((1 + RANDOM % 58)) $((12 + RANDOM % 8))/" /etc/cron.d/pihole
     printf "%b  %b %s\\n" "${OVER}" "${TICK}" "${str}"
@@ -1852,8 +1972,14 @@ installCron() {
 # Gravity is a very important script as it aggregates all of the domains into a single HOSTS formatted list,
 # which is what Pi-hole needs to begin blocking ads
 runGravity() {
+    # Nothing to rebuild if neither the lists nor the database schema changed since the last build
+    if install_stage_unchanged gravity; then
+        printf "  %b Gravity database is up to date, skipping rebuild\\n" "${TICK}"
+        return 0
+    fi
     # Run gravity in the current shell
     { /opt/pihole/gravity.sh --force; }
+    record_install_stage gravity
 }
 
 # Check if the pihole user exists and create if it does not
@@ -2037,19 +2163,27 @@ installPihole() {
         accountForRefactor
     fi
     # Install base files and web interface
-    if ! installScripts; then
+    if install_stage_unchanged scripts; then
+        printf "  %b Scripts unchanged since last install\\n" "${TICK}"
+    elif ! installScripts; then
         printf "  %b Failure in dependent script copy function.\\n" "${CROSS}"
         exit 1
     fi
     # Install config files
-    if ! installConfigs; then
+    if install_stage_unchanged configs; then
+        printf "\\n  %b Configs unchanged since last install\\n" "${TICK}"
+    elif ! installConfigs; then
         printf "  %b Failure in dependent config copy function.\\n" "${CROSS}"
         exit 1
     fi
     # If the user wants to install the dashboard,
     if [[ "${INSTALL_WEB_INTERFACE}" == true ]]; then
-        # do so
-        installPiholeWeb
+        # do so, unless it is already in place
+        if install_stage_unchanged web; then
+            printf "\\n  %b Blocking page unchanged since last install\\n" "${TICK}"
+        else
+            installPiholeWeb
+        fi
     fi
     # Install the cron file
     installCron
@@ -2060,10 +2194,20 @@ installPihole() {
     disable_dnsmasq
 
     # install a man page entry for pihole
-    install_manpage
+    if install_stage_unchanged manpage; then
+        printf "  %b Man pages unchanged since last install\\n" "${TICK}"
+    else
+        install_manpage
+    fi
 
     # Update setupvars.conf with any variables that may or may not have been changed during the install
     finalExports
+
+    # Record the stages only now, as finalExports rewrites some of the installed configs
+    local stage
+    for stage in scripts configs web manpage; do
+        record_install_stage "${stage}"
+    done
 }
 
 # SELinux
@@ -2566,6 +2710,12 @@ FTLcheckUpdate() {
             else
                 printf "  %b Latest FTL Binary already installed (%s). Confirming Checksum...\\n" "${INFO}" "${FTLlatesttag}"
 
+                # The binary was verified against the remote checksum when it was recorded
+                if install_stage_unchanged ftl "${binary}"; then
+                    printf "  %b Checksum matches install manifest. No need to download!\\n" "${INFO}"
+                    return 1
+                fi
+
                 remoteSha1=$(curl -sSL --fail "https://github.com/pi-hole/FTL/releases/download/${FTLversion%$'\r'}/${binary}.sha1" | cut -d ' ' -f 1)
                 localSha1=$(sha1sum "$(which pihole-FTL)" | cut -d ' ' -f 1)
 
@@ -2766,6 +2916,7 @@ main() {
         printf "  %b FTL Engine not installed\\n" "${CROSS}"
         exit 1
     fi
+    record_install_stage ftl "${binary}"
 
     # Install and log everything to a file
     installPihole | tee -a /proc/$$/fd/3
@@ -39,9 +39,17 @@ gravityDBfile="${piholeDir}/gravity.db"
 gravityTEMPfile="${piholeDir}/gravity_temp.db"
 gravityDBschema="${piholeGitDir}/advanced/Templates/gravity.db.sql"
 gravityDBcopy="${piholeGitDir}/advanced/Templates/gravity_copy.sql"
+snapshotScript="/opt/pihole/piholeSnapshot.sh"
+historyScript="/opt/pihole/piholeHistory.sh"
+syncScript="/opt/pihole/piholeSync.sh"
 
 domainsExtension="domains"
 
+# Refresh intervals (in seconds) of adlists in adaptive mode
+defaultRefreshInterval=86400
+adaptiveMinInterval=3600
+adaptiveMaxInterval=604800
+
 # Source setupVars from install script
 setupVars="${piholeDir}/setupVars.conf"
 if [[ -f "${setupVars}" ]];then
@@ -80,6 +88,10 @@ fi
 # Generate new sqlite3 file from schema template
 generate_gravity_database() {
   sqlite3 "${1}" < "${gravityDBschema}"
+  # The journal mode is stored in the database file, readers never block behind a writer
+  sqlite3 "${1}" "PRAGMA journal_mode=WAL;" > /dev/null
+  chown pihole:pihole "${1}"
+  chmod g+w "${piholeDir}" "${1}"
 }
 
 # Copy data from old to new database file and swap them
@@ -101,23 +113,33 @@ gravity_swap_databases() {
   str="Swapping databases"
   echo -ne "  ${INFO} ${str}..."
 
-  output=$( { sqlite3 "${gravityTEMPfile}" < "${gravityDBcopy}"; } 2>&1 )
+  # Changes made to the old database after copying its data would be lost, so other
+  # writers have to wait until the new database is in place
+  if ! acquire_gravityDB_lock; then
+    echo -e "\\n  ${CROSS} Unable to swap databases"
+    return 1
+  fi
+
+  # The new database is built with a rollback journal as this is faster for the bulk import,
+  # it is switched to a write-ahead log only once it is complete
+  output=$( { sqlite3 "${gravityTEMPfile}" < "${gravityDBcopy}" && sqlite3 "${gravityTEMPfile}" "PRAGMA journal_mode=WAL;" > /dev/null; } 2>&1 )
   status="$?"
 
   if [[ "${status}" -ne 0 ]]; then
+    release_gravityDB_lock
     echo -e "\\n  ${CROSS} Unable to copy data from ${gravityDBfile} to ${gravityTEMPfile}\\n  ${output}"
     return 1
   fi
   echo -e "${OVER}  ${TICK} ${str}"
 
-  # Swap databases and remove old database
-  rm "${gravityDBfile}"
-  mv "${gravityTEMPfile}" "${gravityDBfile}"
+  # Swap databases, the old one is removed by gravity_Cleanup after FTL has reloaded the lists
+  swap_gravityDB "${gravityTEMPfile}"
+  release_gravityDB_lock
 }
 
 # Update timestamp when the gravity table was last updated successfully
 update_gravity_timestamp() {
-  output=$( { printf ".timeout 30000\\nINSERT OR REPLACE INTO info (property,value) values ('updated',cast(strftime('%%s', 'now') as int));" | sqlite3 "${gravityDBfile}"; } 2>&1 )
+  output=$( { printf ".timeout 30000\\nINSERT OR REPLACE INTO info (property,value) values ('updated',cast(strftime('%%s', 'now') as int));" | lock_gravityDB sqlite3 "${gravityDBfile}"; } 2>&1 )
   status="$?"
 
   if [[ "${status}" -ne 0 ]]; then
@@ -127,88 +149,69 @@ update_gravity_timestamp() {
   return 0
 }
 
-# Import domains from file and store them in the specified database table
-database_table_from_file() {
-  # Define locals
-  local table source backup_path backup_file tmpFile type
-  table="${1}"
-  source="${2}"
-  backup_path="${piholeDir}/migration_backup"
-  backup_file="${backup_path}/$(basename "${2}")"
-  tmpFile="$(mktemp -p "/tmp" --suffix=".gravity")"
-
-  local timestamp
+# Print the SQL statements importing all domains from file ${2} into the database table ${1}
+# A single awk process writes one INSERT per line, sqlite3 executes them as they are produced
+database_table_sql() {
+  local table="${1}" source="${2}" type="" timestamp
   timestamp="$(date --utc +'%s')"
 
-  local rowid
-  declare -i rowid
-  rowid=1
-
   # Special handling for domains to be imported into the common domainlist table
   if [[ "${table}" == "whitelist" ]]; then
     type="0"
-    table="domainlist"
   elif [[ "${table}" == "blacklist" ]]; then
     type="1"
-    table="domainlist"
   elif [[ "${table}" == "regex" ]]; then
     type="3"
-    table="domainlist"
   fi
 
-  # Get MAX(id) from domainlist when INSERTing into this table
-  if [[ "${table}" == "domainlist" ]]; then
-    rowid="$(sqlite3 "${gravityDBfile}" "SELECT MAX(id) FROM domainlist;")"
-    if [[ -z "$rowid" ]]; then
-      rowid=0
-    fi
-    rowid+=1
-  fi
-
-  # Loop over all domains in ${source} file
-  # Read file line by line
-  grep -v '^ *#' < "${source}" | while IFS= read -r domain
-  do
-    # Only add non-empty lines
-    if [[ -n "${domain}" ]]; then
-      if [[ "${table}" == "domain_audit" ]]; then
-        # domain_audit table format (no enable or modified fields)
-        echo "${rowid},\"${domain}\",${timestamp}" >> "${tmpFile}"
-      elif [[ "${table}" == "adlist" ]]; then
-        # Adlist table format
-        echo "${rowid},\"${domain}\",1,${timestamp},${timestamp},\"Migrated from ${source}\"," >> "${tmpFile}"
-      else
-        # White-, black-, and regexlist table format
-        echo "${rowid},${type},\"${domain}\",1,${timestamp},${timestamp},\"Migrated from ${source}\"" >> "${tmpFile}"
-      fi
-      rowid+=1
-    fi
-  done
+  # Only add non-empty lines which are not comments
+  awk -v table="${table}" -v type="${type}" -v timestamp="${timestamp}" -v source="${source}" -v q="'" '
+    function quote(str) { gsub(q, q q, str); return q str q }
+    /^ *#/ || length($0) == 0 { next }
+    table == "domain_audit" {
+      # domain_audit table format (no enable or modified fields)
+      printf "INSERT OR IGNORE INTO domain_audit (domain,date_added) VALUES (%s,%d);\n", quote($0), timestamp
+      next
+    }
+    table == "adlist" {
+      # Adlist table format
+      printf "INSERT OR IGNORE INTO adlist (address,enabled,date_added,date_modified,comment) VALUES (%s,1,%d,%d,%s);\n", quote($0), timestamp, timestamp, quote("Migrated from " source)
+      next
+    }
+    {
+      # White-, black-, and regexlist table format
+      printf "INSERT OR IGNORE INTO domainlist (type,domain,enabled,date_added,date_modified,comment) VALUES (%d,%s,1,%d,%d,%s);\n", type, quote($0), timestamp, timestamp, quote("Migrated from " source)
+    }' "${source}"
+}
+
+# Move a migrated list file to the backup directory, create directory if not existing
+database_backup_file() {
+  local source="${1}" backup_path="${piholeDir}/migration_backup"
+
+  mkdir -p "${backup_path}"
+  mv "${source}" "${backup_path}/$(basename "${source}")" 2> /dev/null || \
+      echo -e "  ${CROSS} Unable to backup ${source} to ${backup_path}"
+}
+
+# Import domains from file and store them in the specified database table
+database_table_from_file() {
+  local table="${1}" source="${2}"
 
-  # Store domains in database table specified by ${table}
-  # Use printf as .mode and .import need to be on separate lines
-  # see https://unix.stackexchange.com/a/445615/83260
-  output=$( { printf ".timeout 30000\\n.mode csv\\n.import \"%s\" %s\\n" "${tmpFile}" "${table}" | sqlite3 "${gravityDBfile}"; } 2>&1 )
+  # Store domains in database table specified by ${table} within a single transaction
+  output=$( { { printf ".timeout 30000\\nBEGIN TRANSACTION;\\n"; database_table_sql "${table}" "${source}"; printf "COMMIT;\\n"; } | lock_gravityDB sqlite3 -bail "${gravityDBfile}"; } 2>&1 )
   status="$?"
 
   if [[ "${status}" -ne 0 ]]; then
-    echo -e "\\n  ${CROSS} Unable to fill table ${table}${type} in database ${gravityDBfile}\\n  ${output}"
+    echo -e "\\n  ${CROSS} Unable to fill table ${table} in database ${gravityDBfile}\\n  ${output}"
     gravity_Cleanup "error"
   fi
 
-  # Move source file to backup directory, create directory if not existing
-  mkdir -p "${backup_path}"
-  mv "${source}" "${backup_file}" 2> /dev/null || \
-      echo -e "  ${CROSS} Unable to backup ${source} to ${backup_path}"
-
-  # Delete tmpFile
-  rm "${tmpFile}" > /dev/null 2>&1 || \
-    echo -e "  ${CROSS} Unable to remove ${tmpFile}"
+  database_backup_file "${source}"
 }
 
 # Update timestamp of last update of this list. We store this in the "old" database as all values in the new database will later be overwritten
 database_adlist_updated() {
-  output=$( { printf ".timeout 30000\\nUPDATE adlist SET date_updated = (cast(strftime('%%s', 'now') as int)) WHERE id = %i;\\n" "${1}" | sqlite3 "${gravityDBfile}"; } 2>&1 )
+  output=$( { printf ".timeout 30000\\nUPDATE adlist SET date_updated = (cast(strftime('%%s', 'now') as int)) WHERE id = %i;\\n" "${1}" | lock_gravityDB sqlite3 "${gravityDBfile}"; } 2>&1 )
   status="$?"
 
   if [[ "${status}" -ne 0 ]]; then
@@ -217,8 +220,34 @@ database_adlist_updated() {
   fi
 }
 
+# Record when this list was last checked. Lists in adaptive mode are checked more often when their
+# content changed ("true" as second argument) and less often when it did not ("false"), bounded by
+# ${adaptiveMinInterval} and ${adaptiveMaxInterval}. Failed downloads and full gravity runs (no second argument)
+# leave the interval alone
+database_adlist_checked() {
+  local factor="NULL"
+  if [[ "${2}" == true ]]; then
+    factor="0.5"
+  elif [[ "${2}" == false ]]; then
+    factor="1.5"
+  fi
+
+  output=$( { printf ".timeout 30000\\nUPDATE adlist SET date_checked = (cast(strftime('%%s', 'now') as int)), refresh_interval = CASE WHEN adaptive = 1 AND %s IS NOT NULL THEN MIN(%i, MAX(%i, CAST(IFNULL(refresh_interval, %i) * %s AS INT))) ELSE refresh_interval END WHERE id = %i;\\n" "${factor}" "${adaptiveMaxInterval}" "${adaptiveMinInterval}" "${defaultRefreshInterval}" "${factor}" "${1}" | lock_gravityDB sqlite3 "${gravityDBfile}"; } 2>&1 )
+  status="$?"
+
+  if [[ "${status}" -ne 0 ]]; then
+    echo -e "\\n  ${CROSS} Unable to update check timestamp of adlist with ID ${1} in database ${gravityDBfile}\\n  ${output}"
+    gravity_Cleanup "error"
+  fi
+}
+
 # Migrate pre-v5.0 list files to database-based Pi-hole versions
 migrate_to_database() {
+  # Other writers have to wait until the database has been created and upgraded
+  if ! acquire_gravityDB_lock; then
+    gravity_Cleanup "error"
+  fi
+
   # Create database file only if not present
   if [ ! -e "${gravityDBfile}" ]; then
     # Create new database file - note that this will be created in version 1
@@ -255,6 +284,8 @@ migrate_to_database() {
 
   # Check if gravity database needs to be updated
   upgrade_gravityDB "${gravityDBfile}" "${piholeDir}"
+
+  release_gravityDB_lock
 }
 
 # Determine if DNS resolution is available before proceeding
@@ -313,6 +344,62 @@ gravity_CheckDNSResolutionAvailable() {
   gravity_CheckDNSResolutionAvailable
 }
 
+# Get the host of every source URL ("local" for local files)
+gravity_ParseSourceDomains() {
+  # Logic: Split by folder/port
+  awk -F '[/:]' '{
+    # Remove URL protocol & optional username:password@
+    gsub(/(.*:\/\/|.*:.*@)/, "", $0)
+    if(length($1)>0){print $1}
+    else {print "local"}
+  }' <<< "$(printf '%s\n' "$@")" 2> /dev/null
+}
+
+# Use compression to reduce the amount of data that is transfered
+# between the Pi-hole and the ad list provider. Use this feature
+# only if it is supported by the locally available version of curl
+gravity_GetCompression() {
+  if curl -V | grep -q "Features:.* libz"; then
+    echo "--compressed"
+    echo -e "  ${INFO} Using libz compression\n" >&2
+  else
+    echo -e "  ${INFO} Libz compression not available\n" >&2
+  fi
+}
+
+# Download a single blocklist and add its domains to the target file
+gravity_DownloadBlocklist() {
+  local url="${1}" domain="${2}" id="${3}" target="${4}" compression="${5}"
+  local saveLocation agent cmd_ext regex check_url
+
+  # Save the file as list.#.domain
+  saveLocation="${piholeDir}/list.${id}.${domain}.${domainsExtension}"
+
+  # Default user-agent (for Cloudflare's Browser Integrity Check: https://support.cloudflare.com/hc/en-us/articles/200170086-What-does-the-Browser-Integrity-Check-do-)
+  agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.102 Safari/537.36"
+
+  # Provide special commands for blocklists which may need them
+  case "${domain}" in
+    "pgl.yoyo.org") cmd_ext="-d mimetype=plaintext -d hostformat=hosts";;
+    *) cmd_ext="";;
+  esac
+
+  echo -e "  ${INFO} Target: ${url}"
+  # Check for characters NOT allowed in URLs
+  regex="[^a-zA-Z0-9:/?&%=~._()-;]"
+
+  # this will remove first @ that is after schema and before domain
+  # \1 is optional schema, \2 is userinfo
+  check_url="$( sed -re 's#([^:/]*://)?([^/]+)@#\1\2#' <<< "$url" )"
+
+  if [[ "${check_url}" =~ ${regex} ]]; then
+      echo -e "  ${CROSS} Invalid Target"
+  else
+     gravity_DownloadBlocklistFromUrl "${url}" "${cmd_ext}" "${agent}" "${id}" "${saveLocation}" "${target}" "${compression}"
+  fi
+  echo ""
+}
+
 # Retrieve blocklist URLs and parse domains from adlist.list
 gravity_DownloadBlocklists() {
   echo -e "  ${INFO} ${COL_BOLD}Neutrino emissions detected${COL_NC}..."
@@ -323,15 +410,7 @@ gravity_DownloadBlocklists() {
   mapfile -t sourceIDs <<< "$(sqlite3 "${gravityDBfile}" "SELECT id FROM vw_adlist;" 2> /dev/null)"
 
   # Parse source domains from $sources
-  mapfile -t sourceDomains <<< "$(
-    # Logic: Split by folder/port
-    awk -F '[/:]' '{
-      # Remove URL protocol & optional username:password@
-      gsub(/(.*:\/\/|.*:.*@)/, "", $0)
-      if(length($1)>0){print $1}
-      else {print "local"}
-    }' <<< "$(printf '%s\n' "${sources[@]}")" 2> /dev/null
-  )"
+  mapfile -t sourceDomains <<< "$(gravity_ParseSourceDomains "${sources[@]}")"
 
   local str="Pulling blocklist source list into range"
 
@@ -344,9 +423,12 @@ gravity_DownloadBlocklists() {
     return 1
   fi
 
-  local url domain agent cmd_ext str target compression
+  local str target compression
   echo ""
 
+  # Check once for every source host whether it is blocked, before any list is downloaded
+  gravity_CheckBlockedHosts "${sourceDomains[@]}"
+
   # Prepare new gravity database
   str="Preparing new gravity database"
   echo -ne "  ${INFO} ${str}..."
@@ -363,50 +445,13 @@ gravity_DownloadBlocklists() {
 
   target="$(mktemp -p "/tmp" --suffix=".gravity")"
 
-  # Use compression to reduce the amount of data that is transfered
-  # between the Pi-hole and the ad list provider. Use this feature
-  # only if it is supported by the locally available version of curl
-  if curl -V | grep -q "Features:.* libz"; then
-    compression="--compressed"
-    echo -e "  ${INFO} Using libz compression\n"
-  else
-      compression=""
-      echo -e "  ${INFO} Libz compression not available\n"
-    fi
+  compression="$(gravity_GetCompression)"
   # Loop through $sources and download each one
   for ((i = 0; i < "${#sources[@]}"; i++)); do
-    url="${sources[$i]}"
-    domain="${sourceDomains[$i]}"
-    id="${sourceIDs[$i]}"
-
     # Save the file as list.#.domain
-    saveLocation="${piholeDir}/list.${id}.${domain}.${domainsExtension}"
-    activeDomains[$i]="${saveLocation}"
+    activeDomains[$i]="${piholeDir}/list.${sourceIDs[$i]}.${sourceDomains[$i]}.${domainsExtension}"
 
-    # Default user-agent (for Cloudflare's Browser Integrity Check: https://support.cloudflare.com/hc/en-us/articles/200170086-What-does-the-Browser-Integrity-Check-do-)
-    agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.102 Safari/537.36"
-
-    # Provide special commands for blocklists which may need them
-    case "${domain}" in
-      "pgl.yoyo.org") cmd_ext="-d mimetype=plaintext -d hostformat=hosts";;
-      *) cmd_ext="";;
-    esac
-
-    echo -e "  ${INFO} Target: ${url}"
-    local regex check_url
-    # Check for characters NOT allowed in URLs
-    regex="[^a-zA-Z0-9:/?&%=~._()-;]"
-
-    # this will remove first @ that is after schema and before domain
-    # \1 is optional schema, \2 is userinfo
-    check_url="$( sed -re 's#([^:/]*://)?([^/]+)@#\1\2#' <<< "$url" )"
-
-    if [[ "${check_url}" =~ ${regex} ]]; then
-        echo -e "  ${CROSS} Invalid Target"
-    else
-       gravity_DownloadBlocklistFromUrl "${url}" "${cmd_ext}" "${agent}" "${sourceIDs[$i]}" "${saveLocation}" "${target}" "${compression}"
-    fi
-    echo ""
+    gravity_DownloadBlocklist "${sources[$i]}" "${sourceDomains[$i]}" "${sourceIDs[$i]}" "${target}" "${compression}"
   done
 
   str="Storing downloaded domains in new gravity database"
@@ -443,7 +488,150 @@ gravity_DownloadBlocklists() {
   gravity_Blackbody=true
 }
 
+# Refresh only the adlists whose refresh interval has elapsed since they were last checked
+# Their domains are replaced in the live gravity database, all other lists are left untouched
+gravity_RefreshDueLists() {
+  local str target compression ids id i
+  local -a sources sourceIDs sourceDomains
+
+  # Retrieve due lists from gravity database
+  # Lists without a refresh interval are only updated by full gravity runs
+  mapfile -t sourceIDs <<< "$(sqlite3 "${gravityDBfile}" "SELECT id FROM vw_adlist WHERE id IN (SELECT id FROM adlist WHERE refresh_interval IS NOT NULL AND IFNULL(date_checked, 0) + refresh_interval <= cast(strftime('%s', 'now') as int));" 2> /dev/null)"
+  if [[ -z "${sourceIDs[*]}" ]]; then
+    echo -e "  ${INFO} No adlist is due for a refresh"
+    return 1
+  fi
+  for id in "${sourceIDs[@]}"; do
+    sources+=("$(sqlite3 "${gravityDBfile}" "SELECT address FROM adlist WHERE id = ${id};" 2> /dev/null)")
+  done
+
+  # Parse source domains from $sources
+  mapfile -t sourceDomains <<< "$(gravity_ParseSourceDomains "${sources[@]}")"
+
+  echo -e "  ${INFO} Refreshing ${#sourceIDs[@]} due adlist(s)"
+  echo ""
+
+  # Check once for every source host whether it is blocked, before any list is downloaded
+  gravity_CheckBlockedHosts "${sourceDomains[@]}"
+
+  target="$(mktemp -p "/tmp" --suffix=".gravity")"
+
+  compression="$(gravity_GetCompression)"
+  # Loop through $sources and download each one
+  for ((i = 0; i < "${#sources[@]}"; i++)); do
+    gravity_DownloadBlocklist "${sources[$i]}" "${sourceDomains[$i]}" "${sourceIDs[$i]}" "${target}" "${compression}"
+  done
+
+  # Only replace the domains of lists we received content for (either fresh or from the cache),
+  # lists without any usable content keep their current domains
+  ids="$(cut -d, -f2 < "${target}" | sort -u | paste -sd, -)"
+  if [[ -z "${ids}" ]]; then
+    rm "${target}" > /dev/null 2>&1
+    echo -e "  ${INFO} No domains received, gravity database left unchanged"
+    return 1
+  fi
+
+  str="Replacing domains of refreshed adlists"
+  echo -ne "  ${INFO} ${str}..."
+  # Delete and import in one transaction so FTL never sees the lists half-imported
+  output=$( { printf ".timeout 30000\\nBEGIN TRANSACTION;\\nDELETE FROM gravity WHERE adlist_id IN (%s);\\n.mode csv\\n.import \"%s\" gravity\\nCOMMIT;\\n" "${ids}" "${target}" | lock_gravityDB sqlite3 "${gravityDBfile}"; } 2>&1 )
+  status="$?"
+
+  rm "${target}" > /dev/null 2>&1 || \
+    echo -e "  ${CROSS} Unable to remove ${target}"
+
+  if [[ "${status}" -ne 0 ]]; then
+    echo -e "\\n  ${CROSS} Unable to replace domains in database ${gravityDBfile}\\n  ${output}"
+    gravity_Cleanup "error"
+  else
+    echo -e "${OVER}  ${TICK} ${str}"
+  fi
+}
+
+# Source hosts blocked by Pi-hole, mapped to their address as resolved by the upstream server
+# and the list they are blocked by
+declare -A blockedHosts blockingLists
+
+# Determine whether the source hosts are blocked by Pi-hole
+# Every host is checked only once, and all hosts are checked concurrently
+gravity_CheckBlockedHosts() {
+  local host hostsDir ip_addr port str i=0 maxJobs=8
+  local -A checked
+
+  str="Checking source hosts"
+  echo -ne "  ${INFO} ${str}..."
+
+  hostsDir="$(mktemp -d -p "/tmp" "gravity_hosts.XXXXX")"
+
+  printf -v ip_addr "%s" "${PIHOLE_DNS_1%#*}"
+  if [[ ${PIHOLE_DNS_1} != *"#"* ]]; then
+    port=53
+  else
+    printf -v port "%s" "${PIHOLE_DNS_1#*#}"
+  fi
+
+  for host in "$@"; do
+    if [[ "${host}" == "local" ]] || [[ -n "${checked[${host}]:-}" ]]; then
+      continue
+    fi
+    checked[${host}]=true
+    i=$((i+1))
+
+    # Limit the number of lookups running at the same time
+    while [[ $(jobs -rp | wc -l) -ge ${maxJobs} ]]; do
+      sleep 0.1
+    done
+
+    (
+      blocked=false
+      case $BLOCKINGMODE in
+        "IP-NODATA-AAAA"|"IP")
+            if [[ $(dig "${host}" +short | grep "${IPV4_ADDRESS}" -c) -ge 1 ]]; then
+              blocked=true
+            fi;;
+        "NXDOMAIN")
+            if [[ $(dig "${host}" | grep "NXDOMAIN" -c) -ge 1 ]]; then
+              blocked=true
+            fi;;
+        "NULL"|*)
+            if [[ $(dig "${host}" +short | grep "0.0.0.0" -c) -ge 1 ]]; then
+              blocked=true
+            fi;;
+      esac
+
+      if [[ "${blocked}" == true ]]; then
+        ip=$(dig "@${ip_addr}" -p "${port}" +short "${host}" | tail -1)
+        # Find the list the host is blocked by without running a full "pihole -q"
+        suffix="${host//\'/\'\'}"
+        suffixes="'${suffix}'"
+        while [[ "${suffix}" == *.* ]]; do
+          suffix="${suffix#*.}"
+          suffixes="${suffixes},'${suffix}'"
+        done
+        bad_list=$(sqlite3 "${gravityDBfile}" "SELECT 'exact blacklist' FROM vw_blacklist WHERE domain = '${host//\'/\'\'}' UNION ALL
+                                               SELECT 'wildcard blacklist' FROM vw_wildcard_blacklist WHERE domain IN (${suffixes}) UNION ALL
+                                               SELECT address FROM adlist WHERE id = (SELECT adlist_id FROM gravity WHERE domain = '${host//\'/\'\'}' LIMIT 1) LIMIT 1;" 2> /dev/null)
+        printf "%s\t%s\t%s\n" "${host}" "${ip}" "${bad_list:-unknown}" > "${hostsDir}/${i}"
+      fi
+    ) &
+  done
+  wait
+
+  while IFS=$'\t' read -r host ip bad_list; do
+    blockedHosts[${host}]="${ip}"
+    blockingLists[${host}]="${bad_list}"
+  done < <(cat "${hostsDir}"/* 2> /dev/null)
+
+  rm -rf "${hostsDir}"
+  echo -e "${OVER}  ${TICK} ${str} (${i} unique hosts, ${#blockedHosts[@]} blocked)"
+}
+
 total_num=0
+# Number of lines and invalid lines of the last list parsed, for the adlist history
+list_num_lines=0
+list_num_invalid=0
+# One "<adlist ID> <lines> <invalid lines> <bytes> <duration> <HTTP code>" entry per list downloaded in this run
+gravityHistory=()
 parseList() {
   local adlistID="${1}" src="${2}" target="${3}" incorrect_lines
   # This sed does the following things:
@@ -462,6 +650,8 @@ parseList() {
   num_correct_lines="$(( num_target_lines-total_num ))"
   total_num="$num_target_lines"
   num_invalid="$(( num_lines-num_correct_lines ))"
+  list_num_lines="${num_lines}"
+  list_num_invalid="${num_invalid}"
   if [[ "${num_invalid}" -eq 0 ]]; then
     echo "  ${INFO} Received ${num_lines} domains"
   else
@@ -480,7 +670,7 @@ parseList() {
 # Download specified URL and perform checks on HTTP status and file content
 gravity_DownloadBlocklistFromUrl() {
   local url="${1}" cmd_ext="${2}" agent="${3}" adlistID="${4}" saveLocation="${5}" target="${6}" compression="${7}"
-  local heisenbergCompensator="" patternBuffer str httpCode success=""
+  local heisenbergCompensator="" patternBuffer str httpCode success="" changed="" oldChecksum bytes seconds fraction
 
   # Create temp file to store content on disk instead of RAM
   patternBuffer=$(mktemp -p "/tmp" --suffix=".phgpb")
@@ -495,50 +685,27 @@ gravity_DownloadBlocklistFromUrl() {
 
   str="Status:"
   echo -ne "  ${INFO} ${str} Pending..."
-  blocked=false
-  case $BLOCKINGMODE in
-    "IP-NODATA-AAAA"|"IP")
-        if [[ $(dig "${domain}" +short | grep "${IPV4_ADDRESS}" -c) -ge 1 ]]; then
-          blocked=true
-        fi;;
-    "NXDOMAIN")
-        if [[ $(dig "${domain}" | grep "NXDOMAIN" -c) -ge 1 ]]; then
-          blocked=true
-        fi;;
-    "NULL"|*)
-        if [[ $(dig "${domain}" +short | grep "0.0.0.0" -c) -ge 1 ]]; then
-          blocked=true
-        fi;;
-   esac
-
-  if [[ "${blocked}" == true ]]; then
-    printf -v ip_addr "%s" "${PIHOLE_DNS_1%#*}"
-    if [[ ${PIHOLE_DNS_1} != *"#"* ]]; then
-        port=53
-    else
-        printf -v port "%s" "${PIHOLE_DNS_1#*#}"
-    fi
-    ip=$(dig "@${ip_addr}" -p "${port}" +short "${domain}" | tail -1)
+  # The blocked status of the host has been determined by gravity_CheckBlockedHosts
+  if [[ -n "${blockedHosts[${domain}]+x}" ]]; then
     if [[ $(echo "${url}" | awk -F '://' '{print $1}') = "https" ]]; then
       port=443;
     else port=80
     fi
-    bad_list=$(pihole -q -adlist "${domain}" | head -n1 | awk -F 'Match found in ' '{print $2}')
-    echo -e "${OVER}  ${CROSS} ${str} ${domain} is blocked by ${bad_list%:}. Using DNS on ${PIHOLE_DNS_1} to download ${url}";
+    echo -e "${OVER}  ${CROSS} ${str} ${domain} is blocked by ${blockingLists[${domain}]}. Using DNS on ${PIHOLE_DNS_1} to download ${url}";
     echo -ne "  ${INFO} ${str} Pending..."
-    cmd_ext="--resolve $domain:$port:$ip $cmd_ext"
+    cmd_ext="--resolve $domain:$port:${blockedHosts[${domain}]} $cmd_ext"
   fi
 
   # shellcheck disable=SC2086
-  httpCode=$(curl -s -L ${compression} ${cmd_ext} ${heisenbergCompensator} -w "%{http_code}" -A "${agent}" "${url}" -o "${patternBuffer}" 2> /dev/null)
+  read -r httpCode bytes seconds <<< "$(curl -s -L ${compression} ${cmd_ext} ${heisenbergCompensator} -w "%{http_code} %{size_download} %{time_total}" -A "${agent}" "${url}" -o "${patternBuffer}" 2> /dev/null)"
 
   case $url in
     # Did we "download" a local file?
     "file"*)
         if [[ -s "${patternBuffer}" ]]; then
-          echo -e "${OVER}  ${TICK} ${str} Retrieval successful"; success=true
+          echo -e "${OVER}  ${TICK} ${str} Retrieval successful"; success=true; httpCode="200"
         else
-          echo -e "${OVER}  ${CROSS} ${str} Not found / empty list"
+          echo -e "${OVER}  ${CROSS} ${str} Not found / empty list"; httpCode="404"
         fi;;
     # Did we "download" a remote file?
     *)
@@ -559,15 +726,25 @@ gravity_DownloadBlocklistFromUrl() {
       esac;;
   esac
 
+  list_num_lines=0
+  list_num_invalid=0
   # Determine if the blocklist was downloaded and saved correctly
   if [[ "${success}" == true ]]; then
     if [[ "${httpCode}" == "304" ]]; then
+      changed=false
       # Add domains to database table file
       parseList "${adlistID}" "${saveLocation}" "${target}"
     # Check if $patternbuffer is a non-zero length file
     elif [[ -s "${patternBuffer}" ]]; then
+      oldChecksum="$(cksum 2> /dev/null < "${saveLocation}")"
       # Determine if blocklist is non-standard and parse as appropriate
       gravity_ParseFileIntoDomains "${patternBuffer}" "${saveLocation}"
+      # Compare against the previously cached list to learn whether the list changed
+      if [[ "$(cksum < "${saveLocation}")" == "${oldChecksum}" ]]; then
+        changed=false
+      else
+        changed=true
+      fi
       # Add domains to database table file
       parseList "${adlistID}" "${saveLocation}" "${target}"
       # Update date_updated field in gravity database table
@@ -586,6 +763,20 @@ gravity_DownloadBlocklistFromUrl() {
       echo -e "  ${CROSS} List download failed: ${COL_LIGHT_RED}no cached list available${COL_NC}"
     fi
   fi
+
+  # Update date_checked field (and adaptive refresh interval) in gravity database table
+  # Only due-list refreshes adapt the interval: full runs download every list whether it is due or not,
+  # so an unchanged list would look stale and be checked less often
+  if [[ "${refreshDue:-}" == true ]]; then
+    database_adlist_checked "${adlistID}" "${changed}"
+  else
+    database_adlist_checked "${adlistID}"
+  fi
+
+  # Remember the run of this list for the adlist history, with the duration in ms
+  seconds="${seconds:-0.000}"
+  fraction="${seconds#*.}000"
+  gravityHistory+=("${adlistID} ${list_num_lines} ${list_num_invalid} ${bytes%.*} $(( 10#${seconds%.*} * 1000 + 10#${fraction:0:3} )) ${httpCode}")
 }
 
 # Parse source files into domains format
@@ -662,25 +853,182 @@ gravity_ParseFileIntoDomains() {
 gravity_Table_Count() {
   local table="${1}"
   local str="${2}"
+  local where="${3:-1}"
   local num
-  num="$(sqlite3 "${gravityDBfile}" "SELECT COUNT(*) FROM ${table};")"
-  if [[ "${table}" == "vw_gravity" ]]; then
-    local unique
-    unique="$(sqlite3 "${gravityDBfile}" "SELECT COUNT(DISTINCT domain) FROM ${table};")"
-    echo -e "  ${INFO} Number of ${str}: ${num} (${COL_BOLD}${unique} unique domains${COL_NC})"
-    sqlite3 "${gravityDBfile}" "INSERT OR REPLACE INTO info (property,value) VALUES ('gravity_count',${unique});"
-  else
-    echo -e "  ${INFO} Number of ${str}: ${num}"
+  num="$(sqlite3 "${gravityDBfile}" "SELECT COUNT(*) FROM ${table} WHERE ${where};")"
+  echo -e "  ${INFO} Number of ${str}: ${num}"
+}
+
+# Compute per-adlist and per-group statistics in a single pass over the gravity table
+# The gravity index is read in domain order so all lists containing a domain are seen at once:
+# - adlist_stats: number of domains, domains found only in this list, and domains shared with other lists
+# - adlist_overlap: number of domains shared by each pair of lists
+# - group_stats: one row per group with the number of gravity domains on the group's lists
+#   that are not exactly whitelisted for the group, and the number that are. Regex and
+#   wildcard whitelists and the group's blacklist entries are not taken into account, so
+#   this is gravity minus the exact whitelist, not the number of domains FTL blocks
+# - info.gravity_count: number of unique domains on lists in vw_adlist, which (like
+#   vw_gravity) only contains enabled lists assigned to an enabled group or to none
+gravity_ComputeStatistics() {
+  local str="Computing statistics"
+  echo -ne "  ${INFO} ${str}..."
+
+  output=$( { sqlite3 -separator $'\t' "${gravityDBfile}" \
+    "SELECT 'A', id FROM vw_adlist;
+     SELECT 'E', id FROM \"group\";
+     SELECT 'G', adlist_by_group.adlist_id, adlist_by_group.group_id FROM adlist_by_group
+       JOIN adlist ON adlist.id = adlist_by_group.adlist_id JOIN \"group\" ON \"group\".id = adlist_by_group.group_id
+       WHERE adlist.enabled = 1 AND \"group\".enabled = 1;
+     SELECT 'W', group_id, domain FROM vw_whitelist WHERE group_id IS NOT NULL;
+     SELECT 'D', domain, adlist_id FROM gravity ORDER BY domain, adlist_id;" | \
+    awk -F '\t' '
+    function finish(    i, j, key, g, gs, num, counted) {
+      if (n == 0) { return }
+      counted = 0
+      for (i = 1; i <= n; i++) {
+        domains[lists[i]]++
+        if (lists[i] in active) { counted = 1 }
+      }
+      if (counted) { count++ }
+      if (n == 1) {
+        unique[lists[1]]++
+      } else {
+        for (i = 1; i <= n; i++) {
+          overlap[lists[i]]++
+          for (j = 1; j <= n; j++) {
+            if (i != j) { pairs[lists[i] SUBSEP lists[j]]++ }
+          }
+        }
+      }
+      # The groups of a combination of lists are computed only once
+      key = ""
+      for (i = 1; i <= n; i++) { key = key " " lists[i] }
+      if (!(key in groupsets)) {
+        split("", seen)
+        groupsets[key] = ""
+        for (i = 1; i <= n; i++) {
+          num = split(groups[lists[i]], gs, " ")
+          for (j = 1; j <= num; j++) {
+            if (!(gs[j] in seen)) { seen[gs[j]] = 1; groupsets[key] = groupsets[key] " " gs[j] }
+          }
+        }
+      }
+      num = split(groupsets[key], gs, " ")
+      for (i = 1; i <= num; i++) {
+        if ((gs[i] SUBSEP domain) in whitelist) { whitelisted[gs[i]]++ } else { remaining[gs[i]]++ }
+      }
+      n = 0
+    }
+    $1 == "A" { active[$2] = 1; next }
+    $1 == "E" { allgroups[$2] = 1; next }
+    $1 == "G" { groups[$2] = groups[$2] " " $3; next }
+    $1 == "W" { whitelist[$2 SUBSEP $3] = 1; next }
+    $1 == "D" {
+      if ($2 != domain) { finish(); domain = $2 }
+      # Lists containing a domain more than once are only counted once
+      if (n == 0 || lists[n] != $3) { lists[++n] = $3 }
+    }
+    END {
+      finish()
+      print ".timeout 30000"
+      print "BEGIN TRANSACTION;"
+      print "DELETE FROM adlist_stats;"
+      print "DELETE FROM adlist_overlap;"
+      print "DELETE FROM group_stats;"
+      for (id in active) { if (!(id in domains)) { domains[id] = 0 } }
+      for (id in domains) {
+        printf "INSERT INTO adlist_stats (adlist_id,domains,unique_domains,overlap) VALUES (%d,%d,%d,%d);\n", id, domains[id], unique[id], overlap[id]
+      }
+      for (pair in pairs) {
+        split(pair, ids, SUBSEP)
+        printf "INSERT INTO adlist_overlap (adlist_id,other_adlist_id,domains) VALUES (%d,%d,%d);\n", ids[1], ids[2], pairs[pair]
+      }
+      for (g in allgroups) {
+        printf "INSERT INTO group_stats (group_id,gravity_minus_exact_whitelist,exact_whitelisted) VALUES (%d,%d,%d);\n", g, remaining[g], whitelisted[g]
+      }
+      printf "INSERT OR REPLACE INTO info (property,value) VALUES (\047gravity_count\047,%d);\n", count
+      print "COMMIT;"
+    }' | lock_gravityDB sqlite3 "${gravityDBfile}"; } 2>&1 )
+  status="$?"
+
+  if [[ "${status}" -ne 0 ]]; then
+    echo -e "\\n  ${CROSS} Unable to compute statistics in ${gravityDBfile}\\n  ${output}"
+    return 1
+  fi
+  echo -e "${OVER}  ${TICK} ${str}"
+}
+
+# Append the lists downloaded in this run to the adlist history, then roll up and expire old history
+# The unique domains of every list have been computed by gravity_ComputeStatistics
+gravity_RecordHistory() {
+  local str="Recording adlist history" entry id lines invalid bytes duration httpCode timestamp
+  echo -ne "  ${INFO} ${str}..."
+
+  timestamp="$(date +%s)"
+  output=$( { {
+    printf ".timeout 30000\\nBEGIN TRANSACTION;\\n"
+    for entry in "${gravityHistory[@]}"; do
+      read -r id lines invalid bytes duration httpCode <<< "${entry}"
+      printf "INSERT OR REPLACE INTO adlist_history (adlist_id,timestamp,domains,invalid,unique_domains,bytes,duration,http_code) VALUES (%d,%d,%d,%d,IFNULL((SELECT unique_domains FROM adlist_stats WHERE adlist_id = %d),0),%d,%d,%d);\\n" \
+        "${id}" "${timestamp}" "${lines}" "${invalid}" "${id}" "${bytes}" "${duration}" "${httpCode}"
+    done
+    printf "COMMIT;\\n"
+  } | lock_gravityDB sqlite3 -bail "${gravityDBfile}" && "${historyScript}" rollup; } 2>&1 )
+  status="$?"
+
+  if [[ "${status}" -ne 0 ]]; then
+    echo -e "\\n  ${CROSS} Unable to record adlist history in ${gravityDBfile}\\n  ${output}"
+    return 1
+  fi
+  echo -e "${OVER}  ${TICK} ${str}"
+}
+
+# Compile the gravity database into the read-only snapshot used for fast lookups
+# A Bloom filter is built as well if GRAVITY_SNAPSHOT_BLOOM=true is set in setupVars.conf
+gravity_BuildSnapshot() {
+  local str="Building gravity snapshot" args=()
+  echo -ne "  ${INFO} ${str}..."
+
+  if [[ "${GRAVITY_SNAPSHOT_BLOOM:-}" == true ]]; then
+    args+=("--bloom")
+  fi
+
+  output=$( { "${snapshotScript}" build "${args[@]}"; } 2>&1 )
+  status="$?"
+
+  if [[ "${status}" -ne 0 ]]; then
+    echo -e "\\n  ${CROSS} Unable to build gravity snapshot\\n  ${output}"
+    return 1
   fi
+  echo -e "${OVER}  ${TICK} ${str}"
 }
 
 # Output count of blacklisted domains and regex filters
 gravity_ShowCount() {
-  gravity_Table_Count "vw_gravity" "gravity domains" ""
+  local num unique line
+  # The number of gravity domains has been computed by gravity_ComputeStatistics
+  IFS='|' read -r num unique <<< "$(sqlite3 "${gravityDBfile}" "SELECT CAST(TOTAL(domains) AS INT), (SELECT value FROM info WHERE property = 'gravity_count') FROM adlist_stats WHERE adlist_id IN (SELECT id FROM vw_adlist);")"
+  echo -e "  ${INFO} Number of gravity domains: ${num} (${COL_BOLD}${unique} unique domains${COL_NC})"
   gravity_Table_Count "vw_blacklist" "exact blacklisted domains"
-  gravity_Table_Count "vw_regex_blacklist" "regex blacklist filters"
+  gravity_Table_Count "vw_wildcard_blacklist" "wildcard blacklisted domains"
+  # The regex views contain the wildcards as regex filters for FTL, too
+  gravity_Table_Count "vw_regex_blacklist" "regex blacklist filters" "id NOT IN (SELECT id FROM domainlist WHERE type = 5)"
   gravity_Table_Count "vw_whitelist" "exact whitelisted domains"
-  gravity_Table_Count "vw_regex_whitelist" "regex whitelist filters"
+  gravity_Table_Count "vw_wildcard_whitelist" "wildcard whitelisted domains"
+  gravity_Table_Count "vw_regex_whitelist" "regex whitelist filters" "id NOT IN (SELECT id FROM domainlist WHERE type = 4)"
+
+  # Report enabled lists which do not contribute a single domain that is not found in another list, too
+  local redundant=()
+  mapfile -t redundant < <(sqlite3 "${gravityDBfile}" "SELECT adlist.id || ': ' || address || ' (' || adlist_stats.domains || ' domains, most of them in list ' ||
+    (SELECT other_adlist_id FROM adlist_overlap WHERE adlist_overlap.adlist_id = adlist.id ORDER BY adlist_overlap.domains DESC LIMIT 1) || ')'
+    FROM adlist_stats JOIN adlist ON adlist.id = adlist_stats.adlist_id
+    WHERE adlist.enabled = 1 AND adlist_stats.domains > 0 AND adlist_stats.unique_domains = 0 ORDER BY adlist.id;")
+  if [[ "${#redundant[@]}" -gt 0 ]]; then
+    echo -e "  ${INFO} ${#redundant[@]} adlist(s) do not contain any domain which is not on another adlist:"
+    for line in "${redundant[@]}"; do
+      echo -e "      - ${line}"
+    done
+  fi
 }
 
 # Parse list of domains into hosts format
@@ -763,6 +1111,9 @@ gravity_Cleanup() {
     dnsWasOffline=true
   fi
 
+  # FTL has been told to reload the lists from the new database by now
+  remove_old_gravityDB
+
   # Print Pi-hole status if an error occurred
   if [[ -n "${error}" ]]; then
     "${PIHOLE_COMMAND}" status
@@ -776,6 +1127,7 @@ Update domains from blocklists specified in adlists.list
 
 Options:
   -f, --force          Force the download of all specified blocklists
+  --due                Only refresh adlists whose refresh interval has elapsed
   -h, --help           Show this help dialog"
   exit 0
 }
@@ -784,6 +1136,7 @@ for var in "$@"; do
   case "${var}" in
     "-f" | "--force" ) forceDelete=true;;
     "-r" | "--recreate" ) recreate_database=true;;
+    "--due" ) refreshDue=true;;
     "-h" | "--help" ) helpFunc;;
   esac
 done
@@ -804,6 +1157,33 @@ fi
 # Move possibly existing legacy files to the gravity database
 migrate_to_database
 
+# Followers take their database from the leader instead of building it
+if [[ -n "${SYNC_LEADER:-}" ]]; then
+  echo -e "  ${INFO} Synchronizing gravity database with ${SYNC_LEADER}"
+  "${syncScript}" pull "${SYNC_LEADER}"
+  exit $?
+fi
+
+# Scheduled runs only refresh the lists that are due
+if [[ "${refreshDue:-}" == true ]]; then
+  if gravity_RefreshDueLists; then
+    update_gravity_timestamp
+    gravity_ComputeStatistics
+    gravity_RecordHistory
+    checkpoint_gravityDB "${gravityDBfile}"
+    gravity_BuildSnapshot
+    "${PIHOLE_COMMAND}" restartdns reload-lists
+    refreshed=true
+  fi
+  gravity_Cleanup
+  echo ""
+  # Publish the new build for followers
+  if [[ "${refreshed:-}" == true && -n "${SYNC_PUBLISH_DIR:-}" ]]; then
+    "${syncScript}" publish "${SYNC_PUBLISH_DIR}"
+  fi
+  exit 0
+fi
+
 if [[ "${forceDelete:-}" == true ]]; then
   str="Deleting existing list cache"
   echo -ne "${INFO} ${str}..."
@@ -825,9 +1205,17 @@ gravity_swap_databases
 # Update gravity timestamp
 update_gravity_timestamp
 
-# Ensure proper permissions are set for the database
-chown pihole:pihole "${gravityDBfile}"
-chmod g+w "${piholeDir}" "${gravityDBfile}"
+# Compute per-adlist and per-group statistics
+gravity_ComputeStatistics
+
+# Append this run to the adlist history
+gravity_RecordHistory
+
+# Write the statistics from the write-ahead log into the database
+checkpoint_gravityDB "${gravityDBfile}"
+
+# Compile the snapshot from the new database
+gravity_BuildSnapshot
 
 # Compute numbers to be displayed
 gravity_ShowCount
@@ -840,4 +1228,10 @@ fi
 gravity_Cleanup
 echo ""
 
+# Publish the new build for followers
+if [[ -n "${SYNC_PUBLISH_DIR:-}" ]]; then
+  "${syncScript}" publish "${SYNC_PUBLISH_DIR}"
+  echo ""
+fi
+
 "${PIHOLE_COMMAND}" status
@@ -160,6 +160,27 @@ def test_update_package_cache_failure_no_errors(Pihole):
     assert 'Error: Unable to update package cache.' in updateCache.stdout
 
 
+def test_dependency_checks_skipped_when_unchanged(Pihole):
+    '''
+    confirms a repair skips the dependency checks recorded in the manifest
+    '''
+    install = Pihole.run('''
+    source /opt/pihole/basic-install.sh
+    distro_check
+    install_dependent_packages ${INSTALLER_DEPS[@]}
+    ''')
+    repair = Pihole.run('''
+    source /opt/pihole/basic-install.sh
+    distro_check
+    useUpdateVars=true
+    install_dependent_packages ${INSTALLER_DEPS[@]}
+    ''')
+    assert 'Checking for git' in install.stdout
+    assert 'Checking for git' not in repair.stdout
+    expected_stdout = tick_box + ' Dependencies unchanged since last install'
+    assert expected_stdout in repair.stdout
+
+
 def test_FTL_detect_aarch64_no_errors(Pihole):
     '''
     confirms only aarch64 package is downloaded for FTL engine
@@ -595,3 +616,35 @@ def test_os_check_passes(Pihole):
     ''')
     expected_stdout = 'Supported OS detected'
     assert expected_stdout in detectOS.stdout
+
+
+def test_migrated_wildcards_visible_to_FTL(Pihole):
+    '''
+    confirms wildcards moved out of the regex filters by the gravity
+    database migration are still found in the regex views read by FTL
+    '''
+    Pihole.run('''
+    source /opt/pihole/basic-install.sh
+    distro_check
+    update_package_cache
+    install_dependent_packages $(printf '%s\\n' "${PIHOLE_DEPS[@]}" | grep '^sqlite')
+    ''')
+    migration = Pihole.run(r'''
+    sqlite3 /tmp/gravity.db < /etc/.pihole/advanced/Templates/gravity.db.sql
+    sqlite3 /tmp/gravity.db "DROP VIEW vw_wildcard_whitelist;
+        DROP VIEW vw_wildcard_blacklist;
+        UPDATE info SET value = 14 WHERE property = 'version';
+        INSERT INTO domainlist (type, domain) VALUES (2, '(^|\.)allowed\.org$');
+        INSERT INTO domainlist (type, domain) VALUES (3, '(^|\.)example\.com$');
+        INSERT INTO domainlist (type, domain) VALUES (3, '^ad[0-9]+\.');"
+    sqlite3 /tmp/gravity.db < \
+        /etc/.pihole/advanced/Scripts/database_migration/gravity/14_to_15.sql
+    sqlite3 /tmp/gravity.db "SELECT type, domain FROM domainlist ORDER BY id;
+        SELECT 'whitelist', domain FROM vw_regex_whitelist;
+        SELECT 'blacklist', domain FROM vw_regex_blacklist;"
+    ''')
+    assert '4|allowed.org' in migration.stdout
+    assert '5|example.com' in migration.stdout
+    assert r'whitelist|(^|\.)allowed\.org$' in migration.stdout
+    assert r'blacklist|(^|\.)example\.com$' in migration.stdout
+    assert r'blacklist|^ad[0-9]+\.' in migration.stdout